@@ -0,0 +1,8 @@
+"""Benchmarks for django-brake. These are not shipped with the package.
+
+Run them from the repository root, e.g.::
+
+    DJANGO_SETTINGS_MODULE=test_settings python -m benchmarks.sliding_window
+    DJANGO_SETTINGS_MODULE=test_settings python -m benchmarks.hotpath
+    DJANGO_SETTINGS_MODULE=test_settings python -m benchmarks.keys
+"""
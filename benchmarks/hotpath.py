@@ -0,0 +1,343 @@
+"""Measure the per-request cost of ``@ratelimit`` and the backends.
+
+Every decorated view is run against every backend in a single process and
+reported with requests per second, p50/p99 latency and the number of cache
+(or Redis) calls per request. A second pass has several workers count the
+same key at once against a cache they share and reports the fraction of
+increments that were lost.
+
+Run from the repository root::
+
+    DJANGO_SETTINGS_MODULE=test_settings python -m benchmarks.hotpath \\
+        --output results.json
+
+The workers of the contention pass are threads sharing a LocMemCache,
+switching as often as the interpreter allows, unless ``--memcached`` is
+given; then they are processes sharing that server. Redis is benchmarked
+against fakeredis when it is installed, or against the server at
+``--redis-url``.
+"""
+import argparse
+import multiprocessing
+import sys
+import threading
+import timeit
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse
+
+from benchmarks.support import CountingCache, Request, percentile, write_json
+from brake import decorators
+from brake.backends import cachebe, gcrabe, sketchbe
+from brake.backends.redisbe import RedisBackend, redis
+from brake.decorators import ratelimit
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def view(request):
+    return HttpResponse()
+
+
+def login(request):
+    return HttpResponse()
+
+
+def views():
+    """The decorated views, built afresh so nothing is shared between runs."""
+    stacked = ratelimit(rate='1000/m')(ratelimit(rate='10000/h')(
+        ratelimit(rate='100000/d')(view)))
+    return [
+        ('single rate', ratelimit(rate='1000/m')(view), 'GET'),
+        ('stacked rates', stacked, 'GET'),
+        ('fields', ratelimit(
+            field=['username', 'email'], method='POST',
+            rate=['1000/m', '10000/h', '100000/d'])(login), 'POST'),
+        ('request path', ratelimit(
+            use_request_path=True,
+            rate=['1000/m', '10000/h', '100000/d'])(view), 'GET'),
+    ]
+
+
+class RedisClient(object):
+    """Builds RedisBackend clients for --redis-url or fakeredis."""
+
+    def __init__(self, url=None):
+        self.url = url
+        self.server = None
+
+    def available(self):
+        return redis is not None and (self.url or fakeredis is not None)
+
+    def client(self, shared=False):
+        if self.url:
+            return redis.Redis.from_url(self.url)
+        if not shared:
+            return fakeredis.FakeRedis()
+        if self.server is None:
+            # A real socket, so that separate processes share one store.
+            self.server = fakeredis.TcpFakeServer(
+                ('127.0.0.1', 0), server_type='redis')
+            thread = threading.Thread(
+                target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        host, port = self.server.server_address
+        return redis.Redis(host=host, port=port)
+
+
+def make_redis_backend(client):
+    backend = RedisBackend()
+    backend.get_client = lambda: client
+    backend.setup()
+    return backend
+
+
+def backends(redis_client):
+    sliding = cachebe.AtomicCacheBackend()
+    sliding.algorithm = cachebe.SLIDING_WINDOW
+    found = [
+        ('CacheBackend', cachebe.CacheBackend),
+        ('AtomicCacheBackend', cachebe.AtomicCacheBackend),
+        ('AtomicCacheBackend sliding', lambda: sliding),
+        ('GCRABackend', gcrabe.GCRABackend),
+        ('SketchBackend', sketchbe.SketchBackend),
+    ]
+    if redis_client.available():
+        found.append(('RedisBackend', lambda: make_redis_backend(
+            redis_client.client())))
+    return found
+
+
+def count_calls(backend):
+    """Route the backend's cache calls through CountingCaches."""
+    counters = []
+    if isinstance(backend, RedisBackend):
+        client = CountingCache(backend.client)
+        script = backend.incr_script
+
+        def counted_script(*args, **kwargs):
+            client.calls += 1
+            return script(*args, **kwargs)
+
+        backend.client = client
+        backend.incr_script = counted_script
+        counters.append(client)
+    else:
+        cachebe.cache = CountingCache(cachebe.cache)
+        counters.append(cachebe.cache)
+    return counters
+
+
+def uncount_calls():
+    while isinstance(cachebe.cache, CountingCache):
+        cachebe.cache = cachebe.cache._cache
+
+
+def run_view(fn, method, backend, iterations, identities):
+    decorators._backend._wrapped = backend
+    requests = [
+        Request('10.0.%d.%d' % (n // 256, n % 256), method,
+            {'username': 'user%d' % n, 'email': 'user%d@example.com' % n},
+            '/path/%d/' % (n % 10))
+        for n in range(identities)
+    ]
+    counters = count_calls(backend)
+    latencies = []
+    timer = timeit.default_timer
+    try:
+        start = timer()
+        for n in range(iterations):
+            before = timer()
+            fn(requests[n % identities])
+            latencies.append(timer() - before)
+        elapsed = timer() - start
+    finally:
+        uncount_calls()
+
+    latencies.sort()
+    return {
+        'ops_per_sec': iterations / elapsed,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'calls_per_request': sum(c.calls for c in counters) / float(
+            iterations),
+    }
+
+
+def _counted(backend, request, rates):
+    limits = backend.limit_many('contention', request, rates=rates)
+    return limits[0]['count'] if limits else 0
+
+
+def _worker(args):
+    make_backend, make_cache, hits = args
+    if make_cache is not None:
+        cachebe.cache = make_cache()
+    backend = make_backend()
+    request = Request('10.0.0.1')
+    for _ in range(hits):
+        backend.count_many('contention', request, rates=[(None, 86400)])
+
+
+class SharedCache(object):
+    """Picklable factory for the cache the contention workers share.
+
+    Without memcached it is a single LocMemCache, which only threads can
+    share.
+    """
+
+    def __init__(self, memcached=None):
+        self.memcached = memcached
+        self.local = None if memcached else LocMemCache('contention', {})
+
+    @property
+    def name(self):
+        return 'memcached' if self.memcached else 'locmem'
+
+    @property
+    def threaded(self):
+        return self.local is not None
+
+    def __call__(self):
+        if self.memcached:
+            from django.core.cache.backends.memcached import PyMemcacheCache
+            return PyMemcacheCache(self.memcached, {})
+        return self.local
+
+
+class SharedBackend(object):
+    """Picklable factory for a backend in a contention worker."""
+
+    def __init__(self, backend_class, redis_client=None):
+        self.backend_class = backend_class
+        self.redis_client = redis_client
+
+    def __call__(self):
+        if self.redis_client is not None:
+            return make_redis_backend(self.redis_client.client(shared=True))
+        return self.backend_class()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.redis_client is not None and self.redis_client.server:
+            # Workers connect to the server by address instead.
+            host, port = self.redis_client.server.server_address
+            state['redis_client'] = RedisClient(
+                'redis://%s:%d/0' % (host, port))
+        return state
+
+
+def contention(processes, hits, memcached, redis_client):
+    """Return the fraction of increments lost per backend."""
+    shared_cache = SharedCache(memcached)
+    contenders = [
+        ('CacheBackend', SharedBackend(cachebe.CacheBackend), shared_cache),
+        ('AtomicCacheBackend', SharedBackend(cachebe.AtomicCacheBackend),
+            shared_cache),
+    ]
+    if redis_client.available():
+        redis_client.client(shared=True)
+        contenders.append(
+            ('RedisBackend', SharedBackend(RedisBackend, redis_client), None))
+
+    results = []
+    real_cache = cachebe.cache
+    switch_interval = sys.getswitchinterval()
+    try:
+        for name, make_backend, make_cache in contenders:
+            threaded = make_cache is not None and shared_cache.threaded
+            if make_cache is not None:
+                cachebe.cache = make_cache()
+                cachebe.cache.clear()
+            backend = make_backend()
+            rates = [(-1, 86400)]
+            request = Request('10.0.0.1')
+            # Prime the counter, as CacheBackend stores a new one as 2.
+            backend.count_many('contention', request, rates=[(None, 86400)])
+            before = _counted(backend, request, rates)
+            if threaded:
+                # Switch threads about as often as processes on separate
+                # cores would interleave.
+                sys.setswitchinterval(1e-6)
+                pool = ThreadPool(processes)
+            else:
+                pool = multiprocessing.Pool(processes)
+            try:
+                pool.map(
+                    _worker, [(make_backend, make_cache, hits)] * processes)
+            finally:
+                pool.close()
+                pool.join()
+                sys.setswitchinterval(switch_interval)
+            counted = _counted(backend, request, rates) - before
+            expected = processes * hits
+            results.append({
+                'backend': name,
+                'cache': 'redis' if make_cache is None else shared_cache.name,
+                'workers': 'threads' if threaded else 'processes',
+                'processes': processes,
+                'increments': expected,
+                'lost_rate': 1 - counted / float(expected),
+            })
+            cachebe.cache = real_cache
+    finally:
+        cachebe.cache = real_cache
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--identities', type=int, default=20,
+        help='distinct clients; keep it low enough for LocMemCache to hold '
+        'every key (300 by default)')
+    parser.add_argument('--processes', type=int, default=4,
+        help='workers in the contention pass')
+    parser.add_argument('--hits', type=int, default=200,
+        help='increments per process in the contention pass')
+    parser.add_argument('--memcached', help='memcached location to share')
+    parser.add_argument('--redis-url')
+    parser.add_argument('--output', help='write the results as JSON here')
+    options = parser.parse_args()
+
+    redis_client = RedisClient(options.redis_url)
+    results = {'hot_path': [], 'contention': []}
+
+    print('%-28s %-16s %10s %9s %9s %10s' % (
+        'backend', 'view', 'ops/sec', 'p50 us', 'p99 us', 'calls/req'))
+    for backend_name, make_backend in backends(redis_client):
+        for view_name, fn, method in views():
+            backend = make_backend()
+            uncount_calls()
+            cachebe.cache.clear()
+            result = run_view(
+                fn, method, backend, options.iterations, options.identities)
+            result.update(backend=backend_name, view=view_name)
+            results['hot_path'].append(result)
+            print('%-28s %-16s %10.0f %9.1f %9.1f %10.2f' % (
+                backend_name, view_name, result['ops_per_sec'],
+                result['p50_us'], result['p99_us'],
+                result['calls_per_request']))
+
+    print('')
+    print('%-28s %-10s %-10s %10s %10s' % (
+        'backend', 'cache', 'workers', 'increments', 'lost'))
+    for result in contention(options.processes, options.hits,
+            options.memcached, redis_client):
+        results['contention'].append(result)
+        print('%-28s %-10s %-10s %10d %9.1f%%' % (
+            result['backend'], result['cache'], result['workers'],
+            result['increments'], result['lost_rate'] * 100))
+
+    if options.output:
+        write_json(options.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Measure what building the cache keys for a request costs.
+
+Three rates and two fields give nine keys per request. Key building is
+timed, and the memory it allocates at its peak measured with tracemalloc,
+for:
+
+- the way keys were built before prefixes were remembered, formatting
+  and hashing everything on every call;
+- ``CacheBackend._rate_keys()``, with sha1 and blake2b field digests.
+
+Run from the repository root::
+
+    DJANGO_SETTINGS_MODULE=test_settings python -m benchmarks.keys
+"""
+import hashlib
+import timeit
+import tracemalloc
+
+from benchmarks.support import Request
+from brake.backends.cachebe import (
+    CACHE_PREFIX, IP_PREFIX, KEY_TEMPLATE, PERIOD_PREFIX, CacheBackend)
+
+
+RATES = [(5, 60), (100, 3600), (1000, 86400)]
+FIELDS = ['username', 'email']
+ITERATIONS = 20000
+
+
+def rebuild_keys(backend, request):
+    """Keys as they were built before, from scratch every time."""
+    identities = [(IP_PREFIX, backend.get_ip(request))]
+    for f in FIELDS:
+        val = getattr(request, request.method).get(f)
+        if val:
+            val = hashlib.sha1(val.encode('utf-8')).hexdigest()
+            identities.append(('field:%s:' % f, val))
+    return [
+        (CACHE_PREFIX + KEY_TEMPLATE % (
+            'login', PERIOD_PREFIX, period, prefix, value
+        ), count, period)
+        for count, period in RATES
+        for prefix, value in identities
+    ]
+
+
+def make_request(n=0):
+    return Request('10.0.0.1', 'POST', {
+        'username': 'user%d' % n, 'email': 'user%d@example.com' % n})
+
+
+def measure(name, fn, requests):
+    """Print the time per call of fn and the memory one call allocates."""
+    fn(requests[0])
+    start = timeit.default_timer()
+    for request in requests:
+        fn(request)
+    elapsed = timeit.default_timer() - start
+
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    fn(requests[-1])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('%-30s %9.2f %9d' % (
+        name, elapsed / len(requests) * 1e6, peak - start))
+
+
+def main():
+    sha1 = CacheBackend()
+    blake2b = CacheBackend()
+    blake2b.field_hash = 'blake2b'
+
+    def build(backend):
+        return lambda request: backend._rate_keys(
+            'login', request, True, FIELDS, RATES)
+
+    print('%-30s %9s %9s' % ('keys', 'us/call', 'peak B'))
+    requests = [make_request(n) for n in range(ITERATIONS)]
+    measure('rebuilt every call', lambda r: rebuild_keys(sha1, r), requests)
+    measure('prefixes remembered, sha1', build(sha1), requests)
+    measure('prefixes remembered, blake2b', build(blake2b), requests)
+
+
+if __name__ == '__main__':
+    main()
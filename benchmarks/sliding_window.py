@@ -0,0 +1,108 @@
+"""Compare the fixed and sliding window algorithms.
+
+Accuracy is measured against a virtual clock (which LocMemCache's expiry
+follows as well) with a client that sends a single request to open a
+window and then bursts right before and right after it ends, the worst case
+for fixed windows whether they are aligned to the clock or start with the
+first hit. The number reported is the most requests let through in any
+``period`` seconds, as a multiple of the configured limit.
+
+Cost is measured with the real clock against whatever cache is configured
+as ``default`` (LocMemCache with ``test_settings``).
+"""
+import collections
+import time
+
+from django.core.cache import cache
+from django.core.cache.backends import base, locmem
+
+from benchmarks.support import CountingCache, Request, VirtualClock
+from brake.backends import cachebe
+
+
+LIMIT = 30
+PERIOD = 60
+HITS = 20000
+
+
+def backends():
+    fixed = cachebe.AtomicCacheBackend()
+    sliding = cachebe.AtomicCacheBackend()
+    sliding.algorithm = cachebe.SLIDING_WINDOW
+    return [
+        ('CacheBackend', cachebe.CacheBackend()),
+        ('AtomicCacheBackend fixed-window', fixed),
+        ('AtomicCacheBackend sliding-window', sliding),
+    ]
+
+
+def worst_window(accepted, period):
+    """Most timestamps in ``accepted`` that fit in ``period`` seconds."""
+    window = collections.deque()
+    worst = 0
+    for at in accepted:
+        window.append(at)
+        while window[0] <= at - period:
+            window.popleft()
+        worst = max(worst, len(window))
+    return worst
+
+
+def accuracy(backend, windows=20, step=0.05, burst=5):
+    """Return the worst ratio of accepted requests to the limit."""
+    clock = VirtualClock()
+    modules = (cachebe, base, locmem)
+    real_time = time
+    for module in modules:
+        module.time = clock
+    cache.clear()
+    request = Request('10.0.0.1')
+    accepted = []
+    try:
+        for n in range(int(windows * PERIOD / step)):
+            clock.now = 100 * PERIOD + n * step
+            offset = n % int(2 * PERIOD / step) * step
+            if offset and not PERIOD - burst <= offset < PERIOD + burst:
+                continue
+            if not backend.hit_many(
+                    'bench', request, rates=[(LIMIT, PERIOD)]):
+                accepted.append(clock.now)
+    finally:
+        for module in modules:
+            module.time = real_time
+
+    return worst_window(accepted, PERIOD) / float(LIMIT)
+
+
+def cost(backend):
+    """Return (microseconds, cache calls) per request."""
+    cache.clear()
+    counting = CountingCache(cachebe.cache)
+    cachebe.cache = counting
+    # Stay well below LocMemCache's default MAX_ENTRIES of 300 so that
+    # culling doesn't skew the numbers.
+    requests = [Request('10.0.0.%d' % n) for n in range(100)]
+    try:
+        start = time.time()
+        for n in range(HITS):
+            backend.hit_many(
+                'bench', requests[n % len(requests)],
+                rates=[(LIMIT, PERIOD)])
+        elapsed = time.time() - start
+    finally:
+        cachebe.cache = counting._cache
+
+    return elapsed / HITS * 1e6, counting.calls / float(HITS)
+
+
+def main():
+    print('%-36s %10s %10s %12s' % (
+        'backend', 'worst/lim', 'us/req', 'calls/req'))
+    for name, backend in backends():
+        ratio = accuracy(backend)
+        micros, calls = cost(backend)
+        print('%-36s %10.2f %10.1f %12.2f' % (name, ratio, micros, calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Helpers shared by the benchmarks."""
+import json
+import platform
+import time
+
+import django
+
+
+class Request(object):
+    """Just enough of an HttpRequest for the decorator and backends."""
+
+    def __init__(self, ip, method='GET', data=None, path='/'):
+        self.META = {'REMOTE_ADDR': ip}
+        self.method = method
+        self.path = path
+        setattr(self, method, data or {})
+
+
+class VirtualClock(object):
+    """Stands in for the time module so a benchmark controls what now is."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class CountingCache(object):
+    """Counts every call made on the wrapped cache (or client)."""
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if not callable(attr):
+            return attr
+
+        def _counted(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+
+        return _counted
+
+
+def percentile(values, fraction):
+    """Return the value below which ``fraction`` of sorted ``values`` lie."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def write_json(path, results):
+    """Save results with enough context to compare them between releases."""
+    from brake import VERSION
+
+    with open(path, 'w') as out:
+        json.dump({
+            'brake': '.'.join(map(str, VERSION)),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }, out, indent=2, sort_keys=True)
@@ -0,0 +1,127 @@
+"""Rate-limiting for ``async def`` views.
+
+``@ratelimit`` switches to the wrapper in here when it decorates a coroutine
+function. Backends can provide native coroutine versions of their methods,
+named with an ``a`` prefix (``ahit_many``, ``alimit_many`` and
+``acount_many``); for the others the sync method is run in a thread with
+``asgiref.sync.sync_to_async``.
+
+This lives in a module of its own so that the rest of brake still imports
+on Pythons without ``async``/``await``.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+
+from brake import metrics
+from brake.decorators import (
+    HttpResponseTooManyRequests, _add_headers, _backend, _func_name,
+    _method_match, _spend_quota, _staged, _submit_shadow)
+from brake.shadow import _shadow
+from brake.signals import ratelimit_exceeded
+
+
+async def _call(backend, name, *args):
+    """Await the backend's native async method, or its sync one in a thread."""
+    method = getattr(backend, 'a' + name, None)
+    if method is not None:
+        return await method(*args)
+
+    return await sync_to_async(getattr(backend, name))(*args)
+
+
+async def _check(func_name, request, ip, field, rates, burst, block,
+        counted):
+    """Like brake.decorators._check(), awaiting the backend."""
+    name = 'hit_many' if counted else 'limit_many'
+    if not _staged(request, ip, field, block):
+        return await _call(
+            _backend, name, func_name, request, ip, field, rates, burst)
+
+    limits = await _call(
+        _backend, name, func_name, request, ip, None, rates, burst)
+    if limits:
+        return limits
+    return await _call(
+        _backend, name, func_name, request, False, field, rates, burst)
+
+
+async def _acquire(fn, request, func_name, ip, field, block, max_concurrent):
+    """Like brake.decorators._acquire(), awaiting the backend."""
+    leases, limits = await _call(
+        _backend, 'acquire', func_name, request, ip, field, max_concurrent)
+    if not limits:
+        return leases, None
+
+    request.limited = True
+    request.limits = getattr(request, 'limits', []) + limits
+    ratelimit_exceeded.send(
+        sender=fn, request=request, func_name=func_name, limits=limits)
+    return [], HttpResponseTooManyRequests() if block else None
+
+
+def _ratelimited_async(fn, rates, ip, use_request_path, block, method, field,
+        increment, burst, shadow, max_concurrent):
+    label = _func_name(fn, None, False)
+
+    @wraps(fn)
+    async def _wrapped(request, *args, **kw):
+        func_name = _func_name(fn, request, use_request_path)
+        if shadow or _shadow.everything:
+            # Only queues the request, so there's nothing to await.
+            response = await fn(request, *args, **kw)
+            _submit_shadow(request, response, func_name, method, ip, field,
+                rates, burst, increment, label)
+            return response
+
+        response = None
+        counted = False
+        if rates and _method_match(request, method):
+            started = metrics.start()
+            counted = increment is None
+            limits = await _check(
+                func_name, request, ip, field, rates, burst, block, counted)
+            metrics.checked(
+                _backend, 'hit_many' if counted else 'limit_many',
+                label, rates, limits, counted, started)
+            if limits:
+                if block:
+                    response = HttpResponseTooManyRequests()
+                request.limited = True
+                request.limits = limits
+                ratelimit_exceeded.send(
+                    sender=fn, request=request, func_name=func_name,
+                    limits=limits)
+
+        leases = []
+        if response is None and max_concurrent is not None and \
+                _method_match(request, method):
+            leases, response = await _acquire(
+                fn, request, func_name, ip, field, block, max_concurrent)
+
+        if response is None:
+            try:
+                response = await fn(request, *args, **kw)
+            finally:
+                if leases:
+                    await _call(_backend, 'release', leases)
+
+        if not counted and rates and \
+                not isinstance(response, HttpResponseTooManyRequests):
+            if _method_match(request, method) and \
+                (increment is None or (callable(increment) and increment(
+                    request, response
+                ))):
+                started = metrics.start()
+                await _call(
+                    _backend, 'count_many',
+                    func_name, request, ip, field, rates, burst
+                )
+                metrics.counted(
+                    _backend, 'count_many', label, rates, started)
+                _spend_quota(request)
+
+        _add_headers(request, response)
+        return response
+
+    return _wrapped
@@ -1,7 +1,249 @@
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import ipaddress
+except ImportError:  # Python 2 without the ipaddress backport
+    ipaddress = None
+
+try:
+    from functools import lru_cache
+except ImportError:  # Python 2: addresses are parsed every time.
+    def lru_cache(maxsize):
+        return lambda fn: fn
+
+
+# Fields named like 'query:page' or 'header:X-Api-Key' are read from the
+# query string or the headers instead of the request method's data, so
+# that the request body is never parsed for them.
+QUERY = 'query'
+HEADER = 'header'
+FIELD_SOURCES = (QUERY, HEADER)
+
+
+def with_source(field, source):
+    """Return field (a name or a list of them) read from source instead."""
+    if field is None or source is None:
+        return field
+    if source not in FIELD_SOURCES:
+        raise ImproperlyConfigured(
+            'field_source must be one of %s, not %r.' % (
+                ', '.join(FIELD_SOURCES), source))
+    if isinstance(field, (list, tuple)):
+        return ['%s:%s' % (source, f) for f in field]
+    return '%s:%s' % (source, field)
+
+
+def field_source(field):
+    """Return the (source, name) of a field; source is None for the body."""
+    source, sep, name = field.partition(':')
+    if sep and source in FIELD_SOURCES:
+        return source, name
+    return None, field
+
+
+def field_value(request, field):
+    """Return the value of one of the fields a request is limited by."""
+    source, name = field_source(field)
+    if source == QUERY:
+        return request.GET.get(name)
+    if source == HEADER:
+        return request.META.get('HTTP_' + name.upper().replace('-', '_'))
+    return getattr(request, request.method).get(name)
+
+
+# How many (address, prefixes) pairs IPPrefixes remembers the networks of.
+MAX_PARSED_ADDRESSES = 10000
+
+
+class IPPrefixes(object):
+    """Count addresses under their IPv4 and IPv6 networks.
+
+    Passed to backends as ``ip`` instead of True. Addresses of a version
+    without a prefix length, and anything that isn't an address, are
+    counted as they are. With ``exact``, the address is counted as well
+    as its network.
+    """
+
+    def __init__(self, v4=None, v6=None, exact=False):
+        if ipaddress is None:
+            raise ImproperlyConfigured(
+                'ip_prefix_v4 and ip_prefix_v6 require the ipaddress '
+                'package on Python 2.')
+        for name, bits, most in (
+                ('ip_prefix_v4', v4, 32), ('ip_prefix_v6', v6, 128)):
+            if bits is not None and not 0 <= bits <= most:
+                raise ImproperlyConfigured(
+                    '%s must be between 0 and %d, not %r.' % (
+                        name, most, bits))
+        self.v4 = v4
+        self.v6 = v6
+        self.exact = exact
+
+    def _key(self):
+        return (self.v4, self.v6, self.exact)
+
+    def __eq__(self, other):
+        return isinstance(other, IPPrefixes) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return 'IPPrefixes(v4=%r, v6=%r, exact=%r)' % self._key()
+
+    def addresses(self, address):
+        """Return what to count the address under, e.g. '10.0.0.0/24'."""
+        return _networks(address, self.v4, self.v6, self.exact)
+
+
+@lru_cache(maxsize=MAX_PARSED_ADDRESSES)
+def _networks(address, v4, v6, exact):
+    try:
+        parsed = ipaddress.ip_address(u'%s' % address)
+    except ValueError:
+        return (address,)
+    if parsed.version == 6 and parsed.ipv4_mapped is not None:
+        # ::ffff:10.0.0.1 is an IPv4 client on a dual-stack socket.
+        parsed = parsed.ipv4_mapped
+    bits = v4 if parsed.version == 4 else v6
+    if bits is None or bits == parsed.max_prefixlen:
+        return (address,)
+    network = ipaddress.ip_network(
+        u'%s/%d' % (parsed, bits), strict=False).with_prefixlen
+    return (address, network) if exact else (network,)
+
+
+def with_prefixes(ip, v4=None, v6=None, exact=False):
+    """Return the ``ip`` to pass backends, aggregating by network if asked."""
+    if not ip or (v4 is None and v6 is None):
+        return ip
+    return IPPrefixes(v4, v6, exact)
+
+
+def record_quota(request, limit, remaining, reset):
+    """Remember what is left of a rate, for the RateLimit response headers.
+
+    Backends call this for every rate they check, with the number of
+    requests still allowed and the seconds until the rate resets. Only the
+    most constrained rate is kept, on ``request.ratelimit_quota``.
+    """
+    remaining = max(int(remaining), 0)
+    quota = getattr(request, 'ratelimit_quota', None)
+    if quota is None or (remaining, -reset) < (
+            quota['remaining'], -quota['reset']):
+        request.ratelimit_quota = {
+            'limit': limit, 'remaining': remaining, 'reset': reset}
+
+
 class BaseBackend(object):
-    """Backends should implement this interface."""
+    """Backends should implement this interface.
+
+    A single instance is created per process and shared by every request
+    and thread, so backends must not keep per-request state on ``self``.
+    """
+    def setup(self):
+        """Called once, right after the shared instance is created.
+
+        Override this for one-time work such as precompiling key templates
+        or opening connections. It runs again whenever a ``RATELIMIT_*``
+        setting changes and the backend is rebuilt.
+        """
+        pass
+
     def count(self, request, ip=True, field=None, period=60):
         raise NotImplementedError
 
     def limit(self, request, ip=True, field=None, count=5):
         raise NotImplementedError
+
+    def hit(self, func_name, request, ip=True, field=None, count=5,
+            period=60):
+        """Count this request and return the limits it was already over.
+
+        Backends that can do both in a single round trip should override
+        this; the default simply calls limit() and then count().
+        """
+        limits = self.limit(func_name, request, ip, field, count, period)
+        self.count(func_name, request, ip, field, period)
+        return limits
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        """Increment the counters for several (count, period) rates at once.
+
+        Only the period matters to most backends, and count may be None
+        when the caller doesn't know it (e.g. ``brake.utils.inc_counts``).
+        ``burst`` is the number of requests allowed to arrive at once; it
+        is ignored by backends that don't support bursting. ``amount`` is
+        the number of requests being counted.
+        """
+        for count, period in rates:
+            for _ in range(amount):
+                self.count(func_name, request, ip, field, period)
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Check several (count, period) rates at once."""
+        limits = []
+        for count, period in rates:
+            limits.extend(
+                self.limit(func_name, request, ip, field, count, period))
+        return limits
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Check and count several (count, period) rates at once.
+
+        Batching backends should override this (and the other ``*_many``
+        methods) so that stacked rates cost a single round trip.
+        """
+        limits = []
+        for count, period in rates:
+            limits.extend(
+                self.hit(func_name, request, ip, field, count, period))
+        return limits
+
+    def hit_buckets(self, request, buckets):
+        """Check and count a request against several buckets at once.
+
+        ``buckets`` is a list of (func_name, ip, field, rates, burst)
+        tuples; a list of limits is returned for each of them. Backends
+        that can check them all in one round trip should override this.
+        """
+        return [
+            self.hit_many(func_name, request, ip, field, rates, burst)
+            for func_name, ip, field, rates, burst in buckets
+        ]
+
+    def get_counts(self, func_name, periods, ips=(), fields=()):
+        """Return {(identity, period): count} for many identities at once.
+
+        Identities are ('ip', address) or (field, value) pairs, e.g.
+        ``('username', 'alice')``. Used by ``brake.inspection``.
+        """
+        raise NotImplementedError
+
+    def reset_counts(self, func_name, periods, ips=(), fields=()):
+        """Clear the counters of many identities; returns the keys deleted."""
+        raise NotImplementedError
+
+    def delete_keys(self, keys):
+        """Delete counters by the cache keys found in limit data."""
+        raise NotImplementedError
+
+    def acquire(self, func_name, request, ip=True, field=None,
+            max_concurrent=1):
+        """Take one of ``max_concurrent`` in-flight slots per identity.
+
+        Returns (leases, limits). The leases are handed to release() once
+        the request is done. If any identity had no free slot, no slot is
+        held and limits has limit data for those identities.
+        """
+        raise NotImplementedError
+
+    def release(self, leases):
+        """Give back the slots taken by acquire()."""
+        raise NotImplementedError
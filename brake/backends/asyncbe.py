@@ -0,0 +1,117 @@
+"""Backends with native coroutine methods, for ``async def`` views.
+
+They behave exactly like the backends they extend, so they can serve sync
+views too. Cache calls go through Django's async cache API (``aget_many``,
+``aset_many``, ``aincr``, ``aadd``); whether that avoids a thread depends on
+the cache backend, as Django's own backends still implement those methods
+with ``sync_to_async``.
+
+Requires Python 3.5 and Django 4.0 or later.
+"""
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from brake.backends import cachebe
+from brake.backends.cachebe import AtomicCacheBackend, CacheBackend
+
+
+class AsyncCacheBackend(CacheBackend):
+
+    async def _aget_counters(self, rate_keys, now):
+        values = await cachebe.cache.aget_many(
+            [key for key, _, _ in rate_keys])
+        return self._decode_counters(rate_keys, values, now)
+
+    async def _aset_counters(self, counters, now, amount=1):
+        updates = self._counter_updates(counters, now, amount)
+        for timeout, values in updates.items():
+            await cachebe.cache.aset_many(values, timeout=timeout)
+
+    async def acount_many(self, func_name, request, ip=True, field=None,
+            rates=(), burst=None, amount=1):
+        now = time.time()
+        rate_keys = self._rate_keys(func_name, request, ip, field, rates)
+        counters = await self._aget_counters(rate_keys, now)
+        await self._aset_counters(counters, now, amount)
+
+    async def ahit_many(self, func_name, request, ip=True, field=None,
+            rates=(), burst=None):
+        now = time.time()
+        counters = await self._aget_counters(
+            self._rate_keys(func_name, request, ip, field, rates), now)
+        await self._aset_counters(counters, now)
+        return self._limits(counters, request, field, now, 1)
+
+    async def alimit_many(self, func_name, request, ip=True, field=None,
+            rates=(), burst=None):
+        now = time.time()
+        counters = await self._aget_counters(
+            self._rate_keys(func_name, request, ip, field, rates), now)
+        return self._limits(counters, request, field, now)
+
+
+class AsyncAtomicCacheBackend(AtomicCacheBackend):
+
+    def setup(self):
+        super(AsyncAtomicCacheBackend, self).setup()
+        if self.sub_counters:
+            raise ImproperlyConfigured(
+                'RATELIMIT_SUB_COUNTERS is not supported by '
+                'AsyncAtomicCacheBackend.')
+
+    async def _aincr(self, key, timeout, amount=1):
+        while True:
+            try:
+                return await cachebe.cache.aincr(key, amount)
+            except ValueError:
+                if await cachebe.cache.aadd(key, amount, timeout=timeout):
+                    return amount
+
+    async def _aincr_many(self, rate_keys, now, amount=1):
+        counters = {}
+        for timeout, keys in self._incr_timeouts(rate_keys, now).items():
+            for key in keys:
+                counters[key] = await self._aincr(key, timeout, amount)
+        return counters
+
+    async def _aprevious_counts(self, func_name, request, ip, field, rates,
+            now):
+        current, previous = self._previous_keys(
+            func_name, request, ip, field, rates, now)
+        if not previous:
+            return {}
+
+        values = await cachebe.cache.aget_many(
+            [key for key, _, _ in previous])
+        return self._weigh_previous(current, previous, values, now)
+
+    async def acount_many(self, func_name, request, ip=True, field=None,
+            rates=(), burst=None, amount=1):
+        now = time.time()
+        await self._aincr_many(self._window_rate_keys(
+            func_name, request, ip, field, rates, now), now, amount)
+
+    async def ahit_many(self, func_name, request, ip=True, field=None,
+            rates=(), burst=None):
+        now = time.time()
+        previous = await self._aprevious_counts(
+            func_name, request, ip, field, rates, now)
+        rate_keys = self._window_rate_keys(
+            func_name, request, ip, field, rates, now)
+        counters = await self._aincr_many(rate_keys, now)
+        return self._window_limits(
+            rate_keys, dict((k, v - 1) for k, v in counters.items()),
+            previous, request, field, now, 1)
+
+    async def alimit_many(self, func_name, request, ip=True, field=None,
+            rates=(), burst=None):
+        now = time.time()
+        rate_keys, previous_keys = self._read_keys(
+            func_name, request, ip, field, rates, now)
+        counters = await cachebe.cache.aget_many(
+            [key for key, _, _ in rate_keys + previous_keys])
+        return self._window_limits(
+            rate_keys, counters,
+            self._weigh_previous(rate_keys, previous_keys, counters, now),
+            request, field, now)
@@ -0,0 +1,243 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from brake import metrics
+from brake.backends import BaseBackend
+from brake.backends.localbe import LocalCache
+from brake.signals import circuit_closed, circuit_opened
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+
+FAIL_OPEN = 'open'
+FALLBACK_LOCAL = 'local'
+FALLBACKS = (FAIL_OPEN, FALLBACK_LOCAL)
+
+
+class LocalLimiter(object):
+    """Fixed-window counters kept in this process only.
+
+    Used while the shared backend can't be reached, so limits hold per
+    process instead of across all of them.
+    """
+
+    def __init__(self, backend, max_entries):
+        # The shared backend is only used to build keys and limit data.
+        self.backend = backend
+        self.counters = LocalCache(max_entries)
+        self.lock = threading.Lock()
+
+    def hit_many(self, func_name, request, ip, field, rates, amount=1):
+        now = time.time()
+        rate_keys = self.backend._rate_keys(
+            func_name, request, ip, field, rates)
+        limits = []
+        with self.lock:
+            for key, count, period in rate_keys:
+                window = (key, int(now // period) * period)
+                current = self.counters.get(window, now) or 0
+                if amount:
+                    self.counters.set(
+                        window, current + amount, window[1] + period)
+                # Like the shared backend: over once count requests were
+                # counted before this one.
+                if count is not None and current >= count:
+                    limits.append(self.backend._limit_data(
+                        key, request, field, current + 1, period))
+
+        return limits
+
+
+class CircuitBreakerBackend(BaseBackend):
+    """Stop waiting for a shared backend that is failing or too slow.
+
+    Every call to the protected backend, ``RATELIMIT_BREAKER_BACKEND``, that
+    raises or (with ``RATELIMIT_BREAKER_TIMEOUT`` set) takes longer than
+    that many seconds is a failure. After ``RATELIMIT_BREAKER_FAILURES`` of
+    them in a row the circuit opens: for ``RATELIMIT_BREAKER_COOLDOWN``
+    seconds the backend isn't called at all. Then a single call is let
+    through to try it again, and the circuit closes if it succeeds.
+
+    While the circuit is open, requests are let through unlimited
+    (``RATELIMIT_BREAKER_FALLBACK = 'open'``, the default), or limited per
+    process by a ``LocalLimiter`` (``'local'``, which needs a
+    ``CacheBackend`` subclass to be protected).
+
+    A call can't be interrupted, so with a timeout it runs on one of
+    ``RATELIMIT_BREAKER_THREADS`` worker threads and is abandoned when it
+    takes too long. Setting timeouts on the cache client itself as well
+    keeps stuck calls from tying those threads up.
+    """
+
+    def setup(self):
+        # Imported here: brake.decorators loads this module by path.
+        from brake.decorators import get_class_by_path
+
+        self.backend = get_class_by_path(getattr(
+            settings,
+            'RATELIMIT_BREAKER_BACKEND',
+            'brake.backends.cachebe.CacheBackend'
+        ))()
+        self.backend.setup()
+
+        self.timeout = getattr(settings, 'RATELIMIT_BREAKER_TIMEOUT', None)
+        self.max_failures = getattr(settings, 'RATELIMIT_BREAKER_FAILURES', 5)
+        self.cooldown = getattr(settings, 'RATELIMIT_BREAKER_COOLDOWN', 30)
+        self.fallback = getattr(
+            settings, 'RATELIMIT_BREAKER_FALLBACK', FAIL_OPEN)
+        if self.fallback not in FALLBACKS:
+            raise ImproperlyConfigured(
+                'RATELIMIT_BREAKER_FALLBACK must be one of %s, not %r.' % (
+                    ', '.join(FALLBACKS), self.fallback))
+
+        self.local = None
+        if self.fallback == FALLBACK_LOCAL:
+            self.local = LocalLimiter(self.backend, getattr(
+                settings, 'RATELIMIT_LOCAL_MAX_ENTRIES', 10000))
+
+        self.executor = None
+        if self.timeout is not None:
+            if ThreadPoolExecutor is None:
+                raise ImproperlyConfigured(
+                    'RATELIMIT_BREAKER_TIMEOUT requires concurrent.futures.')
+            self.executor = ThreadPoolExecutor(
+                getattr(settings, 'RATELIMIT_BREAKER_THREADS', 10))
+
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def get_ip(self, request):
+        return self.backend.get_ip(request)
+
+    def get_counts(self, func_name, periods, ips=(), fields=()):
+        return self.backend.get_counts(func_name, periods, ips, fields)
+
+    def reset_counts(self, func_name, periods, ips=(), fields=()):
+        return self.backend.reset_counts(func_name, periods, ips, fields)
+
+    def delete_keys(self, keys):
+        return self.backend.delete_keys(keys)
+
+    def acquire(self, func_name, request, ip=True, field=None,
+            max_concurrent=1):
+        # Whatever the fallback, requests run without a slot while the
+        # circuit is open.
+        now = time.time()
+        if self._allow(now):
+            try:
+                result = self._run(self.backend.acquire,
+                    func_name, request, ip, field, max_concurrent)
+            except Exception:
+                self._failed(now)
+            else:
+                self._succeeded()
+                return result
+        return [], []
+
+    def release(self, leases):
+        if not leases:
+            return
+        try:
+            self._run(self.backend.release, leases)
+        except Exception:
+            # The slots expire on their own.
+            self._failed(time.time())
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def _allow(self, now):
+        """Return whether the protected backend may be called now."""
+        with self.lock:
+            if self.opened is None:
+                return True
+            if now - self.opened < self.cooldown:
+                return False
+            # Let this call try the backend again. Until it returns,
+            # everyone else keeps falling back.
+            self.opened = now
+            return True
+
+    def _failed(self, now):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.max_failures:
+                return
+            tripped = self.opened is None
+            self.opened = now
+
+        if tripped:
+            metrics.breaker(metrics.BREAKER_TRIPS, self.backend)
+            circuit_opened.send(sender=self.backend.__class__)
+
+    def _succeeded(self):
+        if not self.failures and self.opened is None:
+            return
+
+        with self.lock:
+            self.failures = 0
+            recovered = self.opened is not None
+            self.opened = None
+
+        if recovered:
+            metrics.breaker(metrics.BREAKER_RECOVERIES, self.backend)
+            circuit_closed.send(sender=self.backend.__class__)
+
+    def _run(self, method, *args):
+        if self.executor is None:
+            return method(*args)
+        return self.executor.submit(method, *args).result(self.timeout)
+
+    def _call(self, name, args, amount):
+        now = time.time()
+        if self._allow(now):
+            try:
+                result = self._run(getattr(self.backend, name), *args)
+            except Exception:
+                # Cache clients raise all sorts of errors when their
+                # server is unwell; none of them should break the view.
+                self._failed(now)
+            else:
+                self._succeeded()
+                return result
+
+        if self.local is None:
+            return []
+        func_name, request, ip, field, rates = args[:5]
+        return self.local.hit_many(
+            func_name, request, ip, field, rates, amount)
+
+    def count(self, func_name, request, ip=True, field=None, period=60):
+        self.count_many(func_name, request, ip, field, [(None, period)])
+
+    def hit(self, func_name, request, ip=True, field=None, count=5,
+            period=60):
+        return self.hit_many(func_name, request, ip, field, [(count, period)])
+
+    def limit(self, func_name, request, ip=True, field=None, count=5,
+            period=None):
+        return self.limit_many(
+            func_name, request, ip, field, [(count, period)])
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        self._call('count_many',
+            (func_name, request, ip, field, rates, burst, amount), amount)
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        return self._call(
+            'hit_many', (func_name, request, ip, field, rates, burst), 1)
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        return self._call(
+            'limit_many', (func_name, request, ip, field, rates, burst), 0)
@@ -1,20 +1,148 @@
 import hashlib
+import numbers
+import random
 import time
+import uuid
 
-from django.core.cache import cache
+from django.conf import settings
+from django.core.cache import cache as default_cache
 from django.core.cache.backends.base import BaseCache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import LazyObject, empty
 
-from brake.backends import BaseBackend
+from brake.backends import (
+    BaseBackend, IPPrefixes, field_value, record_quota)
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed
 
 
 CACHE_PREFIX = 'rl:'
 IP_PREFIX = 'ip:'
 KEY_TEMPLATE = 'func:%s:%s%s:%s%s'
 PERIOD_PREFIX = 'period:'
+WINDOW_PREFIX = 'window:'
+SUB_COUNTER_TEMPLATE = ':sub:%d'
+CONCURRENT_PREFIX = 'concurrent:'
+SLOT_TEMPLATE = ':slot:%d'
+# Concurrency limited by neither IP nor field is capped for everyone at once.
+GLOBAL_IDENTITY = ('all', '')
+
+# CacheBackend stores each counter as one integer: a version tag, the
+# expiration in whole seconds and the count. That is smaller than a pickled
+# (count, expiration) tuple, cheaper to (de)serialize, and a cache can add
+# to the count in place with incr().
+COUNTER_VERSION = 1
+COUNT_BITS = 24
+EXPIRATION_BITS = 32
+VERSION_SHIFT = COUNT_BITS + EXPIRATION_BITS
+MAX_COUNT = (1 << COUNT_BITS) - 1
+EXPIRATION_MASK = (1 << EXPIRATION_BITS) - 1
+
+PACKED = 'packed'
+LEGACY = 'legacy'
+ENCODINGS = (PACKED, LEGACY)
+
+FIXED_WINDOW = 'fixed-window'
+SLIDING_WINDOW = 'sliding-window'
+ALGORITHMS = (FIXED_WINDOW, SLIDING_WINDOW)
+
+
+FIELD_HASHES = {
+    'sha1': hashlib.sha1,
+    # Not available before Python 3.6.
+    'blake2b': lambda value: hashlib.blake2b(value, digest_size=16),
+}
+
+# Key prefixes are remembered per (func_name, period); views limited by
+# request path can have any number of those, so the memo is bounded.
+MAX_PREFIXES = 10000
+
+
+class _CacheProxy(LazyObject):
+    """The cache counters are kept in.
+
+    That is Django's default cache, or the caches named in
+    ``RATELIMIT_CACHE_ALIASES`` with keys spread over them.
+    """
+
+    def _setup(self):
+        aliases = getattr(settings, 'RATELIMIT_CACHE_ALIASES', None)
+        if aliases:
+            from brake.backends.sharding import ShardedCache
+            self._wrapped = ShardedCache(
+                aliases, getattr(settings, 'RATELIMIT_CACHE_THREADS', None))
+        else:
+            self._wrapped = default_cache
+
+
+cache = _CacheProxy()
+
+
+def _reset_cache(setting, **kwargs):
+    if setting in ('RATELIMIT_CACHE_ALIASES', 'RATELIMIT_CACHE_THREADS'):
+        cache._wrapped = empty
+
+setting_changed.connect(_reset_cache)
 
 
 class CacheBackend(BaseBackend):
 
+    key_prefix = CACHE_PREFIX
+    # The values of RATELIMIT_ALGORITHM this backend counts with.
+    algorithms = (FIXED_WINDOW,)
+    # Counters are created at 2, one more than the requests counted.
+    counter_offset = 1
+    field_hash = 'sha1'
+    previous_field_hash = None
+    encoding = PACKED
+    lease_timeout = 300
+    sample_above = None
+    sample_rate = 0.01
+    exact_fraction = 0.8
+
+    def __init__(self):
+        self._prefixes = {}
+
+    def setup(self):
+        algorithm = getattr(settings, 'RATELIMIT_ALGORITHM', FIXED_WINDOW)
+        if algorithm not in self.algorithms:
+            raise ImproperlyConfigured(
+                'RATELIMIT_ALGORITHM must be one of %s for %s, not %r.' % (
+                    ', '.join(self.algorithms), self.__class__.__name__,
+                    algorithm))
+
+        self.field_hash = getattr(settings, 'RATELIMIT_FIELD_HASH', 'sha1')
+        self.previous_field_hash = getattr(
+            settings, 'RATELIMIT_PREVIOUS_FIELD_HASH', None)
+        for name in (self.field_hash, self.previous_field_hash):
+            if name is not None and name not in FIELD_HASHES:
+                raise ImproperlyConfigured(
+                    'RATELIMIT_FIELD_HASH must be one of %s, not %r.' % (
+                        ', '.join(sorted(FIELD_HASHES)), name))
+        if self.previous_field_hash == self.field_hash:
+            self.previous_field_hash = None
+
+        self.encoding = getattr(settings, 'RATELIMIT_COUNTER_ENCODING', PACKED)
+        if self.encoding not in ENCODINGS:
+            raise ImproperlyConfigured(
+                'RATELIMIT_COUNTER_ENCODING must be one of %s, not %r.' % (
+                    ', '.join(ENCODINGS), self.encoding))
+        self.lease_timeout = getattr(settings, 'RATELIMIT_LEASE_TIMEOUT', 300)
+
+        self.sample_above = getattr(settings, 'RATELIMIT_SAMPLE_ABOVE', None)
+        self.sample_rate = getattr(settings, 'RATELIMIT_SAMPLE_RATE', 0.01)
+        self.exact_fraction = getattr(
+            settings, 'RATELIMIT_SAMPLE_EXACT_FRACTION', 0.8)
+        if not 0 < self.sample_rate <= 1:
+            raise ImproperlyConfigured(
+                'RATELIMIT_SAMPLE_RATE must be between 0 and 1.')
+        if not 0 <= self.exact_fraction <= 1:
+            raise ImproperlyConfigured(
+                'RATELIMIT_SAMPLE_EXACT_FRACTION must be between 0 and 1.')
+
     def get_ip(self, request):
         """This gets the IP we wish to use for ratelimiting.
 
@@ -24,71 +152,732 @@ class CacheBackend(BaseBackend):
         """
         return request.META['REMOTE_ADDR']
 
+    def _fields(self, request, field):
+        """Return the (field, value) pairs of the request to limit by."""
+        if field is None:
+            return ()
+        if not isinstance(field, (list, tuple)):
+            field = [field]
+        return tuple((f, field_value(request, f)) for f in field)
+
+    def _identities(self, request, ip=True, field=None, fields=None):
+        """Return the (prefix, value) pairs that end each of the keys.
+
+        These don't depend on the period, so they are worked out once per
+        request no matter how many rates are checked.
+        """
+        identities = []
+        if isinstance(ip, IPPrefixes):
+            for address in ip.addresses(self.get_ip(request)):
+                identities.append((IP_PREFIX, address))
+        elif ip:
+            identities.append((IP_PREFIX, self.get_ip(request)))
+
+        if fields is None:
+            fields = self._fields(request, field)
+        hashes = [FIELD_HASHES[self.field_hash]]
+        if self.previous_field_hash is not None:
+            # While migrating, keep the counters under the old digest
+            # going as well, so neither set starts from scratch.
+            hashes.append(FIELD_HASHES[self.previous_field_hash])
+        for f, val in fields:
+            # Convert value to hexdigest as cache backend doesn't allow
+            # certain characters
+            if val:
+                val = val.encode('utf-8')
+                for digest in hashes:
+                    identities.append(
+                        ('field:%s:' % f, digest(val).hexdigest()))
+
+        return identities
+
+    def _prefixes_for(self, func_name, rates):
+        """Return a (key prefix, count, period) triple per rate of a view.
+
+        ``rates`` must be a tuple. Prefixes are formatted once per process
+        and view rather than on every request.
+        """
+        prefixes = self._prefixes.get((func_name, rates))
+        if prefixes is None:
+            if len(self._prefixes) >= MAX_PREFIXES:
+                self._prefixes.clear()
+            prefixes = self._prefixes[func_name, rates] = [
+                (self.key_prefix + KEY_TEMPLATE % (
+                    func_name, PERIOD_PREFIX, period, '', ''
+                ), count, period)
+                for count, period in rates
+            ]
+        return prefixes
+
+    def _rate_keys(self, func_name, request, ip=True, field=None, rates=()):
+        """Return a (cache_key, count, period) triple per rate and identity."""
+        identities = self._identities(request, ip, field)
+        return [
+            (prefix + name + value, count, period)
+            for prefix, count, period in self._prefixes_for(
+                func_name, tuple(rates))
+            for name, value in identities
+        ]
+
     def _keys(self, func_name, request, ip=True, field=None, period=None):
-        keys = []
-        if ip:
-            keys.append(KEY_TEMPLATE % (
-                func_name, PERIOD_PREFIX, period,
-                IP_PREFIX, self.get_ip(request)
-            ))
-
-        if field is not None:
-            if not isinstance(field, (list, tuple)):
-                field = [field]
-            for f in field:
-                val = getattr(request, request.method).get(f)
-                # Convert value to hexdigest as cache backend doesn't allow
-                # certain characters
-                if val:
-                    val = hashlib.sha1(val.encode('utf-8')).hexdigest()
-                    keys.append('func:%s:%s%s:field:%s:%s' % (
-                        func_name, PERIOD_PREFIX, period, f, val
-                    ))
+        return [
+            key for key, _, _ in self._rate_keys(
+                func_name, request, ip, field, [(None, period)])
+        ]
+
+    def _limit_data(self, counter, request, field, current_count, period):
+        ratelimited_by = 'field'
+        if ':ip:' in counter:
+            ratelimited_by = 'ip'
+
+        return {
+            'ratelimited_by': ratelimited_by,
+            'period': period,
+            'field': field,
+            'count': current_count,
+            'cache_key': counter,
+            'ip': self.get_ip(request)
+        }
+
+    def _get_counters(self, rate_keys, now):
+        """Read every counter with a single ``get_many``."""
+        return self._decode_counters(
+            rate_keys, cache.get_many([key for key, _, _ in rate_keys]), now)
+
+    def _encode(self, count, expiration):
+        """Return the value to store for a counter."""
+        if self.encoding == LEGACY:
+            return (count, expiration)
+
+        return (COUNTER_VERSION << VERSION_SHIFT |
+            int(expiration) << COUNT_BITS | min(count, MAX_COUNT))
+
+    def _decode(self, value, period, now):
+        """Return the (count, expiration) of a stored counter value.
 
+        Every format there has been is understood: packed integers,
+        (count, expiration) tuples and, from before 1.4.1, bare counts.
+        The count is None for counters not yet created, and for values
+        that aren't counters at all, which are then overwritten.
+        """
+        if isinstance(value, tuple) and len(value) == 2:
+            return value
+        if not isinstance(value, numbers.Integral) or \
+                isinstance(value, bool) or value < 0:
+            return None, now + period
+        version = value >> VERSION_SHIFT
+        if version == COUNTER_VERSION:
+            return (value & MAX_COUNT,
+                value >> COUNT_BITS & EXPIRATION_MASK)
+        if version == 0:
+            return value, now + period
+        return None, now + period
+
+    def _decode_counters(self, rate_keys, values, now):
+        """Pair up rate keys with the values read for them.
+
+        Returns (cache_key, count, period, current_count, expiration)
+        tuples, where current_count is None for counters not yet created.
+        """
         return [
-            CACHE_PREFIX + k for k in keys
+            (key, count, period) + self._decode(values.get(key), period, now)
+            for key, count, period in rate_keys
         ]
 
+    def _sampled(self, count, current_count):
+        """Whether to only sometimes write a counter, and weigh it up.
+
+        Only counters of rates of at least ``RATELIMIT_SAMPLE_ABOVE``
+        requests are sampled, and only while they are below
+        ``RATELIMIT_SAMPLE_EXACT_FRACTION`` of their count, so that they
+        are exact where limiting is decided.
+        """
+        return self.sample_above is not None and count is not None and \
+            count >= self.sample_above and \
+            (current_count or 0) < self.exact_fraction * count
+
+    def _counter_updates(self, counters, now, amount=1):
+        """Return the incremented counters, grouped by their TTL.
+
+        Sampled counters are each written with probability
+        ``RATELIMIT_SAMPLE_RATE`` and then incremented by ``amount`` over
+        it, which is right on average.
+        """
+        updates = {}
+        for key, count, _, current_count, expiration in counters:
+            step = amount
+            if self._sampled(count, current_count):
+                if random.random() >= self.sample_rate:
+                    continue
+                # Rounded at random, so the steps stay right on average.
+                step = int(amount / self.sample_rate + random.random())
+            if current_count is None:
+                current_count = 1
+            updates.setdefault(int(expiration - now), {})[key] = (
+                self._encode(current_count + step, expiration))
+
+        return updates
+
+    def _set_counters(self, counters, now, amount=1):
+        """Write back incremented counters, one set_many per distinct TTL."""
+        updates = self._counter_updates(counters, now, amount)
+        for timeout, values in updates.items():
+            cache.set_many(values, timeout=timeout)
+
+    def _limits(self, counters, request, field, now, amount=0):
+        """Return limit data for the counters that are over their count.
+
+        Counters hold the requests counted before this one, so a rate is
+        over once ``count`` of them were seen. What each rate has left once
+        ``amount`` more requests are counted is recorded for the response
+        headers, along with its ``reset``.
+        """
+        limits = []
+        for key, count, period, current_count, expiration in counters:
+            reset = max(expiration - now, 0)
+            seen = 0 if current_count is None else \
+                current_count - self.counter_offset
+            record_quota(request, count, count - seen - amount, reset)
+            if current_count is not None and seen >= count:
+                limit = self._limit_data(
+                    key, request, field, seen + 1, period)
+                limit['reset'] = reset
+                limits.append(limit)
+
+        return limits
+
     def count(self, func_name, request, ip=True, field=None, period=60):
         """Increment counters for all relevant cache_keys given a request."""
-        counters = dict((key, (1, time.time() + period)) for key in self._keys(
-            func_name, request, ip, field, period))
-        counters.update(cache.get_many(counters.keys()))
-        for key, value in counters.items():
-            # Handle old values.
-            if isinstance(value, tuple):
-                count, expiration = value
-            else:
-                count = value
-                expiration = time.time() + period
-            count += 1
-            cache.set(key, (count, expiration), timeout=int(expiration - time.time()))
+        self.count_many(func_name, request, ip, field, [(None, period)])
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        """Increment counters for every period with one read and write."""
+        self._count_keys(
+            self._rate_keys(func_name, request, ip, field, rates),
+            time.time(), amount)
+
+    def _count_keys(self, rate_keys, now, amount=1):
+        """Like count_many(), for rate keys that were already built."""
+        self._set_counters(self._get_counters(rate_keys, now), now, amount)
+
+    def hit(self, func_name, request,
+            ip=True, field=None, count=5, period=60):
+        """Increment counters and return limit data in one pass.
+
+        Counters are read with a single ``get_many`` and written back with
+        one ``set_many`` per distinct remaining TTL (usually just one).
+        """
+        return self.hit_many(func_name, request, ip, field, [(count, period)])
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Like hit(), for several (count, period) rates at once."""
+        now = time.time()
+        counters = self._get_counters(
+            self._rate_keys(func_name, request, ip, field, rates), now)
+        self._set_counters(counters, now)
+        return self._limits(counters, request, field, now, 1)
 
     def limit(self, func_name, request,
             ip=True, field=None, count=5, period=None):
         """Return limit data about any keys relevant for requst."""
-        counters = cache.get_many(
-            self._keys(func_name, request, ip, field, period)
+        return self.limit_many(
+            func_name, request, ip, field, [(count, period)])
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Like limit(), for several (count, period) rates at once."""
+        now = time.time()
+        counters = self._get_counters(
+            self._rate_keys(func_name, request, ip, field, rates), now)
+        return self._limits(counters, request, field, now)
+
+    def _bucket_rate_keys(self, request, buckets, rate_keys):
+        """Return the rate keys of every bucket, and where each one ends.
+
+        ``rate_keys`` builds the keys of a single bucket from its
+        (func_name, request, ip, field, rates) arguments.
+        """
+        all_keys = []
+        ends = []
+        for func_name, ip, field, rates, _ in buckets:
+            all_keys.extend(rate_keys(func_name, request, ip, field, rates))
+            ends.append(len(all_keys))
+        return all_keys, ends
+
+    def _split(self, buckets, ends, items):
+        """Pair each bucket's field with its slice of items."""
+        start = 0
+        for (_, _, field, _, _), end in zip(buckets, ends):
+            yield field, items[start:end]
+            start = end
+
+    def hit_buckets(self, request, buckets):
+        """Like hit_many(), for every bucket with one read and write."""
+        now = time.time()
+        rate_keys, ends = self._bucket_rate_keys(
+            request, buckets, self._rate_keys)
+        counters = self._get_counters(rate_keys, now)
+        self._set_counters(counters, now)
+        return [
+            self._limits(bucket_counters, request, field, now, 1)
+            for field, bucket_counters in self._split(buckets, ends, counters)
+        ]
+
+    def _inspection_keys(self, func_name, periods, ips=(), fields=(),
+            previous_hash=False):
+        """Return an (identity, period, cache_key) triple per counter.
+
+        Identities are ('ip', address) or (field, value) pairs. With
+        ``previous_hash`` the keys under ``RATELIMIT_PREVIOUS_FIELD_HASH``
+        are included as well.
+        """
+        hashes = [FIELD_HASHES[self.field_hash]]
+        if previous_hash and self.previous_field_hash is not None:
+            hashes.append(FIELD_HASHES[self.previous_field_hash])
+        identities = [(('ip', ip), IP_PREFIX + ip) for ip in ips]
+        for f, val in fields:
+            for digest in hashes:
+                identities.append(((f, val), 'field:%s:%s' % (
+                    f, digest(val.encode('utf-8')).hexdigest())))
+
+        return [
+            (identity, period, prefix + suffix)
+            for prefix, _, period in self._prefixes_for(
+                func_name, tuple((None, period) for period in periods))
+            for identity, suffix in identities
+        ]
+
+    def _read_counts(self, keys, now):
+        """Return the count of each (cache_key, period) that exists."""
+        values = cache.get_many([key for key, _ in keys])
+        return dict(
+            (key, self._decode(values[key], period, now)[0])
+            for key, period in keys if key in values
         )
 
+    def _stored_keys(self, keys, now):
+        """Return the cache keys holding the given (cache_key, period)s."""
+        return [key for key, _ in keys]
+
+    def get_counts(self, func_name, periods, ips=(), fields=()):
+        """Return {(identity, period): count} for many identities at once.
+
+        Identities are ('ip', address) or (field, value) pairs; only those
+        with a counter are included. Every counter is read with a single
+        ``get_many``.
+        """
+        keys = self._inspection_keys(func_name, periods, ips, fields)
+        counts = self._read_counts(
+            [(key, period) for _, period, key in keys], time.time())
+        return dict(
+            ((identity, period), counts[key])
+            for identity, period, key in keys if key in counts
+        )
+
+    def reset_counts(self, func_name, periods, ips=(), fields=()):
+        """Clear the counters of many identities with one ``delete_many``.
+
+        Returns the cache keys deleted.
+        """
+        keys = self._inspection_keys(
+            func_name, periods, ips, fields, previous_hash=True)
+        return self.delete_keys(self._stored_keys(
+            [(key, period) for _, period, key in keys], time.time()))
+
+    def delete_keys(self, keys):
+        """Delete counters by their cache keys, e.g. from limit data."""
+        keys = list(keys)
+        if keys:
+            cache.delete_many(keys)
+        return keys
+
+
+    def _slot_keys(self, func_name, request, ip, field, max_concurrent):
+        """Return (key, slot keys) for each identity limited by."""
+        if not ip and field is None:
+            identities = [GLOBAL_IDENTITY]
+        else:
+            identities = self._identities(request, ip, field)
+        prefix = CACHE_PREFIX + KEY_TEMPLATE % (
+            func_name, CONCURRENT_PREFIX, max_concurrent, '', '')
+        return [
+            (prefix + name + value, [
+                prefix + name + value + SLOT_TEMPLATE % i
+                for i in range(max_concurrent)
+            ])
+            for name, value in identities
+        ]
+
+    def _get_slots(self, keys):
+        """Return {slot key: lease token} for the slots that are taken."""
+        return cache.get_many(keys)
+
+    def _add_slot(self, key, token, timeout):
+        """Take a slot unless it is taken already; returns whether it was."""
+        return cache.add(key, token, timeout)
+
+    def _delete_slots(self, keys):
+        cache.delete_many(keys)
+
+    def acquire(self, func_name, request, ip=True, field=None,
+            max_concurrent=1):
+        """Take a free slot per identity, each a cache entry of its own.
+
+        Slots are read with one ``get_many`` and taken with ``add()``, so
+        two requests can't take the same one. Each expires after
+        ``RATELIMIT_LEASE_TIMEOUT`` seconds, which frees the slots of
+        workers that died before releasing them.
+        """
+        slot_keys = self._slot_keys(
+            func_name, request, ip, field, max_concurrent)
+        taken = self._get_slots(
+            [slot for _, slots in slot_keys for slot in slots])
+        token = uuid.uuid4().hex
+        leases = []
+        limits = []
+        for key, slots in slot_keys:
+            free = [slot for slot in slots if slot not in taken]
+            # Requests arriving together would otherwise race for the same
+            # slot.
+            random.shuffle(free)
+            for slot in free:
+                if self._add_slot(slot, token, self.lease_timeout):
+                    leases.append((slot, token))
+                    break
+            else:
+                limit = self._limit_data(
+                    key, request, field, max_concurrent, None)
+                if not ip and field is None:
+                    limit['ratelimited_by'] = GLOBAL_IDENTITY[0]
+                limit['max_concurrent'] = max_concurrent
+                # Slots free up as requests finish, not when a period ends.
+                limit['retry_after'] = 1
+                limits.append(limit)
+
+        if limits:
+            self.release(leases)
+            return [], limits
+        return leases, []
+
+    def release(self, leases):
+        if not leases:
+            return
+        held = self._get_slots([slot for slot, _ in leases])
+        # A slot that outlived its lease may have been taken again since.
+        self._delete_slots([
+            slot for slot, token in leases if held.get(slot) == token])
+
+
+class AtomicCacheBackend(CacheBackend):
+    """Count with ``cache.incr`` so concurrent workers never lose updates.
+
+    Counters are stored as plain integers and the start of the window they
+    belong to is appended to the key, so the expiration no longer has to be
+    kept next to the count and read back before every write. Caches that
+    provide an ``incr_many`` method get all of a request's counters for a
+    period incremented in a single call.
+
+    ``RATELIMIT_ALGORITHM`` picks how windows are counted:
+
+    - ``'fixed-window'`` (the default) only looks at the current window, so
+      up to twice the rate can get through around a window boundary.
+    - ``'sliding-window'`` also reads the previous window and weights it by
+      how much of it still overlaps the last ``period`` seconds. That costs
+      one ``get_many`` per request next to the increments.
+    """
+
+    algorithms = ALGORITHMS
+    algorithm = FIXED_WINDOW
+    sub_counters = ()
+
+    def setup(self):
+        super(AtomicCacheBackend, self).setup()
+        self.algorithm = getattr(
+            settings, 'RATELIMIT_ALGORITHM', FIXED_WINDOW)
+        self.sub_counters = [
+            ('%sfunc:%s:%s' % (CACHE_PREFIX, func_name, PERIOD_PREFIX), splits)
+            for func_name, splits in getattr(
+                settings, 'RATELIMIT_SUB_COUNTERS', {}).items()
+            if splits > 1
+        ]
+
+    def _sub_keys(self, key):
+        """Return the keys a counter is kept in: itself unless it is split."""
+        for prefix, splits in self.sub_counters:
+            if key.startswith(prefix):
+                return [key + SUB_COUNTER_TEMPLATE % i for i in range(splits)]
+        return [key]
+
+    def _get_windows(self, keys):
+        """Like cache.get_many(), summing the sub-counters of split keys."""
+        if not self.sub_counters:
+            return cache.get_many(keys)
+
+        sub_keys = [(key, self._sub_keys(key)) for key in keys]
+        values = cache.get_many([sub for _, subs in sub_keys for sub in subs])
+        counters = {}
+        for key, subs in sub_keys:
+            found = [values[sub] for sub in subs if sub in values]
+            if found:
+                counters[key] = sum(found)
+        return counters
+
+    def _window(self, period, now=None):
+        if now is None:
+            now = time.time()
+        return int(now // period) * period
+
+    def _window_rate_keys(self, func_name, request, ip, field, rates, now,
+            previous=False):
+        """Like _rate_keys(), with the window start appended to each key.
+
+        With ``previous`` the keys of the window before the current one are
+        returned, in the same order.
+        """
+        return [
+            (self._window_key(key, period, now, previous), count, period)
+            for key, count, period in self._rate_keys(
+                func_name, request, ip, field, rates)
+        ]
+
+    def _window_key(self, key, period, now, previous=False):
+        return key + ':%s%d' % (
+            WINDOW_PREFIX,
+            self._window(period, now) - (period if previous else 0))
+
+    def _window_keys(self, func_name, request, ip=True, field=None,
+            period=60, now=None):
+        return [
+            key for key, _, _ in self._window_rate_keys(
+                func_name, request, ip, field, [(None, period)], now)
+        ]
+
+    def _previous_keys(self, func_name, request, ip, field, rates, now):
+        """Return (current, previous) window rate keys, in the same order.
+
+        Both are empty with the fixed window algorithm.
+        """
+        if self.algorithm != SLIDING_WINDOW:
+            return [], []
+
+        return (
+            self._window_rate_keys(func_name, request, ip, field, rates, now),
+            self._window_rate_keys(
+                func_name, request, ip, field, rates, now, previous=True)
+        )
+
+    def _read_keys(self, func_name, request, ip, field, rates, now):
+        """Return the (current, previous) window rate keys to read.
+
+        They are read together, with a single ``get_many``; previous is
+        empty with the fixed window algorithm.
+        """
+        current, previous = self._previous_keys(
+            func_name, request, ip, field, rates, now)
+        if not current:
+            current = self._window_rate_keys(
+                func_name, request, ip, field, rates, now)
+        return current, previous
+
+    def _previous_counts(self, func_name, request, ip, field, rates, now):
+        """Return the weighted previous-window count for each current key.
+
+        Always empty with the fixed window algorithm.
+        """
+        current, previous = self._previous_keys(
+            func_name, request, ip, field, rates, now)
+        if not previous:
+            return {}
+
+        return self._weigh_previous(
+            current, previous,
+            self._get_windows([key for key, _, _ in previous]), now)
+
+    def _weigh_previous(self, current, previous, values, now):
+        counts = {}
+        for (key, _, period), (previous_key, _, _) in zip(current, previous):
+            if previous_key in values:
+                overlap = 1 - (now - self._window(period, now)) / float(period)
+                counts[key] = values[previous_key] * overlap
+
+        return counts
+
+    def _incr(self, key, timeout, amount=1):
+        while True:
+            try:
+                return cache.incr(key, amount)
+            except ValueError:
+                # First hit in this window. Only one writer wins the add(),
+                # everybody else goes back to incr().
+                if cache.add(key, amount, timeout=timeout):
+                    return amount
+
+    def _incr_timeouts(self, rate_keys, now):
+        """Group the distinct keys by the timeout they get when created."""
+        by_timeout = {}
+        for key, _, period in rate_keys:
+            # Keep the key around a little past the end of its window so
+            # that clocks which are slightly off between hosts still agree
+            # on it, and for a whole extra window when it will be read as
+            # the previous window.
+            timeout = int(self._window(period, now) + period - now) + 1
+            if self.algorithm == SLIDING_WINDOW:
+                timeout += period
+            by_timeout.setdefault(timeout, set()).add(key)
+
+        return by_timeout
+
+    def _incr_many(self, rate_keys, now, amount=1):
+        """Increment every key by amount and return the new values.
+
+        Of a split counter, one sub-counter picked at random is incremented
+        and the others are read with a single get_many, to sum them up.
+        """
+        if not self.sub_counters:
+            return self._incr_keys(rate_keys, now, amount)
+
+        picked = {}
+        others = {}
+        for key, _, _ in rate_keys:
+            subs = self._sub_keys(key)
+            picked[key] = random.choice(subs)
+            others[key] = [sub for sub in subs if sub != picked[key]]
+        counters = self._incr_keys(
+            [(picked[key], count, period) for key, count, period in rate_keys],
+            now, amount)
+        values = cache.get_many(
+            [sub for subs in others.values() for sub in subs])
+        return dict(
+            (key, counters[picked[key]] + sum(
+                values.get(sub, 0) for sub in others[key]))
+            for key in picked
+        )
+
+    def _incr_keys(self, rate_keys, now, amount=1):
+        incr_many = getattr(cache, 'incr_many', None)
+        counters = {}
+        for timeout, keys in self._incr_timeouts(rate_keys, now).items():
+            if incr_many is not None:
+                counters.update(
+                    incr_many(list(keys), timeout=timeout, delta=amount))
+            else:
+                for key in keys:
+                    counters[key] = self._incr(key, timeout, amount)
+
+        return counters
+
+    def _window_limits(self, rate_keys, counters, previous, request, field,
+            now, amount=0):
+        """Like CacheBackend._limits(), for windowed counters.
+
+        ``counters`` hold the counts from before this request, so it is over
+        a rate once ``count`` requests have been counted already.
+        """
         limits = []
-        for counter in counters:
-            ratelimited_by = 'field'
-            if ':ip:' in counter:
-                ratelimited_by = 'ip'
-
-            current_count = counters[counter]
-            if isinstance(current_count, tuple):
-                current_count = current_count[0]
-
-            if current_count > count:
-                limits.append({
-                    'ratelimited_by': ratelimited_by,
-                    'period': period,
-                    'field': field,
-                    'count': current_count,
-                    'cache_key': counter,
-                    'ip': self.get_ip(request)
-                })
+        for key, count, period in rate_keys:
+            current_count = counters.get(key, 0) + previous.get(key, 0)
+            reset = self._window(period, now) + period - now
+            record_quota(request, count, count - current_count - amount, reset)
+            if current_count >= count:
+                limit = self._limit_data(
+                    key, request, field, int(current_count) + 1, period)
+                limit['reset'] = reset
+                limits.append(limit)
 
         return limits
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        """Atomically increment counters for every period."""
+        self._count_keys(
+            self._rate_keys(func_name, request, ip, field, rates),
+            time.time(), amount)
+
+    def _count_keys(self, rate_keys, now, amount=1):
+        self._incr_many([
+            (self._window_key(key, period, now), count, period)
+            for key, count, period in rate_keys
+        ], now, amount)
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Atomically increment counters and return limit data."""
+        now = time.time()
+        previous = self._previous_counts(
+            func_name, request, ip, field, rates, now)
+        rate_keys = self._window_rate_keys(
+            func_name, request, ip, field, rates, now)
+        counters = self._incr_many(rate_keys, now)
+
+        # Compare the count as it was before this request, like limit().
+        return self._window_limits(
+            rate_keys, dict((k, v - 1) for k, v in counters.items()),
+            previous, request, field, now, 1)
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Return limit data about any keys relevant for requst."""
+        now = time.time()
+        rate_keys, previous_keys = self._read_keys(
+            func_name, request, ip, field, rates, now)
+        counters = self._get_windows(
+            [key for key, _, _ in rate_keys + previous_keys])
+        return self._window_limits(
+            rate_keys, counters,
+            self._weigh_previous(rate_keys, previous_keys, counters, now),
+            request, field, now)
+
+    def hit_buckets(self, request, buckets):
+        """Like hit_many(), incrementing every bucket's counters together."""
+        now = time.time()
+        rate_keys, ends = self._bucket_rate_keys(
+            request, buckets,
+            lambda *args: self._window_rate_keys(*args, now=now))
+        previous = {}
+        if self.algorithm == SLIDING_WINDOW:
+            previous_keys, _ = self._bucket_rate_keys(
+                request, buckets,
+                lambda *args: self._window_rate_keys(
+                    *args, now=now, previous=True))
+            previous = self._weigh_previous(
+                rate_keys, previous_keys,
+                self._get_windows([key for key, _, _ in previous_keys]), now)
+        counters = dict(
+            (k, v - 1) for k, v in self._incr_many(rate_keys, now).items())
+        return [
+            self._window_limits(
+                bucket_keys, counters, previous, request, field, now, 1)
+            for field, bucket_keys in self._split(buckets, ends, rate_keys)
+        ]
+
+    def _read_counts(self, keys, now):
+        """Read the current windows, and previous ones when sliding."""
+        current = [
+            (self._window_key(key, period, now), None, period)
+            for key, period in keys
+        ]
+        previous = []
+        if self.algorithm == SLIDING_WINDOW:
+            previous = [
+                (self._window_key(key, period, now, True), None, period)
+                for key, period in keys
+            ]
+        values = self._get_windows([key for key, _, _ in current + previous])
+        weighed = self._weigh_previous(current, previous, values, now)
+        counts = {}
+        for (key, _), (window_key, _, _) in zip(keys, current):
+            if window_key in values or window_key in weighed:
+                counts[key] = int(
+                    values.get(window_key, 0) + weighed.get(window_key, 0))
+        return counts
+
+    def _stored_keys(self, keys, now):
+        stored = []
+        for key, period in keys:
+            stored.extend(self._sub_keys(self._window_key(key, period, now)))
+            if self.algorithm == SLIDING_WINDOW:
+                stored.extend(self._sub_keys(
+                    self._window_key(key, period, now, True)))
+        return stored
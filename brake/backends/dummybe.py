@@ -12,7 +12,27 @@ class DummyBackend(CacheBackend):
     def get_ip(self, request):
         return str(random.randrange(10e20))
 
-    def limit(self, func_name, request,
-              ip=True, field=None, count=5, period=None):
+    def limit_many(self, func_name, request,
+                   ip=True, field=None, rates=(), burst=None):
         """Return limit data about any keys relevant for requst."""
         return []
+
+    def hit_many(self, func_name, request,
+                 ip=True, field=None, rates=(), burst=None):
+        """Count the request but never report it as limited."""
+        self.count_many(func_name, request, ip, field, rates, burst)
+        return []
+
+    def hit_buckets(self, request, buckets):
+        """Count the request against every bucket but never limit it."""
+        for func_name, ip, field, rates, burst in buckets:
+            self.count_many(func_name, request, ip, field, rates, burst)
+        return [[] for _ in buckets]
+
+    def acquire(self, func_name, request, ip=True, field=None,
+            max_concurrent=1):
+        """Never hold or run out of in-flight slots."""
+        return [], []
+
+    def release(self, leases):
+        pass
@@ -0,0 +1,140 @@
+import time
+
+from brake.backends import cachebe, record_quota
+from brake.backends.cachebe import CACHE_PREFIX, CacheBackend
+
+
+# Arrival times are kept apart from CacheBackend's counters, so switching
+# between the two never reads one as the other.
+GCRA_PREFIX = CACHE_PREFIX + 'gcra:'
+
+
+class GCRABackend(CacheBackend):
+    """Rate-limit with the generic cell rate algorithm.
+
+    Instead of a count and an expiration, each key holds a single float:
+    the "theoretical arrival time" (TAT) at which the client's allowance
+    will be fully restored. A rate of ``count`` per ``period`` lets one
+    request through every ``period / count`` seconds, and ``burst`` of them
+    may arrive at once (by default the whole ``count``).
+
+    Checking and counting is the same O(1) arithmetic on the TAT, done for
+    every key with one ``get_many`` and one ``set_many``. Limit data
+    includes a precise ``retry_after`` in seconds.
+
+    A request that is over any of its limits isn't charged against the
+    others.
+    """
+
+    key_prefix = GCRA_PREFIX
+
+    def _interval(self, count, period):
+        if count is None:
+            raise ValueError(
+                'GCRABackend needs to know the rate to count a request.')
+        return float(period) / count
+
+    def _check(self, rate_keys, burst, now, tats, request=None, amount=0):
+        """Return (limits data, new TATs) for the given stored TATs.
+
+        With a request, what each rate has left once ``amount`` more
+        requests are charged is recorded for the response headers.
+        """
+        limits = []
+        updates = {}
+        for key, count, period in rate_keys:
+            interval = self._interval(count, period)
+            tolerance = (count if burst is None else burst) * interval
+            stored = max(tats.get(key, now), now)
+            tat = stored + interval
+            if tat - now > tolerance:
+                limits.append((key, period, interval, tat - now - tolerance))
+            else:
+                updates[key] = tat
+            if request is not None:
+                charged = stored + amount * interval - now
+                record_quota(
+                    request, count, (tolerance - charged) // interval,
+                    charged)
+
+        return limits, updates
+
+    def _limits(self, limits, request, field, now, tats):
+        data = []
+        for key, period, interval, retry_after in limits:
+            queued = max(tats.get(key, now) - now, 0)
+            limit = self._limit_data(
+                key, request, field, int(round(queued / interval)), period)
+            limit['retry_after'] = retry_after
+            data.append(limit)
+
+        return data
+
+    def _store(self, updates, now):
+        if updates:
+            # A TAT in the past means the same as no TAT at all, so every
+            # key can share the longest timeout.
+            cachebe.cache.set_many(
+                updates, timeout=int(max(updates.values()) - now) + 1)
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        """Charge a request against every key, even when over the limit."""
+        self._count_keys(
+            self._rate_keys(func_name, request, ip, field, rates),
+            time.time(), amount)
+
+    def _count_keys(self, rate_keys, now, amount=1):
+        tats = cachebe.cache.get_many([key for key, _, _ in rate_keys])
+        updates = {}
+        for key, count, period in rate_keys:
+            updates[key] = max(tats.get(key, now), now) + amount * (
+                self._interval(count, period))
+        self._store(updates, now)
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Charge a request if it is within all of its limits."""
+        now = time.time()
+        rate_keys = self._rate_keys(func_name, request, ip, field, rates)
+        tats = cachebe.cache.get_many([key for key, _, _ in rate_keys])
+        limits, updates = self._check(
+            rate_keys, burst, now, tats, request, 1)
+        if limits:
+            return self._limits(limits, request, field, now, tats)
+
+        self._store(updates, now)
+        return []
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Return limit data for the keys that would reject this request."""
+        now = time.time()
+        rate_keys = self._rate_keys(func_name, request, ip, field, rates)
+        tats = cachebe.cache.get_many([key for key, _, _ in rate_keys])
+        limits, _ = self._check(rate_keys, burst, now, tats, request)
+        return self._limits(limits, request, field, now, tats)
+
+    def hit_buckets(self, request, buckets):
+        """Like hit_many() for every bucket, with one read and one write."""
+        now = time.time()
+        rate_keys, ends = self._bucket_rate_keys(
+            request, buckets, self._rate_keys)
+        tats = cachebe.cache.get_many([key for key, _, _ in rate_keys])
+        results = []
+        updates = {}
+        for (_, _, field, _, burst), (_, bucket_keys) in zip(
+                buckets, self._split(buckets, ends, rate_keys)):
+            limits, bucket_updates = self._check(
+                bucket_keys, burst, now, tats, request, 1)
+            if limits:
+                results.append(self._limits(limits, request, field, now, tats))
+            else:
+                updates.update(bucket_updates)
+                results.append([])
+        self._store(updates, now)
+        return results
+
+    def get_counts(self, func_name, periods, ips=(), fields=()):
+        raise NotImplementedError(
+            'GCRABackend stores arrival times rather than counts.')
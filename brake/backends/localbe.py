@@ -0,0 +1,297 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from brake.backends import BaseBackend
+from brake.backends.cachebe import WINDOW_PREFIX
+
+
+class LocalCache(object):
+    """A small thread-safe LRU mapping whose entries expire.
+
+    Lookups never return expired entries. When the mapping grows past
+    ``max_entries`` the least recently used entries are dropped, and
+    ``set()`` hands them back so callers can deal with what was lost.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, now):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= now:
+                return None
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, expires=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            evicted = []
+            while len(self._data) > self.max_entries:
+                evicted.append(self._data.popitem(last=False))
+        return [(k, v) for k, (v, _) in evicted]
+
+    def values(self):
+        """Return every value, including expired ones, oldest used first."""
+        with self._lock:
+            return [value for value, _ in self._data.values()]
+
+    def popitem(self):
+        """Remove and return the least recently used (key, value)."""
+        with self._lock:
+            key, (value, _) = self._data.popitem(last=False)
+        return key, value
+
+
+class _Batch(object):
+    """Requests counted locally for one identity, not yet sent upstream.
+
+    Only the rate keys are kept, not the request they were built from.
+    """
+
+    def __init__(self, rate_keys, now):
+        self.rate_keys = rate_keys
+        self.pending = 0
+        self.started = now
+        self.lock = threading.Lock()
+
+    def take(self, now):
+        with self.lock:
+            pending, self.pending = self.pending, 0
+            self.started = now
+        return pending
+
+
+class TieredBackend(BaseBackend):
+    """Put an in-process tier in front of a shared backend.
+
+    Keys that the shared backend reports as over their limit are remembered
+    in a bounded local LRU until their limit runs out, and requests for them
+    are rejected without a network call. This takes the load of a single
+    abusive client off the shared cache.
+
+    With ``RATELIMIT_LOCAL_FLUSH_INTERVAL`` set, requests are also counted
+    locally and sent upstream when the batch is that many seconds old or
+    ``RATELIMIT_LOCAL_FLUSH_SIZE`` requests big, whichever comes first.
+    Batches of identities that have gone quiet are sent by whichever
+    request comes next once they are due. Limits are only read from the
+    shared backend at flush time, so each process may let up to a batch of
+    extra requests through, and counts still pending when a process exits
+    are lost.
+
+    The shared backend, ``RATELIMIT_TIERED_BACKEND``, must be a
+    ``CacheBackend`` subclass.
+    """
+
+    def setup(self):
+        # Imported here: brake.decorators loads this module by path.
+        from brake.decorators import get_class_by_path
+
+        self.backend = get_class_by_path(getattr(
+            settings,
+            'RATELIMIT_TIERED_BACKEND',
+            'brake.backends.cachebe.CacheBackend'
+        ))()
+        self.backend.setup()
+
+        max_entries = getattr(settings, 'RATELIMIT_LOCAL_MAX_ENTRIES', 10000)
+        self.max_ttl = getattr(settings, 'RATELIMIT_LOCAL_MAX_TTL', None)
+        self.flush_interval = getattr(
+            settings, 'RATELIMIT_LOCAL_FLUSH_INTERVAL', None)
+        self.flush_size = getattr(settings, 'RATELIMIT_LOCAL_FLUSH_SIZE', 100)
+        self.denied = LocalCache(max_entries)
+        self.batches = LocalCache(max_entries)
+        self.swept = time.time()
+        self.sweep_lock = threading.Lock()
+
+    def get_ip(self, request):
+        return self.backend.get_ip(request)
+
+    def get_counts(self, func_name, periods, ips=(), fields=()):
+        return self.backend.get_counts(func_name, periods, ips, fields)
+
+    def reset_counts(self, func_name, periods, ips=(), fields=()):
+        return self.backend.reset_counts(func_name, periods, ips, fields)
+
+    def delete_keys(self, keys):
+        return self.backend.delete_keys(keys)
+
+    def acquire(self, func_name, request, ip=True, field=None,
+            max_concurrent=1):
+        return self.backend.acquire(
+            func_name, request, ip, field, max_concurrent)
+
+    def release(self, leases):
+        self.backend.release(leases)
+
+    def _denied(self, rate_keys, now):
+        """Return the remembered limit data for any of the keys.
+
+        Its ``reset`` and ``retry_after`` count down from when it was
+        remembered.
+        """
+        limits = []
+        for key, _, _ in rate_keys:
+            denied = self.denied.get(key, now)
+            if denied is not None:
+                limit, ends = denied
+                limit = dict(limit)
+                for name, end in ends.items():
+                    limit[name] = max(end - now, 0)
+                limits.append(limit)
+        return limits
+
+    def _deny(self, limits, rate_keys, now):
+        """Remember limits until they run out (or for max_ttl at most)."""
+        for limit in limits:
+            for key, _, period in rate_keys:
+                # The shared backend may have added the window to the key.
+                if limit['cache_key'] == key or limit['cache_key'].startswith(
+                        key + ':' + WINDOW_PREFIX):
+                    break
+            else:
+                continue
+
+            ttl = limit.get('retry_after', limit.get('reset', period))
+            if self.max_ttl is not None:
+                ttl = min(ttl, self.max_ttl)
+            ends = dict(
+                (name, now + limit[name]) for name in ('reset', 'retry_after')
+                if name in limit)
+            self.denied.set(key, (limit, ends), now + ttl)
+
+    def _flush(self, batch, now):
+        """Send what a batch has counted upstream."""
+        pending = batch.take(now)
+        if pending:
+            self.backend._count_keys(batch.rate_keys, now, pending)
+
+    def _sweep(self, now):
+        """Flush the batches that are due, at most once an interval."""
+        if self.flush_interval is None or \
+                now - self.swept < self.flush_interval or \
+                not self.sweep_lock.acquire(False):
+            return
+        try:
+            self.swept = now
+            for batch in self.batches.values():
+                if now - batch.started >= self.flush_interval:
+                    self._flush(batch, now)
+        finally:
+            self.sweep_lock.release()
+
+    def _batch(self, rate_keys, args, amount, now, hit=False):
+        """Count locally, flushing upstream once the batch is due.
+
+        With ``hit``, the request flushing the batch is counted upstream on
+        its own with ``hit_many()`` after the rest of the batch, so it is
+        checked against the counters from right before it.
+        """
+        bucket = tuple(key for key, _, _ in rate_keys)
+        batch = self.batches.get(bucket, now)
+        if batch is None:
+            batch = _Batch(rate_keys, now)
+            for _, evicted in self.batches.set(bucket, batch):
+                self._flush(evicted, now)
+
+        with batch.lock:
+            batch.pending += amount
+            due = (batch.pending >= self.flush_size or
+                now - batch.started >= self.flush_interval)
+        if not due:
+            return []
+
+        pending = batch.take(now)
+        if hit and pending:
+            if pending > 1:
+                self.backend._count_keys(rate_keys, now, pending - 1)
+            limits = self.backend.hit_many(*args)
+        else:
+            if pending:
+                self.backend._count_keys(rate_keys, now, pending)
+            limits = self.backend.limit_many(*args)
+        self._deny(limits, rate_keys, now)
+        return limits
+
+    def flush(self):
+        """Send every pending batch upstream, e.g. before shutting down."""
+        now = time.time()
+        while True:
+            try:
+                _, batch = self.batches.popitem()
+            except KeyError:
+                break
+            self._flush(batch, now)
+
+    def count(self, func_name, request, ip=True, field=None, period=60):
+        self.count_many(func_name, request, ip, field, [(None, period)])
+
+    def hit(self, func_name, request, ip=True, field=None, count=5,
+            period=60):
+        return self.hit_many(func_name, request, ip, field, [(count, period)])
+
+    def limit(self, func_name, request, ip=True, field=None, count=5,
+            period=None):
+        return self.limit_many(
+            func_name, request, ip, field, [(count, period)])
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        if self.flush_interval is None:
+            return self.backend.count_many(
+                func_name, request, ip, field, rates, burst, amount)
+
+        now = time.time()
+        self._sweep(now)
+        self._batch(
+            self.backend._rate_keys(func_name, request, ip, field, rates),
+            (func_name, request, ip, field, rates, burst), amount, now)
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        now = time.time()
+        self._sweep(now)
+        rate_keys = self.backend._rate_keys(
+            func_name, request, ip, field, rates)
+        limits = self._denied(rate_keys, now)
+        if limits:
+            return limits
+
+        if self.flush_interval is None:
+            limits = self.backend.hit_many(
+                func_name, request, ip, field, rates, burst)
+            self._deny(limits, rate_keys, now)
+            return limits
+
+        return self._batch(
+            rate_keys, (func_name, request, ip, field, rates, burst), 1, now,
+            hit=True)
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        now = time.time()
+        self._sweep(now)
+        rate_keys = self.backend._rate_keys(
+            func_name, request, ip, field, rates)
+        limits = self._denied(rate_keys, now)
+        if limits or self.flush_interval is not None:
+            # When batching, limits are only read from upstream on flush.
+            return limits
+
+        limits = self.backend.limit_many(
+            func_name, request, ip, field, rates, burst)
+        self._deny(limits, rate_keys, now)
+        return limits
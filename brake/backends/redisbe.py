@@ -0,0 +1,170 @@
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from brake.backends.cachebe import CacheBackend
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# KEYS are the counters, ARGV[1] the amount to add and ARGV[i + 1] the TTL
+# for KEYS[i]. The TTL is only set when a counter has none, so a window
+# starts with its first request just like CacheBackend's. Returns the new
+# count and the TTL of each key, one after the other.
+INCR_SCRIPT = """
+local results = {}
+for i, key in ipairs(KEYS) do
+    results[2 * i - 1] = redis.call('INCRBY', key, ARGV[1])
+    local ttl = redis.call('TTL', key)
+    if ttl < 0 then
+        ttl = tonumber(ARGV[i + 1])
+        redis.call('EXPIRE', key, ttl)
+    end
+    results[2 * i] = ttl
+end
+return results
+"""
+
+
+class RedisBackend(CacheBackend):
+    """Talk to Redis directly instead of going through Django's cache.
+
+    Counters are plain integers. Every key for a request is incremented,
+    given its TTL and read back by a single Lua script, so a request costs
+    one round trip however many rates and fields it is limited by, and
+    concurrent workers can't lose each other's increments.
+
+    ``RATELIMIT_REDIS_URL`` points at the server and
+    ``RATELIMIT_REDIS_OPTIONS`` is passed on to the connection pool.
+    Override ``get_client()`` to connect some other way. All of a request's
+    keys are sent to one script, so Redis Cluster isn't supported.
+
+    Requires the ``redis`` package.
+    """
+
+    counter_offset = 0
+
+    def setup(self):
+        if redis is None:
+            raise ImproperlyConfigured(
+                'RedisBackend requires the redis package.')
+        super(RedisBackend, self).setup()
+        self.client = self.get_client()
+        self.incr_script = self.client.register_script(INCR_SCRIPT)
+
+    def get_client(self):
+        pool = redis.ConnectionPool.from_url(
+            getattr(settings, 'RATELIMIT_REDIS_URL', 'redis://localhost:6379/0'),
+            **getattr(settings, 'RATELIMIT_REDIS_OPTIONS', {})
+        )
+        return redis.Redis(connection_pool=pool)
+
+    def _incr(self, rate_keys, amount=1):
+        """Run the script once for every distinct key.
+
+        Returns the new (count, ttl) of each key.
+        """
+        ttls = {}
+        for key, _, period in rate_keys:
+            ttls.setdefault(key, period)
+        keys = list(ttls)
+        results = self.incr_script(
+            keys=keys, args=[amount] + [ttls[key] for key in keys])
+        return dict(zip(keys, zip(results[::2], results[1::2])))
+
+    def _counters(self, rate_keys, values, now, amount=0):
+        """Turn the (count, ttl) of each key into CacheBackend counters.
+
+        ``amount`` is taken off the counts, to get them as they were before
+        this request.
+        """
+        counters = []
+        for key, count, period in rate_keys:
+            current_count, ttl = values[key]
+            if current_count is not None:
+                current_count = int(current_count) - amount
+            if ttl < 0:
+                ttl = period
+            counters.append(
+                (key, count, period, current_count, now + ttl))
+        return counters
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        """Increment counters for every period in one round trip."""
+        self._count_keys(
+            self._rate_keys(func_name, request, ip, field, rates),
+            time.time(), amount)
+
+    def _count_keys(self, rate_keys, now, amount=1):
+        self._incr(rate_keys, amount)
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Increment counters and return limit data in one round trip."""
+        now = time.time()
+        rate_keys = self._rate_keys(func_name, request, ip, field, rates)
+        counters = self._counters(rate_keys, self._incr(rate_keys), now, 1)
+
+        # Compare the count as it was before this request, like limit().
+        return self._limits(counters, request, field, now, 1)
+
+    def hit_buckets(self, request, buckets):
+        """Increment every bucket's counters in one round trip."""
+        now = time.time()
+        rate_keys, ends = self._bucket_rate_keys(
+            request, buckets, self._rate_keys)
+        counters = self._counters(rate_keys, self._incr(rate_keys), now, 1)
+        return [
+            self._limits(bucket_counters, request, field, now, 1)
+            for field, bucket_counters in self._split(buckets, ends, counters)
+        ]
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        """Return limit data about any keys relevant for requst."""
+        now = time.time()
+        rate_keys = self._rate_keys(func_name, request, ip, field, rates)
+        keys = [key for key, _, _ in rate_keys]
+
+        # The counts and their TTLs, in one round trip.
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.mget(keys)
+        for key in keys:
+            pipeline.ttl(key)
+        results = pipeline.execute()
+        values = dict(zip(keys, zip(results[0], results[1:])))
+
+        return self._limits(
+            self._counters(rate_keys, values, now), request, field, now)
+
+    def _read_counts(self, keys, now):
+        values = self.client.mget([key for key, _ in keys])
+        return dict(
+            (key, int(value))
+            for (key, _), value in zip(keys, values) if value is not None
+        )
+
+    def delete_keys(self, keys):
+        keys = list(keys)
+        if keys:
+            self.client.delete(*keys)
+        return keys
+
+    def _get_slots(self, keys):
+        return dict(
+            (key, value.decode('utf-8'))
+            for key, value in zip(keys, self.client.mget(keys))
+            if value is not None
+        )
+
+    def _add_slot(self, key, token, timeout):
+        return bool(self.client.set(key, token, nx=True, ex=timeout))
+
+    def _delete_slots(self, keys):
+        if keys:
+            self.client.delete(*keys)
@@ -0,0 +1,140 @@
+import bisect
+import hashlib
+import struct
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+
+def _hash(value):
+    return struct.unpack(
+        '<I', hashlib.md5(value.encode('utf-8')).digest()[:4])[0]
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto names.
+
+    Each name gets ``replicas`` points on the ring, and a key belongs to
+    the name of the first point after its own hash. Adding or removing a
+    name only moves the keys next to its points.
+    """
+
+    def __init__(self, names, replicas=100):
+        points = sorted(
+            (_hash('%s:%d' % (name, i)), name)
+            for name in names for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    def get(self, key):
+        index = bisect.bisect(self.hashes, _hash(key))
+        return self.names[index % len(self.names)]
+
+
+class ShardedCache(BaseCache):
+    """Spread keys over several cache aliases by consistent hashing.
+
+    The ``*_many`` methods make one call per alias involved, run
+    concurrently on ``threads`` worker threads (one of them in the calling
+    thread). Caches' own key prefixes and versions apply as usual.
+    """
+
+    def __init__(self, aliases, threads=None, replicas=100):
+        super(ShardedCache, self).__init__({})
+        self.aliases = list(aliases)
+        self.ring = HashRing(self.aliases, replicas)
+        self.executor = None
+        if ThreadPoolExecutor is not None and len(self.aliases) > 1:
+            self.executor = ThreadPoolExecutor(
+                threads or len(self.aliases) - 1)
+        if all(hasattr(caches[alias], 'incr_many') for alias in aliases):
+            self.incr_many = self._incr_many
+
+    def _call(self, alias, method, *args, **kwargs):
+        # Django hands out a cache connection per thread, so look it up in
+        # the thread making the call.
+        return getattr(caches[alias], method)(*args, **kwargs)
+
+    def _map(self, method, groups, **kwargs):
+        """Call method on each alias with its group of keys, concurrently.
+
+        Returns the results of the calls.
+        """
+        calls = list(groups.items())
+        if self.executor is None or len(calls) < 2:
+            return [
+                self._call(alias, method, group, **kwargs)
+                for alias, group in calls
+            ]
+
+        futures = [
+            self.executor.submit(self._call, alias, method, group, **kwargs)
+            for alias, group in calls[1:]
+        ]
+        alias, group = calls[0]
+        return [self._call(alias, method, group, **kwargs)] + [
+            future.result() for future in futures]
+
+    def _group(self, keys):
+        """Return {alias: [key, ...]} for the keys."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.get(key), []).append(key)
+        return groups
+
+    def get_many(self, keys, version=None):
+        values = {}
+        for result in self._map(
+                'get_many', self._group(keys), version=version):
+            values.update(result)
+        return values
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        groups = dict(
+            (alias, dict((key, data[key]) for key in group))
+            for alias, group in self._group(data).items())
+        failed = []
+        for result in self._map(
+                'set_many', groups, timeout=timeout, version=version):
+            failed.extend(result or ())
+        return failed
+
+    def delete_many(self, keys, version=None):
+        self._map('delete_many', self._group(keys), version=version)
+
+    def _incr_many(self, keys, timeout=DEFAULT_TIMEOUT, delta=1):
+        values = {}
+        for result in self._map(
+                'incr_many', self._group(keys), timeout=timeout, delta=delta):
+            values.update(result)
+        return values
+
+    def _cache(self, key):
+        return caches[self.ring.get(key)]
+
+    def get(self, key, default=None, version=None):
+        return self._cache(key).get(key, default, version=version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._cache(key).set(key, value, timeout, version=version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._cache(key).add(key, value, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        return self._cache(key).incr(key, delta, version=version)
+
+    def delete(self, key, version=None):
+        return self._cache(key).delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        return self._cache(key).has_key(key, version=version)
+
+    def clear(self):
+        for alias in self.aliases:
+            caches[alias].clear()
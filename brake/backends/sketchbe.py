@@ -0,0 +1,216 @@
+import hashlib
+import re
+import struct
+import time
+from array import array
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from brake.backends import cachebe, record_quota
+from brake.backends.cachebe import CACHE_PREFIX, CacheBackend, PERIOD_PREFIX
+
+
+SKETCH_PREFIX = 'sketch:'
+PERIOD_RE = re.compile(':%s(\\d+):' % PERIOD_PREFIX)
+MAX_CELL = (1 << 32) - 1
+
+
+class SketchBackend(CacheBackend):
+    """Count light traffic in a Count-Min Sketch, heavy hitters exactly.
+
+    ``CacheBackend`` keeps a cache entry for every identity, so a flood of
+    distinct usernames or IPs fills the cache and evicts everything else.
+    This backend first counts each identity in a sketch: a fixed-size
+    array of ``RATELIMIT_SKETCH_DEPTH`` rows of ``RATELIMIT_SKETCH_WIDTH``
+    counters, stored in one cache entry per view, period and window, no
+    matter how many identities there are. Only identities whose estimated
+    count reaches ``RATELIMIT_SKETCH_THRESHOLD`` times their rate are
+    promoted to an exact counter of their own, which starts from the
+    estimate.
+
+    Sharing cells only makes estimates too high: with N requests in a
+    window, at most ``e * N / width`` too high except with probability
+    ``exp(-depth)``, so identities sharing cells with heavy ones may be
+    promoted, and limited, early. Size the width so that ``3 * N / width``
+    stays well below ``threshold * count``.
+
+    The sketch is read and written back whole, so of two requests to a
+    view at the same moment one may overwrite the other's update, for any
+    identity. Estimates can then fall short and promotion come late, by
+    up to as many requests as run at once; once promoted, identities are
+    counted as exactly as by ``CacheBackend``.
+
+    Cells are updated conservatively (only raised to the new estimate),
+    which keeps estimates tighter. Sketch windows are aligned to the clock
+    like ``AtomicCacheBackend``'s. Every request reads and writes the whole
+    sketch, ``4 * width * depth`` bytes, so keep it small.
+    """
+
+    width = 1024
+    depth = 4
+    threshold = 0.5
+
+    def setup(self):
+        super(SketchBackend, self).setup()
+        self.width = getattr(settings, 'RATELIMIT_SKETCH_WIDTH', 1024)
+        self.depth = getattr(settings, 'RATELIMIT_SKETCH_DEPTH', 4)
+        self.threshold = getattr(settings, 'RATELIMIT_SKETCH_THRESHOLD', 0.5)
+        if not 0 < self.threshold <= 1:
+            raise ImproperlyConfigured(
+                'RATELIMIT_SKETCH_THRESHOLD must be between 0 and 1.')
+
+    def _sketch_key(self, key, period, now):
+        """Return the key of the sketch a counter key is counted in."""
+        # The identity at the end of a key never contains the period.
+        marker = ':%s%d:' % (PERIOD_PREFIX, period)
+        window = int(now // period) * period
+        return '%s%s%s%d' % (
+            CACHE_PREFIX, SKETCH_PREFIX,
+            key[len(CACHE_PREFIX):key.rindex(marker) + len(marker)], window)
+
+    def _cells(self, key):
+        """Return the index of the key's cell in every row."""
+        h1, h2 = struct.unpack(
+            '<II', hashlib.md5(key.encode('utf-8')).digest()[:8])
+        h2 |= 1
+        return [
+            row * self.width + (h1 + row * h2) % self.width
+            for row in range(self.depth)
+        ]
+
+    def _read(self, rate_keys, now):
+        """Read the counters and their sketches with a single get_many.
+
+        Returns CacheBackend counters, holding the estimate for identities
+        without an exact counter, the sketches by key, and the cells of
+        the counters kept in them.
+        """
+        sketch_keys = dict(
+            (key, self._sketch_key(key, period, now))
+            for key, _, period in rate_keys)
+        values = cachebe.cache.get_many(
+            [key for key, _, _ in rate_keys] + list(set(sketch_keys.values())))
+
+        sketches = {}
+        sketched = {}
+        counters = []
+        for key, count, period in rate_keys:
+            if key in values:
+                counters.append((key, count, period) +
+                    self._decode(values[key], period, now))
+                continue
+
+            sketch_key = sketch_keys[key]
+            sketch = sketches.get(sketch_key)
+            if sketch is None:
+                sketch = sketches[sketch_key] = values.get(sketch_key) or \
+                    array('I', [0]) * (self.width * self.depth)
+            cells = self._cells(key)
+            estimate = min(sketch[cell] for cell in cells)
+            expiration = int(now // period) * period + period
+            counters.append(
+                (key, count, period, estimate or None, expiration))
+            if count is None or estimate + 1 <= self.threshold * count:
+                sketched[key] = (sketch_key, cells)
+
+        return counters, sketches, sketched
+
+    def _write(self, counters, sketches, sketched, now, amount=1):
+        """Add amount to the exact counters and raise the sketched cells."""
+        exact = []
+        updates = {}
+        for counter in counters:
+            key, _, _, estimate, expiration = counter
+            if key not in sketched:
+                exact.append(counter)
+                continue
+
+            sketch_key, cells = sketched[key]
+            sketch = sketches[sketch_key]
+            # New identities start at 1 + amount, like CacheBackend counters.
+            new = min((estimate or 1) + amount, MAX_CELL)
+            for cell in cells:
+                if sketch[cell] < new:
+                    sketch[cell] = new
+            updates.setdefault(int(expiration - now) + 1, {})[sketch_key] = (
+                sketch)
+
+        self._set_counters(exact, now, amount)
+        for timeout, values in updates.items():
+            cachebe.cache.set_many(values, timeout=timeout)
+
+    def _sketch_limits(self, counters, sketched, request, field, now,
+            amount=0):
+        """Like _limits(); identities still in the sketch are never over."""
+        for key, count, _, estimate, expiration in counters:
+            if key in sketched and count is not None:
+                seen = estimate - self.counter_offset if estimate else 0
+                record_quota(request, count, count - seen - amount,
+                    max(expiration - now, 0))
+        return self._limits(
+            [counter for counter in counters if counter[0] not in sketched],
+            request, field, now, amount)
+
+    def count_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None, amount=1):
+        self._count_keys(
+            self._rate_keys(func_name, request, ip, field, rates),
+            time.time(), amount)
+
+    def _count_keys(self, rate_keys, now, amount=1):
+        counters, sketches, sketched = self._read(rate_keys, now)
+        self._write(counters, sketches, sketched, now, amount)
+
+    def hit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        now = time.time()
+        counters, sketches, sketched = self._read(
+            self._rate_keys(func_name, request, ip, field, rates), now)
+        self._write(counters, sketches, sketched, now)
+        return self._sketch_limits(counters, sketched, request, field, now, 1)
+
+    def limit_many(self, func_name, request, ip=True, field=None, rates=(),
+            burst=None):
+        now = time.time()
+        counters, _, sketched = self._read(
+            self._rate_keys(func_name, request, ip, field, rates), now)
+        return self._sketch_limits(counters, sketched, request, field, now)
+
+    def hit_buckets(self, request, buckets):
+        now = time.time()
+        rate_keys, ends = self._bucket_rate_keys(
+            request, buckets, self._rate_keys)
+        counters, sketches, sketched = self._read(rate_keys, now)
+        self._write(counters, sketches, sketched, now)
+        return [
+            self._sketch_limits(
+                bucket_counters, sketched, request, field, now, 1)
+            for field, bucket_counters in self._split(buckets, ends, counters)
+        ]
+
+    def _read_counts(self, keys, now):
+        """Exact counts, and estimates for identities still sketched."""
+        counters, _, _ = self._read(
+            [(key, None, period) for key, period in keys], now)
+        return dict(
+            (key, current_count) for key, _, _, current_count, _ in counters
+            if current_count is not None)
+
+    def delete_keys(self, keys):
+        """Zero the counters instead, as the sketch still remembers them.
+
+        A deleted counter would be promoted again on the next request,
+        starting from the sketch's estimate.
+        """
+        now = time.time()
+        keys = list(keys)
+        updates = {}
+        for key in keys:
+            period = int(PERIOD_RE.findall(key)[-1])
+            expiration = int(now // period) * period + period
+            updates.setdefault(int(expiration - now) + 1, {})[key] = (
+                self._encode(0, expiration))
+        for timeout, values in updates.items():
+            cachebe.cache.set_many(values, timeout=timeout)
+        return keys
@@ -1,8 +1,28 @@
+import inspect
+import math
 import re
 from functools import wraps
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpRequest, HttpResponse
+from django.utils.functional import LazyObject, empty
+
+from brake import metrics
+# Connects the receiver that feeds the index of top offenders.
+from brake import inspection  # noqa
+from brake.backends import field_source, with_prefixes, with_source
+from brake.shadow import _shadow
+from brake.signals import ratelimit_exceeded
+
+try:
+    from django.http.response import HttpResponseBase
+except ImportError:  # Django < 1.5
+    HttpResponseBase = HttpResponse
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed
 
 class HttpResponseTooManyRequests(HttpResponse):
     status_code = getattr(settings, 'RATELIMIT_STATUS_CODE', 403)
@@ -43,53 +63,249 @@ def get_class_by_path(path):
     return mod
 
 
+class _BackendProxy(LazyObject):
+    """The configured backend, created on first use and shared after that.
+
+    Instantiating the backend (and importing its class) happens once per
+    process instead of once per request. The instance is thrown away when a
+    ``RATELIMIT_*`` setting changes, e.g. under ``override_settings``.
+    """
+
+    def _setup(self):
+        # Allows you to override the CacheBackend in your settings.py
+        backend_class = getattr(
+            settings,
+            'RATELIMIT_CACHE_BACKEND',
+            'brake.backends.cachebe.CacheBackend'
+        )
+        backend = get_class_by_path(backend_class)()
+        backend.setup()
+        self._wrapped = backend
+
+
+_backend = _BackendProxy()
+
+
+def _reset_backend(setting, **kwargs):
+    if setting.startswith('RATELIMIT_'):
+        _backend._wrapped = empty
+
+setting_changed.connect(_reset_backend)
+
+
+def _func_name(fn, request, use_request_path):
+    if use_request_path:
+        return request.path
+    elif hasattr(fn, '__name__'):
+        return fn.__name__
+    else:
+        return fn.func.__name__
+
+
+def _spend_quota(request):
+    """Take a request counted after the view off the recorded quota."""
+    quota = getattr(request, 'ratelimit_quota', None)
+    if quota is not None:
+        quota['remaining'] = max(quota['remaining'] - 1, 0)
+
+
+def _add_headers(request, response):
+    """Set the RateLimit-* and Retry-After headers from what was read.
+
+    Uses what the backend recorded on the request while checking it, so
+    no extra cache reads are needed.
+    """
+    if not getattr(settings, 'RATELIMIT_HEADERS', True) or \
+            not isinstance(response, HttpResponseBase):
+        return
+
+    quota = getattr(request, 'ratelimit_quota', None)
+    if quota is not None:
+        response['RateLimit-Limit'] = str(quota['limit'])
+        response['RateLimit-Remaining'] = str(quota['remaining'])
+        response['RateLimit-Reset'] = str(int(math.ceil(quota['reset'])))
+
+    limits = getattr(request, 'limits', None)
+    if limits and isinstance(response, HttpResponseTooManyRequests):
+        retry_after = max(
+            limit.get('retry_after', limit.get('reset', 0))
+            for limit in limits)
+        response['Retry-After'] = str(int(math.ceil(retry_after)))
+
+
+def _submit_shadow(request, response, func_name, method, ip, field, rates,
+        burst, increment, label):
+    """Queue the request to be checked against shadow limits."""
+    if _method_match(request, method):
+        counted = increment is None or (
+            callable(increment) and increment(request, response))
+        _shadow.submit(
+            func_name, request, ip, field, rates, burst, counted, label)
+
+
+def _staged(request, ip, field, block):
+    """Whether to check the IP before fields that would parse the body.
+
+    A request already limited by IP is then rejected without its body
+    being read, and without counting it against its fields; one that isn't
+    costs a second backend call. Not worth it once the body has been
+    parsed, e.g. by CSRF middleware.
+    """
+    if not (block and ip) or field is None or \
+            request.method in ('GET', 'HEAD') or \
+            not isinstance(request, HttpRequest) or hasattr(request, '_post'):
+        return False
+    fields = field if isinstance(field, (list, tuple)) else [field]
+    return any(field_source(f)[0] is None for f in fields)
+
+
+def _check(func_name, request, ip, field, rates, burst, block, counted):
+    """Return the limits the request runs into, counting it if counted."""
+    check = _backend.hit_many if counted else _backend.limit_many
+    if not _staged(request, ip, field, block):
+        return check(func_name, request, ip, field, rates, burst)
+
+    limits = check(func_name, request, ip, None, rates, burst)
+    if limits:
+        return limits
+    return check(func_name, request, False, field, rates, burst)
+
+
+def _is_coroutine_function(fn):
+    # Not available before Python 3.5, where there are no async views.
+    is_coroutine_function = getattr(inspect, 'iscoroutinefunction', None)
+    return is_coroutine_function is not None and is_coroutine_function(fn)
+
+
+def _acquire(fn, request, func_name, ip, field, block, max_concurrent):
+    """Take an in-flight slot for the request.
+
+    Returns the leases to release once the view is done, and the response
+    to block the request with if no slot was free.
+    """
+    leases, limits = _backend.acquire(
+        func_name, request, ip, field, max_concurrent)
+    if not limits:
+        return leases, None
+
+    request.limited = True
+    request.limits = getattr(request, 'limits', []) + limits
+    ratelimit_exceeded.send(
+        sender=fn, request=request, func_name=func_name, limits=limits)
+    return [], HttpResponseTooManyRequests() if block else None
+
+
+def _ratelimited(fn, rates, ip, use_request_path, block, method, field,
+        increment, burst, shadow, max_concurrent):
+    # Metrics are labelled with the view's name even when counters are
+    # kept per path, so that there is a bounded number of label values.
+    label = _func_name(fn, None, False)
+
+    @wraps(fn)
+    def _wrapped(request, *args, **kw):
+        func_name = _func_name(fn, request, use_request_path)
+        if shadow or _shadow.everything:
+            response = fn(request, *args, **kw)
+            _submit_shadow(request, response, func_name, method, ip, field,
+                rates, burst, increment, label)
+            return response
+
+        response = None
+        counted = False
+        if rates and _method_match(request, method):
+            started = metrics.start()
+            # When every matching request is counted anyway, check and
+            # increment in one backend call.
+            counted = increment is None
+            limits = _check(
+                func_name, request, ip, field, rates, burst, block, counted)
+            metrics.checked(
+                _backend, 'hit_many' if counted else 'limit_many',
+                label, rates, limits, counted, started)
+            if limits:
+                if block:
+                    response = HttpResponseTooManyRequests()
+                request.limited = True
+                request.limits = limits
+                ratelimit_exceeded.send(
+                    sender=fn, request=request, func_name=func_name,
+                    limits=limits)
+
+        leases = []
+        if response is None and max_concurrent is not None and \
+                _method_match(request, method):
+            leases, response = _acquire(
+                fn, request, func_name, ip, field, block, max_concurrent)
+
+        if response is None:
+            # If the response isn't HttpResponseTooManyRequests already, run
+            # the actual function to get the result.
+            try:
+                response = fn(request, *args, **kw)
+            finally:
+                if leases:
+                    _backend.release(leases)
+
+        if not counted and rates and \
+                not isinstance(response, HttpResponseTooManyRequests):
+            if _method_match(request, method) and \
+                (increment is None or (callable(increment) and increment(
+                    request, response
+                ))):
+                started = metrics.start()
+                _backend.count_many(
+                    func_name, request, ip, field, rates, burst)
+                metrics.counted(
+                    _backend, 'count_many', label, rates, started)
+                _spend_quota(request)
+
+        _add_headers(request, response)
+        return response
+
+    return _wrapped
+
+
 def ratelimit(
-    ip=True, use_request_path=False, block=False, method=None, field=None, rate='5/m', increment=None
+    ip=True, use_request_path=False, block=False, method=None, field=None, rate='5/m', increment=None,
+    burst=None, shadow=False, field_source=None, max_concurrent=None,
+    ip_prefix_v4=None, ip_prefix_v6=None, ip_exact=False
 ):
-    def decorator(fn):
-        count, period = _split_rate(rate)
-
-        @wraps(fn)
-        def _wrapped(request, *args, **kw):
-            # Allows you to override the CacheBackend in your settings.py
-            _backend_class = getattr(
-                settings,
-                'RATELIMIT_CACHE_BACKEND',
-                'brake.backends.cachebe.CacheBackend'
-            )
-            _backend = get_class_by_path(_backend_class)()
-
-            if use_request_path:
-                func_name = request.path
-            elif hasattr(fn, '__name__'):
-                func_name = fn.__name__
-            else:
-                func_name = fn.func.__name__
-            response = None
-            if _method_match(request, method):
-                limits = _backend.limit(
-                    func_name, request, ip, field, count, period
-                )
-                if limits:
-                    if block:
-                        response = HttpResponseTooManyRequests()
-                    request.limited = True
-                    request.limits = limits
-
-            if response is None:
-                # If the response isn't HttpResponseTooManyRequests already, run
-                # the actual function to get the result.
-                response = fn(request, *args, **kw)
+    ip = with_prefixes(ip, ip_prefix_v4, ip_prefix_v6, ip_exact)
+    field = with_source(field, field_source)
+    options = dict(
+        ip=ip, use_request_path=use_request_path, block=block,
+        method=method, field=field, increment=increment, burst=burst,
+        shadow=shadow, max_concurrent=max_concurrent
+    )
 
-            if not isinstance(response, HttpResponseTooManyRequests):
-                if _method_match(request, method) and \
-                    (increment is None or (callable(increment) and increment(
-                        request, response
-                    ))):
-                    _backend.count(func_name, request, ip, field, period)
+    def decorator(fn):
+        rates = rate
+        if rates is None:
+            # Only max_concurrent applies.
+            rates = []
+        elif not isinstance(rates, (list, tuple)):
+            rates = [rates]
+        rates = [_split_rate(r) for r in rates]
 
-            return response
+        stacked = getattr(fn, '_ratelimit', None)
+        # functools.wraps copies _ratelimit onto any decorator wrapping a
+        # @ratelimit, so only merge into the wrapper itself; merging
+        # through another decorator would drop it.
+        if stacked is not None and stacked['wrapper'] is fn and \
+                stacked['options'] == options:
+            # A @ratelimit that only differs in its rate is merged into
+            # the one below it, so all of the windows share a single
+            # backend call.
+            fn = stacked['fn']
+            rates = stacked['rates'] + rates
 
+        if _is_coroutine_function(fn):
+            from brake.aio import _ratelimited_async
+            _wrapped = _ratelimited_async(fn, rates, **options)
+        else:
+            _wrapped = _ratelimited(fn, rates, **options)
+        _wrapped._ratelimit = {
+            'fn': fn, 'rates': rates, 'options': options, 'wrapper': _wrapped}
         return _wrapped
 
     return decorator
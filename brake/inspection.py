@@ -0,0 +1,205 @@
+"""Look at and reset rate-limit counters without building keys by hand.
+
+``get_counts()`` reads the counters of many identities (IP addresses or
+field values) for a view with one ``get_many``, and ``reset()`` clears them
+with one ``delete_many``. ``manage.py ratelimit`` wraps both.
+
+With ``RATELIMIT_INDEX_SIZE`` set, every limit a request runs into is also
+recorded in a bounded index of the busiest keys, which ``top_offenders()``
+reads, so finding who is being limited never needs a scan of the cache.
+Each process keeps the keys it sees in memory and merges them into a
+single cache entry at most every ``RATELIMIT_INDEX_FLUSH_INTERVAL``
+seconds, keeping the ``RATELIMIT_INDEX_SIZE`` highest counts. Processes
+flushing at the same moment can overwrite each other's entries; keys that
+keep getting limited come back with the next flush.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import LazyObject, empty
+
+from brake.backends import cachebe
+from brake.signals import ratelimit_exceeded
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed
+
+
+INDEX_KEY = cachebe.CACHE_PREFIX + 'index'
+
+
+def _top(entries, size, now):
+    """Return the unexpired entries with the ``size`` highest counts."""
+    entries = [
+        entry for entry in entries.values() if entry['expires'] > now
+    ]
+    entries.sort(key=lambda entry: entry['count'], reverse=True)
+    return dict((entry['cache_key'], entry) for entry in entries[:size])
+
+
+class ActiveKeyIndex(object):
+    """The busiest limited keys, shared between processes via the cache.
+
+    Disabled, and never touched, when ``size`` is None.
+    """
+
+    def __init__(self, size, flush_interval=10):
+        self.enabled = size is not None
+        self.size = size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.flushed = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, func_name, limits, now=None):
+        """Remember the keys in the limit data of a limited request."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for limit in limits:
+                key = limit['cache_key']
+                entry = self.pending.get(key)
+                if entry is not None and entry['count'] >= limit['count']:
+                    continue
+                self.pending[key] = {
+                    'func_name': func_name,
+                    'period': limit['period'],
+                    'ratelimited_by': limit['ratelimited_by'],
+                    'ip': limit['ip'],
+                    'count': limit['count'],
+                    'cache_key': key,
+                    'expires': now + limit.get(
+                        'retry_after', limit.get('reset', limit['period'])),
+                }
+            if len(self.pending) > 2 * self.size:
+                self.pending = _top(self.pending, self.size, now)
+            due = now - self.flushed >= self.flush_interval
+        if due:
+            self.flush(now)
+
+    def flush(self, now=None):
+        """Merge the keys recorded by this process into the shared index."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed = now
+        if not pending:
+            return
+
+        entries = cachebe.cache.get(INDEX_KEY) or {}
+        for key, entry in pending.items():
+            if key not in entries or entries[key]['count'] < entry['count']:
+                entries[key] = entry
+        self._store(_top(entries, self.size, now), now)
+
+    def _store(self, entries, now):
+        if entries:
+            cachebe.cache.set(INDEX_KEY, entries, timeout=int(
+                max(entry['expires'] for entry in entries.values()) - now) + 1)
+        else:
+            cachebe.cache.delete(INDEX_KEY)
+
+    def entries(self, now=None):
+        """Return every indexed entry, highest count first."""
+        if now is None:
+            now = time.time()
+        self.flush(now)
+        entries = _top(cachebe.cache.get(INDEX_KEY) or {}, self.size, now)
+        return sorted(
+            entries.values(), key=lambda entry: entry['count'], reverse=True)
+
+    def discard(self, keys, now=None):
+        """Drop keys from the index, e.g. once their counters are reset."""
+        if now is None:
+            now = time.time()
+        keys = set(keys)
+        with self.lock:
+            for key in keys:
+                self.pending.pop(key, None)
+        entries = cachebe.cache.get(INDEX_KEY)
+        if entries and keys.intersection(entries):
+            self._store(_top(dict(
+                (key, entry) for key, entry in entries.items()
+                if key not in keys), self.size, now), now)
+
+
+class _IndexProxy(LazyObject):
+
+    def _setup(self):
+        self._wrapped = ActiveKeyIndex(
+            getattr(settings, 'RATELIMIT_INDEX_SIZE', None),
+            getattr(settings, 'RATELIMIT_INDEX_FLUSH_INTERVAL', 10))
+
+
+_index = _IndexProxy()
+
+
+def _reset_index(setting, **kwargs):
+    if setting.startswith('RATELIMIT_'):
+        _index._wrapped = empty
+
+setting_changed.connect(_reset_index)
+
+
+def _record_limits(sender, request, func_name, limits, **kwargs):
+    if _index.enabled:
+        _index.record(func_name, limits)
+
+ratelimit_exceeded.connect(_record_limits)
+
+
+def top_offenders(func_name=None, period=None, limit=20):
+    """Return the most limited keys, highest count first.
+
+    Each is a dict with the ``func_name``, ``period``, ``ratelimited_by``,
+    ``ip``, ``count`` and ``cache_key`` of the limit, and when it
+    ``expires``. Requires ``RATELIMIT_INDEX_SIZE``.
+    """
+    if not _index.enabled:
+        raise ImproperlyConfigured(
+            'Set RATELIMIT_INDEX_SIZE to keep track of the top offenders.')
+    entries = [
+        entry for entry in _index.entries()
+        if (func_name is None or entry['func_name'] == func_name) and
+            (period is None or entry['period'] == period)
+    ]
+    return entries[:limit]
+
+
+def _backend():
+    # Imported here: brake.decorators imports this module.
+    from brake.decorators import _backend
+    return _backend
+
+
+def get_counts(func_name, periods, ips=(), fields=()):
+    """Return {(identity, period): count} for the identities given.
+
+    ``fields`` is a list of (field, value) pairs such as
+    ``[('username', 'alice')]``; identities in the result are those pairs
+    and ``('ip', address)`` for each of ``ips``. Identities without a
+    counter are left out.
+    """
+    return _backend().get_counts(func_name, periods, ips, fields)
+
+
+def reset(func_name, periods, ips=(), fields=()):
+    """Clear the counters of the identities given; returns the keys."""
+    keys = _backend().reset_counts(func_name, periods, ips, fields)
+    if _index.enabled:
+        _index.discard(keys)
+    return keys
+
+
+def reset_keys(keys):
+    """Clear counters by cache key, such as those from top_offenders()."""
+    keys = _backend().delete_keys(keys)
+    if _index.enabled:
+        _index.discard(keys)
+    return keys
+
@@ -0,0 +1,99 @@
+import django
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from brake import inspection
+from brake.decorators import _split_rate
+
+
+# Named for argparse's error messages.
+def period(value):
+    """Parse a period in seconds, or like the end of a rate: 'm', '15m'."""
+    if value.isdigit():
+        return int(value)
+    try:
+        return _split_rate('0/' + value)[1]
+    except (AttributeError, KeyError):
+        raise ValueError(value)
+
+
+def field(value):
+    name, sep, val = value.partition('=')
+    if not sep:
+        raise ValueError(value)
+    return name, val
+
+
+class Command(BaseCommand):
+    help = (
+        'Show the top offenders (needs RATELIMIT_INDEX_SIZE), or show or '
+        'reset the counters of IP addresses and field values for a view.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('top', 'show', 'reset'))
+        parser.add_argument(
+            '--func', help='The func_name counters are kept under, usually '
+            'the name of the view.')
+        parser.add_argument(
+            '--period', action='append', type=period, default=[],
+            help='A period in seconds or like 5m, 1h or d; repeatable.')
+        parser.add_argument(
+            '--ip', action='append', default=[], help='Repeatable.')
+        parser.add_argument(
+            '--field', action='append', type=field, default=[],
+            metavar='NAME=VALUE', help='Repeatable.')
+        parser.add_argument(
+            '--key', action='append', default=[],
+            help='A cache key, as listed by top, to reset; repeatable.')
+        parser.add_argument(
+            '--limit', type=int, default=20,
+            help='How many top offenders to list.')
+
+    def handle(self, *args, **options):
+        # Options are declared with add_arguments(), which older versions
+        # don't call.
+        if django.VERSION < (1, 8):
+            raise CommandError('ratelimit needs Django 1.8 or later.')
+        getattr(self, '_' + options['action'])(**options)
+
+    def _top(self, func, period, limit, **options):
+        if period and len(period) > 1:
+            raise CommandError('top takes a single --period.')
+        try:
+            entries = inspection.top_offenders(
+                func, period[0] if period else None, limit)
+        except ImproperlyConfigured as e:
+            raise CommandError(e)
+        for entry in entries:
+            self.stdout.write('%(count)d\t%(func_name)s\t%(period)s\t'
+                '%(ratelimited_by)s\t%(ip)s\t%(cache_key)s' % entry)
+
+    def _identities(self, func, period, ip, field):
+        if not func or not period:
+            raise CommandError('--func and at least one --period are needed.')
+        if not ip and not field:
+            raise CommandError('Give at least one --ip or --field.')
+        return func, period, ip, field
+
+    def _show(self, func, period, ip, field, **options):
+        func, period, ip, field = self._identities(func, period, ip, field)
+        try:
+            counts = inspection.get_counts(func, period, ip, field)
+        except NotImplementedError as e:
+            raise CommandError('The backend can\'t show counts. %s' % e)
+        for p in period:
+            for identity in [('ip', i) for i in ip] + field:
+                self.stdout.write('%s=%s\t%d\t%d' % (
+                    identity[0], identity[1], p, counts.get((identity, p), 0)))
+
+    def _reset(self, func, period, ip, field, key, **options):
+        try:
+            if key:
+                deleted = inspection.reset_keys(key)
+            else:
+                deleted = inspection.reset(
+                    *self._identities(func, period, ip, field))
+        except NotImplementedError as e:
+            raise CommandError(
+                'The backend can\'t reset counters. %s' % e)
+        self.stdout.write('Reset %d counters.' % len(deleted))
@@ -0,0 +1,69 @@
+import json
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from brake import simulate
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay access logs against candidate RATELIMIT_RULES and report '
+        'how many requests and identities each would have limited.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'log', nargs='+',
+            help='CSV or JSON Lines logs, in order; - for standard input.')
+        parser.add_argument(
+            '--config', help='A JSON file mapping candidate names to lists '
+            'of rules. Defaults to RATELIMIT_RULES, as "current".')
+        parser.add_argument(
+            '--format', choices=simulate.FORMATS,
+            help='Defaults to csv for .csv files and jsonl otherwise.')
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='How many processes to spread the counting over.')
+        parser.add_argument(
+            '--shard-by', default='ip',
+            help='The column lines are split between processes by; limits '
+            'keyed by it are counted exactly. Defaults to ip.')
+
+    def _candidates(self, config):
+        if config is None:
+            rules = getattr(settings, 'RATELIMIT_RULES', None)
+            if not rules:
+                raise CommandError(
+                    'Give a --config or set RATELIMIT_RULES.')
+            return {'current': rules}
+        try:
+            with open(config) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            raise CommandError('Can\'t read %s: %s' % (config, e))
+
+    def handle(self, *args, **options):
+        # Options are declared with add_arguments(), which older versions
+        # don't call.
+        if django.VERSION < (1, 8):
+            raise CommandError(
+                'ratelimit_simulate needs Django 1.8 or later.')
+        candidates = self._candidates(options['config'])
+        try:
+            results = simulate.simulate(
+                options['log'], candidates, options['format'],
+                options['processes'], options['shard_by'])
+        except (IOError, KeyError, ValueError) as e:
+            raise CommandError(e)
+
+        self.stdout.write('candidate\trule\trequests\tlimited\tips\tfields')
+        for name in sorted(results):
+            summary = results[name]
+            for rule in sorted(summary['rules']):
+                row = summary['rules'][rule]
+                self.stdout.write('%s\t%s\t%d\t%d\t%d\t%d' % (
+                    name, rule, row['requests'], row['limited'], row['ips'],
+                    row['fields']))
+            self.stdout.write('%s\t*\t%d\t%d\t\t' % (
+                name, summary['requests'], summary['limited']))
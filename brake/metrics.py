@@ -0,0 +1,256 @@
+"""Measurements about rate limiting, for dashboards and capacity planning.
+
+``RATELIMIT_METRICS`` is the path to a ``Metrics`` class that receives them.
+By default they are thrown away before being worked out, so they cost next
+to nothing. ``@ratelimit`` reports:
+
+``checks``
+    One per rate a request was checked against, labelled with
+    ``func_name`` and ``period``. ``func_name`` is the view's name, or the
+    rule's for ``RateLimitMiddleware``, even with ``use_request_path``.
+``limited``
+    One per limit a request ran into, labelled with ``func_name``,
+    ``period`` and ``ratelimited_by`` (``ip`` or ``field``).
+``increments``
+    One per rate a request was counted against, labelled like ``checks``.
+``backend_seconds``
+    How long each backend call took, labelled with the ``backend`` class
+    and the ``method`` called.
+
+``CircuitBreakerBackend`` adds ``breaker_trips`` and ``breaker_recoveries``,
+labelled with the ``backend`` class it protects.
+
+Shadow limits (see ``brake.shadow``) report ``shadow_limited``, labelled
+like ``limited``, and ``shadow_dropped``, labelled with ``func_name``.
+"""
+import threading
+import timeit
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import LazyObject, empty
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+CHECKS = 'checks'
+LIMITED = 'limited'
+INCREMENTS = 'increments'
+BACKEND_SECONDS = 'backend_seconds'
+BREAKER_TRIPS = 'breaker_trips'
+BREAKER_RECOVERIES = 'breaker_recoveries'
+SHADOW_LIMITED = 'shadow_limited'
+SHADOW_DROPPED = 'shadow_dropped'
+
+
+class Metrics(object):
+    """Discards every measurement. Subclasses set ``enabled``."""
+
+    enabled = False
+
+    def increment(self, name, labels, value=1):
+        pass
+
+    def observe(self, name, labels, seconds):
+        pass
+
+
+class InMemoryMetrics(Metrics):
+    """Keeps every measurement in memory, e.g. for tests."""
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.observations = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, labels, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = self._key(name, labels)
+        with self._lock:
+            self.observations.setdefault(key, []).append(seconds)
+
+    def _matching(self, measurements, name, labels):
+        wanted = set(labels.items())
+        return [
+            value for (n, l), value in measurements.items()
+            if n == name and wanted <= set(l)
+        ]
+
+    def count(self, name, **labels):
+        """Return the total of the counters matching the given labels."""
+        return sum(self._matching(self.counters, name, labels))
+
+    def observed(self, name, **labels):
+        """Return every observation matching the given labels."""
+        return [
+            seconds
+            for values in self._matching(self.observations, name, labels)
+            for seconds in values
+        ]
+
+
+# Collectors can only be registered once per registry, but the metrics
+# object is rebuilt whenever a RATELIMIT_* setting changes.
+_prometheus_collectors = {}
+
+
+class PrometheusMetrics(Metrics):
+    """Reports to ``prometheus_client``, prefixed with ``brake_``.
+
+    Counters get a ``_total`` suffix and ``backend_seconds`` is a
+    histogram. Requires the ``prometheus_client`` package.
+    """
+
+    enabled = True
+    registry = None
+
+    def __init__(self):
+        if prometheus_client is None:
+            raise ImproperlyConfigured(
+                'PrometheusMetrics requires the prometheus_client package.')
+        registry = self.registry or prometheus_client.REGISTRY
+        collectors = _prometheus_collectors.get(id(registry))
+        if collectors is None:
+            collectors = _prometheus_collectors[id(registry)] = {
+                CHECKS: prometheus_client.Counter(
+                    'brake_checks', 'Rates requests were checked against.',
+                    ['func_name', 'period'], registry=registry),
+                LIMITED: prometheus_client.Counter(
+                    'brake_limited', 'Limits requests ran into.',
+                    ['func_name', 'period', 'ratelimited_by'],
+                    registry=registry),
+                INCREMENTS: prometheus_client.Counter(
+                    'brake_increments', 'Rates requests were counted against.',
+                    ['func_name', 'period'], registry=registry),
+                BACKEND_SECONDS: prometheus_client.Histogram(
+                    'brake_backend_seconds', 'Time spent in backend calls.',
+                    ['backend', 'method'], registry=registry),
+                BREAKER_TRIPS: prometheus_client.Counter(
+                    'brake_breaker_trips', 'Times the circuit opened.',
+                    ['backend'], registry=registry),
+                BREAKER_RECOVERIES: prometheus_client.Counter(
+                    'brake_breaker_recoveries', 'Times the circuit closed.',
+                    ['backend'], registry=registry),
+                SHADOW_LIMITED: prometheus_client.Counter(
+                    'brake_shadow_limited',
+                    'Limits requests would have run into.',
+                    ['func_name', 'period', 'ratelimited_by'],
+                    registry=registry),
+                SHADOW_DROPPED: prometheus_client.Counter(
+                    'brake_shadow_dropped',
+                    'Requests not checked against shadow limits.',
+                    ['func_name'], registry=registry),
+            }
+        self.collectors = collectors
+
+    def increment(self, name, labels, value=1):
+        self.collectors[name].labels(**labels).inc(value)
+
+    def observe(self, name, labels, seconds):
+        self.collectors[name].labels(**labels).observe(seconds)
+
+
+class _MetricsProxy(LazyObject):
+
+    def _setup(self):
+        # Imported here: brake.decorators imports this module.
+        from brake.decorators import get_class_by_path
+
+        self._wrapped = get_class_by_path(getattr(
+            settings, 'RATELIMIT_METRICS', 'brake.metrics.Metrics'))()
+
+
+_metrics = _MetricsProxy()
+
+
+def _reset_metrics(setting, **kwargs):
+    if setting.startswith('RATELIMIT_'):
+        _metrics._wrapped = empty
+
+setting_changed.connect(_reset_metrics)
+
+
+def start():
+    """Return a start time for the metrics functions, or None if disabled."""
+    if _metrics.enabled:
+        return timeit.default_timer()
+
+
+def _observe(backend, method, started):
+    _metrics.observe(BACKEND_SECONDS, {
+        'backend': backend.__class__.__name__, 'method': method,
+    }, timeit.default_timer() - started)
+
+
+def checked(backend, method, func_name, rates, limits, counted, started,
+        observe=True):
+    """Record a limit check made with ``method``, started at ``started``.
+
+    Pass ``observe=False`` for all but one of several checks made with the
+    same backend call, so its latency is only recorded once.
+    """
+    if started is None:
+        return
+
+    if observe:
+        _observe(backend, method, started)
+    for _, period in rates:
+        labels = {'func_name': func_name, 'period': period}
+        _metrics.increment(CHECKS, labels)
+        if counted:
+            _metrics.increment(INCREMENTS, labels)
+    for limit in limits:
+        _metrics.increment(LIMITED, {
+            'func_name': func_name, 'period': limit['period'],
+            'ratelimited_by': limit['ratelimited_by'],
+        })
+
+
+def counted(backend, method, func_name, rates, started):
+    """Record that a request was counted, after the view ran."""
+    if started is None:
+        return
+
+    _observe(backend, method, started)
+    for _, period in rates:
+        _metrics.increment(
+            INCREMENTS, {'func_name': func_name, 'period': period})
+
+
+def breaker(name, backend):
+    """Record a circuit breaker trip or recovery for ``backend``."""
+    if _metrics.enabled:
+        _metrics.increment(name, {'backend': backend.__class__.__name__})
+
+
+def shadow(name, func_name, limit=None):
+    """Record a shadow limit a request ran into, or a dropped request."""
+    if not _metrics.enabled:
+        return
+
+    labels = {'func_name': func_name}
+    if limit is not None:
+        labels['period'] = limit['period']
+        labels['ratelimited_by'] = limit['ratelimited_by']
+    _metrics.increment(name, labels)
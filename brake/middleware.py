@@ -0,0 +1,243 @@
+"""Rate-limit whole URL spaces, including views you can't decorate.
+
+Add ``brake.middleware.RateLimitMiddleware`` to ``MIDDLEWARE`` and describe
+the limits in ``RATELIMIT_RULES``, a list of dicts with these keys:
+
+``prefix`` or ``pattern``
+    The paths the rule applies to: those starting with ``prefix``, or
+    those matching the regular expression ``pattern`` from their start.
+``rate``
+    A rate like ``'100/m'``, or a list of them, as for ``@ratelimit``.
+``name``
+    The bucket the requests are counted in. Rules with the same name
+    share their counters. Defaults to the prefix or pattern.
+``method``, ``ip``, ``ip_prefix_v4``, ``ip_prefix_v6``, ``ip_exact``,
+``field``, ``field_source``, ``burst``, ``use_request_path``
+    As for ``@ratelimit``.
+``block``
+    Whether to reject requests over the limit, rather than only setting
+    ``request.limited``. Defaults to ``True``.
+``shadow``
+    Whether to only try the rule out, as with ``@ratelimit(shadow=True)``.
+    Defaults to ``False``; ``RATELIMIT_SHADOW`` turns it on for every rule.
+
+Rules are compiled once per process: prefixes into a trie, so finding the
+ones a path starts with costs one step per character of the path, and
+patterns into a single regular expression that most paths fail to match
+in one go, and that names the first pattern a path does match. A request
+is checked against every rule it matches with a single ``hit_buckets()``
+call to the backend, or two when blocking rules limit by fields of a body
+not parsed yet: IP addresses and every other bucket first, then those
+fields only if nothing blocked the request.
+"""
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from brake import metrics
+from brake.decorators import (
+    HttpResponseTooManyRequests, _add_headers, _backend, _split_rate,
+    _staged)
+from brake.backends import with_prefixes, with_source
+from brake.shadow import _shadow
+from brake.signals import ratelimit_exceeded
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:  # Django < 1.10
+    class MiddlewareMixin(object):
+        def __init__(self, get_response=None):
+            self.get_response = get_response
+
+
+# A backslash escape like \1, or a conditional like (?(1)...), naming a
+# group by number. An even run of backslashes before it is escaped.
+_NUMBERED_REFERENCE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d')
+
+
+class Rule(object):
+    """One entry of ``RATELIMIT_RULES``, ready to be matched."""
+
+    def __init__(self, prefix=None, pattern=None, rate='5/m', name=None,
+            method=None, ip=True, field=None, burst=None,
+            use_request_path=False, block=True, shadow=False,
+            field_source=None, ip_prefix_v4=None, ip_prefix_v6=None,
+            ip_exact=False):
+        if (prefix is None) == (pattern is None):
+            raise ImproperlyConfigured(
+                'Each RATELIMIT_RULES entry needs either a prefix or a '
+                'pattern.')
+        self.prefix = prefix
+        self.pattern = pattern
+        self.regex = re.compile(pattern) if pattern is not None else None
+        if not isinstance(rate, (list, tuple)):
+            rate = [rate]
+        self.rates = [_split_rate(r) for r in rate]
+        self.name = name or prefix or pattern
+        if method is not None and not isinstance(method, (list, tuple)):
+            method = [method]
+        self.methods = method
+        self.ip = with_prefixes(ip, ip_prefix_v4, ip_prefix_v6, ip_exact)
+        self.field = with_source(field, field_source)
+        self.burst = burst
+        self.use_request_path = use_request_path
+        self.block = block
+        self.shadow = shadow
+
+    def bucket(self, request):
+        """Return the arguments for the backend's hit_buckets()."""
+        name = request.path if self.use_request_path else self.name
+        return (name, self.ip, self.field, self.rates, self.burst)
+
+
+class RuleTable(object):
+    """Finds the rules that apply to a path."""
+
+    def __init__(self, rules):
+        self.rules = [Rule(**rule) for rule in rules]
+        for index, rule in enumerate(self.rules):
+            rule.index = index
+
+        # Each trie node maps a character to the next node; the rules
+        # whose prefix ends at a node are kept under None.
+        self.trie = {}
+        patterns = []
+        for rule in self.rules:
+            if rule.prefix is None:
+                patterns.append(rule)
+                continue
+            node = self.trie
+            for char in rule.prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(rule)
+
+        # Each pattern is wrapped in a group named after its position, so
+        # a match says which pattern it came from: the patterns before it
+        # didn't match, and only the ones after it still need checking.
+        # Joining patterns renumbers their groups, which would break
+        # numbered backreferences, so those are checked on their own.
+        self.patterns = patterns
+        self.prefilter = None
+        if patterns and not any(
+                _NUMBERED_REFERENCE.search(rule.pattern)
+                for rule in patterns):
+            try:
+                self.prefilter = re.compile('|'.join(
+                    '(?P<_brake_rule%d>%s)' % (position, rule.pattern)
+                    for position, rule in enumerate(patterns)))
+            except re.error:
+                # e.g. the same group name used in two patterns; check
+                # every pattern on its own instead.
+                pass
+
+    def match(self, path, method):
+        """Return the rules for path and method, in settings order."""
+        matched = []
+        node = self.trie
+        for char in path:
+            matched.extend(node.get(None, ()))
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            matched.extend(node.get(None, ()))
+
+        if self.prefilter is not None:
+            found = self.prefilter.match(path)
+            if found is not None:
+                position = int(found.lastgroup[len('_brake_rule'):])
+                matched.append(self.patterns[position])
+                matched.extend(
+                    rule for rule in self.patterns[position + 1:]
+                    if rule.regex.match(path))
+        elif self.patterns:
+            matched.extend(
+                rule for rule in self.patterns if rule.regex.match(path))
+
+        if len(matched) > 1:
+            matched.sort(key=lambda rule: rule.index)
+        return [
+            rule for rule in matched
+            if rule.methods is None or method in rule.methods
+        ]
+
+
+class RateLimitMiddleware(MiddlewareMixin):
+    """Apply ``RATELIMIT_RULES`` to every request."""
+
+    def __init__(self, get_response=None):
+        super(RateLimitMiddleware, self).__init__(get_response)
+        self.table = RuleTable(getattr(settings, 'RATELIMIT_RULES', ()))
+
+    def process_request(self, request):
+        rules = self.table.match(request.path, request.method)
+        if not rules:
+            return None
+
+        if _shadow.everything or any(rule.shadow for rule in rules):
+            live = []
+            for rule in rules:
+                if rule.shadow or _shadow.everything:
+                    name, ip, field, rates, burst = rule.bucket(request)
+                    _shadow.submit(
+                        name, request, ip, field, rates, burst, True,
+                        rule.name)
+                else:
+                    live.append(rule)
+            rules = live
+            if not rules:
+                return None
+
+        buckets = [rule.bucket(request) for rule in rules]
+        started = metrics.start()
+        results = self._hit(request, rules, buckets)
+        blocked = False
+        all_limits = []
+        for i, (rule, (name, _, _, rates, _), limits) in enumerate(
+                zip(rules, buckets, results)):
+            metrics.checked(
+                _backend, 'hit_buckets', rule.name, rates, limits, True,
+                started, observe=i == 0)
+            if limits:
+                blocked = blocked or rule.block
+                all_limits.extend(limits)
+                ratelimit_exceeded.send(
+                    sender=self.__class__, request=request, func_name=name,
+                    limits=limits)
+
+        if all_limits:
+            request.limited = True
+            request.limits = all_limits
+        if blocked:
+            return HttpResponseTooManyRequests()
+        return None
+
+    def _hit(self, request, rules, buckets):
+        """Return the limits of each bucket, staging body fields last."""
+        staged = [
+            _staged(request, ip, field, rule.block)
+            for rule, (_, ip, field, _, _) in zip(rules, buckets)
+        ]
+        if not any(staged):
+            return _backend.hit_buckets(request, buckets)
+
+        results = _backend.hit_buckets(request, [
+            (name, ip, None, rates, burst) if stage else
+            (name, ip, field, rates, burst)
+            for stage, (name, ip, field, rates, burst) in zip(staged, buckets)
+        ])
+        if any(limits and rule.block for rule, limits in zip(rules, results)):
+            return results
+
+        staged = [i for i, stage in enumerate(staged) if stage]
+        for i, limits in zip(staged, _backend.hit_buckets(request, [
+                (name, False, field, rates, burst)
+                for name, _, field, rates, burst in (
+                    buckets[i] for i in staged)])):
+            results[i] = results[i] + limits
+        return results
+
+    def process_response(self, request, response):
+        _add_headers(request, response)
+        return response
@@ -0,0 +1,157 @@
+"""Try out new limits on live traffic without affecting it.
+
+Requests to a view decorated with ``@ratelimit(..., shadow=True)``, or to
+any rate-limited view with ``RATELIMIT_SHADOW = True``, are never limited.
+Instead, what the limit would have decided is worked out after the
+response, on one of ``RATELIMIT_SHADOW_THREADS`` background threads fed by
+a queue of at most ``RATELIMIT_SHADOW_QUEUE_SIZE`` requests. The request
+thread only copies what the backend needs off the request.
+
+Requests that would have been limited are logged to ``brake.shadow`` and
+reported as the ``shadow_limited`` metric. When the queue is full, requests
+are dropped rather than waited for, and counted in ``shadow_dropped``.
+
+Shadow counters are kept apart from live ones, under ``shadow:`` and the
+view's name, so a shadow rate can be tried next to a live one.
+"""
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.utils.functional import LazyObject, empty
+
+from brake import metrics
+from brake.backends import QUERY, field_source, field_value
+
+try:
+    from queue import Full, Queue
+except ImportError:  # Python 2
+    from Queue import Full, Queue
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed
+
+
+logger = logging.getLogger('brake.shadow')
+
+SHADOW_PREFIX = 'shadow:'
+
+
+class ShadowRequest(object):
+    """The parts of a request the backends read, copied off it."""
+
+    def __init__(self, request, field):
+        self.method = request.method
+        self.path = request.path
+        self.META = dict(request.META)
+        self.GET = {}
+        if field is not None:
+            fields = field if isinstance(field, (list, tuple)) else [field]
+            data = getattr(self, self.method, None)
+            if data is None:
+                data = {}
+                setattr(self, self.method, data)
+            for f in fields:
+                source, name = field_source(f)
+                if source == QUERY:
+                    self.GET[name] = request.GET.get(name)
+                elif source is None:
+                    data[name] = field_value(request, f)
+
+
+class ShadowEvaluator(object):
+    """Checks and counts requests against shadow limits in the background."""
+
+    def __init__(self, everything=False, queue_size=1000, threads=1):
+        self.everything = everything
+        self.threads = threads
+        self.queue = Queue(queue_size)
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            # Threads don't survive a fork, so each process starts its own.
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            for _ in range(self.threads):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+
+    def submit(self, func_name, request, ip, field, rates, burst, counted,
+            label=None):
+        """Queue a request to be checked, and counted if ``counted``.
+
+        Metrics are labelled with ``label``, by default ``func_name``.
+        Returns False if the queue was full and the request was dropped.
+        """
+        if self.pid != os.getpid():
+            self._start()
+        label = label or func_name
+        event = (func_name, ShadowRequest(request, field), ip, field,
+            rates, burst, counted, label)
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            metrics.shadow(metrics.SHADOW_DROPPED, label)
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            event = self.queue.get()
+            try:
+                self.evaluate(*event)
+            except Exception:
+                logger.exception('Checking a shadow limit failed.')
+            finally:
+                self.queue.task_done()
+
+    def evaluate(self, func_name, request, ip, field, rates, burst, counted,
+            label=None):
+        """Return the limits the request would have run into."""
+        # Imported here: brake.decorators imports this module.
+        from brake.decorators import _backend
+
+        name = SHADOW_PREFIX + func_name
+        if counted:
+            limits = _backend.hit_many(name, request, ip, field, rates, burst)
+        else:
+            limits = _backend.limit_many(
+                name, request, ip, field, rates, burst)
+        for limit in limits:
+            metrics.shadow(
+                metrics.SHADOW_LIMITED, label or func_name, limit)
+        if limits:
+            logger.info(
+                'Shadow limit for %s would have limited %s: %s',
+                func_name, request.path, limits)
+        return limits
+
+    def wait(self):
+        """Block until every queued request has been checked."""
+        self.queue.join()
+
+
+class _ShadowProxy(LazyObject):
+
+    def _setup(self):
+        self._wrapped = ShadowEvaluator(
+            getattr(settings, 'RATELIMIT_SHADOW', False),
+            getattr(settings, 'RATELIMIT_SHADOW_QUEUE_SIZE', 1000),
+            getattr(settings, 'RATELIMIT_SHADOW_THREADS', 1))
+
+
+_shadow = _ShadowProxy()
+
+
+def _reset_shadow(setting, **kwargs):
+    if setting.startswith('RATELIMIT_SHADOW'):
+        _shadow._wrapped = empty
+
+setting_changed.connect(_reset_shadow)
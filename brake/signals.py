@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+
+# Sent by @ratelimit when a request runs into any of its limits, with the
+# view function as the sender, and ``request``, ``func_name`` and
+# ``limits`` (the limit data the backend returned) as arguments.
+ratelimit_exceeded = Signal()
+
+# Sent by CircuitBreakerBackend when it stops calling the backend it
+# protects (``circuit_opened``) and when that backend works again
+# (``circuit_closed``), with the protected backend as the sender.
+circuit_opened = Signal()
+circuit_closed = Signal()
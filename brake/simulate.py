@@ -0,0 +1,405 @@
+"""Replay access logs against candidate limits, without touching a cache.
+
+Each candidate is a list of rules in ``RATELIMIT_RULES`` form. Log records
+are streamed through them one at a time and counted the way
+``CacheBackend`` would count them: its own key building and counter
+arithmetic, but with the record's timestamp as the clock and a dict as the
+cache. What is reported is how many requests, IP addresses and field
+values each rule would have limited.
+
+Logs are CSV (with a header row) or JSON Lines. The ``timestamp`` (seconds
+since the epoch, or ISO 8601 and UTC unless it says otherwise), ``ip``,
+``path`` and ``method`` columns describe the request; every other column is
+a field value, readable as a form field, a query parameter or a header.
+Records are expected in roughly chronological order.
+
+With several processes, the log is read once and its lines are split
+between them by the value of one column, the IP address by default, without
+being parsed; every process parses, matches and counts its own lines, so
+each record must be on a line of its own. Limits keyed by that column are
+counted exactly.
+``manage.py ratelimit_simulate`` wraps ``simulate()``.
+"""
+import calendar
+import csv
+import json
+import multiprocessing
+import re
+import sys
+import zlib
+
+from django.utils.dateparse import parse_datetime
+
+from brake.backends.cachebe import CacheBackend, PERIOD_PREFIX
+from brake.middleware import RuleTable
+
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+
+COLUMNS = ('timestamp', 'ip', 'path', 'method')
+
+# Expired counters are dropped from memory after this many records.
+PURGE_EVERY = 100000
+
+# Rules matched are remembered per (path, method); logs hold few of those,
+# but the memo is bounded in case paths carry IDs.
+MAX_MATCHES = 10000
+
+# Lines are sent to processes this many at a time, and at most this many
+# batches wait for each process.
+BATCH_SIZE = 1000
+MAX_BATCHES = 16
+
+
+def parse_timestamp(value):
+    """Return seconds since the epoch for a number or an ISO 8601 string."""
+    try:
+        return float(value)
+    except ValueError:
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError('Not a timestamp: %r' % value)
+        return calendar.timegm(moment.utctimetuple()) + \
+            moment.microsecond / 1e6
+
+
+def _identity(key, period):
+    """Return the identity a counter key ends with."""
+    # The identity at the end of a key never contains the period.
+    marker = ':%s%d:' % (PERIOD_PREFIX, period)
+    return key[key.rindex(marker) + len(marker):]
+
+
+def _shard(value, count):
+    return zlib.crc32(value.encode('utf-8')) % count
+
+
+def read_log(lines, format):
+    """Yield a dict per record of a CSV or JSON Lines log."""
+    if format == CSV:
+        return csv.DictReader(lines)
+    return (json.loads(line) for line in lines if line.strip())
+
+
+class LogRequest(object):
+    """The parts of a request the backend reads, from a log record."""
+
+    def __init__(self, record):
+        self.method = (record.get('method') or 'GET').upper()
+        self.path = record.get('path') or '/'
+        self.META = {'REMOTE_ADDR': record.get('ip')}
+        fields = {}
+        for name, value in record.items():
+            if name not in COLUMNS and value not in (None, ''):
+                fields[name] = value if isinstance(value, str) else \
+                    str(value)
+                self.META['HTTP_' + name.upper().replace('-', '_')] = \
+                    fields[name]
+        self.GET = fields
+        setattr(self, self.method, fields)
+
+
+class Simulation(object):
+    """One candidate's rules, counted like ``CacheBackend`` counts them."""
+
+    def __init__(self, rules, backend):
+        self.table = RuleTable(rules)
+        self.backend = backend
+        self.store = {}
+        self.matches = {}
+        self.fed = 0
+        self.matched = 0
+        self.requests = {}
+        self.limited = {}
+        self.identities = {}
+
+    def _get(self, rate_keys, now):
+        values = {}
+        for key, _, _ in rate_keys:
+            entry = self.store.get(key)
+            if entry is not None and entry[1] > now:
+                values[key] = entry[0]
+        return values
+
+    def _set(self, updates, now):
+        for timeout, values in updates.items():
+            for key, value in values.items():
+                self.store[key] = (value, now + timeout)
+
+    def purge(self, now):
+        """Forget the counters that have expired."""
+        self.store = dict(
+            (key, entry) for key, entry in self.store.items()
+            if entry[1] > now)
+
+    def match(self, request):
+        """Return the buckets a request is counted in, and tally it."""
+        rules = self.matches.get((request.path, request.method))
+        if rules is None:
+            if len(self.matches) >= MAX_MATCHES:
+                self.matches.clear()
+            rules = self.matches[request.path, request.method] = \
+                self.table.match(request.path, request.method)
+        if rules:
+            self.matched += 1
+        buckets = [rule.bucket(request) for rule in rules]
+        for name, _, _, _, _ in buckets:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        return buckets
+
+    def feed(self, number, request, now):
+        """Count the request numbered number, seen at now."""
+        self.fed += 1
+        if self.fed % PURGE_EVERY == 0:
+            self.purge(now)
+        buckets = self.match(request)
+        if not buckets:
+            return
+
+        backend = self.backend
+        rate_keys, ends = backend._bucket_rate_keys(
+            request, buckets, backend._rate_keys)
+        counters = backend._decode_counters(
+            rate_keys, self._get(rate_keys, now), now)
+        self._set(backend._counter_updates(counters, now), now)
+
+        for (name, _, _, _, _), (field, bucket_counters) in zip(
+                buckets, backend._split(buckets, ends, counters)):
+            limits = backend._limits(bucket_counters, request, field, now, 1)
+            if not limits:
+                continue
+            self.limited.setdefault(name, set()).add(number)
+            identities = self.identities.setdefault(name, set())
+            for limit in limits:
+                identities.add((
+                    limit['ratelimited_by'],
+                    _identity(limit['cache_key'], limit['period'])))
+
+    def results(self):
+        return {
+            'matched': self.matched,
+            'requests': self.requests,
+            'limited': self.limited,
+            'identities': self.identities,
+        }
+
+
+def _lines(path):
+    if path == '-':
+        return sys.stdin
+    return open(path)
+
+
+def _format(path, format=None):
+    return format or (CSV if path.endswith('.csv') else JSONL)
+
+
+def records(paths, format=None):
+    """Yield every record of the logs at paths; '-' is standard input."""
+    for path in paths:
+        lines = _lines(path)
+        try:
+            for record in read_log(lines, _format(path, format)):
+                yield record
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+
+
+def _simulations(candidates):
+    backend = CacheBackend()
+    backend.setup()
+    return dict(
+        (name, Simulation(rules, backend))
+        for name, rules in candidates.items())
+
+
+def _replay(simulations, numbered):
+    """Feed (number, record) pairs through every simulation."""
+    for number, record in numbered:
+        request = LogRequest(record)
+        now = parse_timestamp(record['timestamp'])
+        for simulation in simulations.values():
+            simulation.feed(number, request, now)
+
+
+def _run(paths, candidates, format=None):
+    """Replay the logs through every candidate in a single pass."""
+    simulations = _simulations(candidates)
+    _replay(simulations, enumerate(records(paths, format)))
+    return dict(
+        (name, simulation.results())
+        for name, simulation in simulations.items())
+
+
+def _column(format, header, name):
+    """Return a function finding column name in a raw line, unparsed.
+
+    Quoted CSV values holding commas and escaped JSON strings can throw it
+    off; that only sends a line to another process.
+    """
+    if format == CSV:
+        columns = next(csv.reader([header]))
+        if name not in columns:
+            raise ValueError('The log has no %s column.' % name)
+        index = columns.index(name)
+
+        def _cell(line):
+            cells = line.split(',', index + 1)
+            return cells[index].strip().strip('"') if index < len(cells) \
+                else ''
+        return _cell
+
+    pattern = re.compile(r'"%s"\s*:\s*"?([^",}]*)' % re.escape(name))
+
+    def _value(line):
+        found = pattern.search(line)
+        return found.group(1) if found else ''
+    return _value
+
+
+def _count_lines(candidates, batches, results):
+    """Count the lines sent to one process, until a None batch.
+
+    Batches are (format, header, [(number, line)]). Errors are sent back
+    instead of results, once every batch has been taken off the queue so
+    the reader doesn't block.
+    """
+    simulations = _simulations(candidates)
+    error = None
+    for format, header, lines in iter(batches.get, None):
+        if error is not None:
+            continue
+        raw = [line for _, line in lines]
+        if header is not None:
+            raw.insert(0, header)
+        try:
+            _replay(simulations, zip(
+                [number for number, _ in lines], read_log(raw, format)))
+        except Exception as e:
+            error = e
+    if error is not None:
+        results.put((None, error))
+    else:
+        results.put((dict(
+            (name, simulation.results())
+            for name, simulation in simulations.items()), None))
+
+
+def _split(paths, format, shard_by, queues):
+    """Read the logs once, sending each line where its shard_by value goes.
+
+    Lines are numbered across all of the logs, and not parsed here.
+    """
+    count = len(queues)
+    number = 0
+    for path in paths:
+        lines = _lines(path)
+        try:
+            line_format = _format(path, format)
+            header = None
+            if line_format == CSV:
+                header = next(lines, None)
+                if header is None:
+                    continue
+            value = _column(line_format, header, shard_by)
+            batches = [[] for _ in queues]
+            for line in lines:
+                if not line.strip():
+                    continue
+                index = _shard(value(line), count)
+                batches[index].append((number, line))
+                number += 1
+                if len(batches[index]) >= BATCH_SIZE:
+                    queues[index].put((line_format, header, batches[index]))
+                    batches[index] = []
+            for queue, batch in zip(queues, batches):
+                if batch:
+                    queue.put((line_format, header, batch))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+    for queue in queues:
+        queue.put(None)
+
+
+def _merge(shards):
+    """Combine the results of the processes for one candidate."""
+    merged = {'matched': 0, 'requests': {}, 'limited': {}, 'identities': {}}
+    for shard in shards:
+        merged['matched'] += shard['matched']
+        for rule, requests in shard['requests'].items():
+            merged['requests'][rule] = \
+                merged['requests'].get(rule, 0) + requests
+        for name in ('limited', 'identities'):
+            for rule, values in shard[name].items():
+                merged[name].setdefault(rule, set()).update(values)
+    return merged
+
+
+def _summary(results):
+    """Turn the sets of limited requests and identities into counts."""
+    rules = {}
+    for rule, requests in results['requests'].items():
+        identities = results['identities'].get(rule, ())
+        rules[rule] = {
+            'requests': requests,
+            'limited': len(results['limited'].get(rule, ())),
+            'ips': sum(1 for by, _ in identities if by == 'ip'),
+            'fields': sum(1 for by, _ in identities if by == 'field'),
+        }
+    limited = set()
+    for numbers in results['limited'].values():
+        limited.update(numbers)
+    return {
+        'requests': results['matched'],
+        'limited': len(limited),
+        'rules': rules,
+    }
+
+
+def simulate(paths, candidates, format=None, processes=1, shard_by='ip'):
+    """Replay logs against candidates, a dict of name to rule dicts.
+
+    Returns {candidate: summary}. A summary has the number of ``requests``
+    any rule matched and how many of them were ``limited``, and under
+    ``rules`` the same by rule name along with the number of distinct
+    ``ips`` and ``fields`` values that were limited.
+
+    With several ``processes``, lines are split between them by their
+    ``shard_by`` column. Only limits keyed by that column are counted
+    exactly: any other counter is kept by every process for its own lines.
+    """
+    if processes > 1:
+        queues = [
+            multiprocessing.Queue(MAX_BATCHES) for _ in range(processes)]
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=_count_lines, args=(candidates, queue, results))
+            for queue in queues
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        shards = None
+        try:
+            _split(paths, format, shard_by, queues)
+            shards = [results.get() for _ in workers]
+        finally:
+            for worker in workers:
+                if shards is None:
+                    worker.terminate()
+                worker.join()
+        for _, error in shards:
+            if error is not None:
+                raise error
+        return dict(
+            (name, _summary(_merge([shard[name] for shard, _ in shards])))
+            for name in candidates)
+
+    return dict(
+        (name, _summary(results))
+        for name, results in _run(paths, candidates, format).items())
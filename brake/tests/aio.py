@@ -0,0 +1,134 @@
+import asyncio
+
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from brake import metrics, shadow
+from brake.backends.asyncbe import AsyncAtomicCacheBackend
+from brake.decorators import ratelimit
+from brake.tests.tests import (
+    CountingCacheMixin, FakeRequest, RateLimitTestCase)
+
+
+@ratelimit(method='POST', rate='1/m', block=True)
+@ratelimit(method='POST', rate='10/h', block=True)
+async def fake_async_view(request):
+    return HttpResponse()
+
+
+@ratelimit(method='POST', rate='5/m', increment=lambda req, resp: True)
+async def fake_async_increment(request):
+    return HttpResponse()
+
+
+@ratelimit(method='POST', rate='1/m', block=True, shadow=True)
+async def fake_async_shadowed(request):
+    return HttpResponse()
+
+
+@ratelimit(field='username', method='POST', rate='1/m', block=True)
+async def fake_async_staged(request):
+    return HttpResponse()
+
+
+@ratelimit(rate=None, max_concurrent=1, block=True)
+async def fake_async_export(request):
+    if getattr(request, 'during', None) is not None:
+        request.inner = await fake_async_export(request.during)
+    return HttpResponse()
+
+
+class TestAsyncViews(CountingCacheMixin, RateLimitTestCase):
+
+    def _post(self, view):
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        request.POST = {}
+        return asyncio.run(view(request))
+
+    def test_view_is_awaited_and_limited(self):
+        self.assertTrue(asyncio.iscoroutinefunction(fake_async_view))
+        self.assertEqual(fake_async_view._ratelimit['rates'],
+            [(10, 3600), (1, 60)])
+        self.assertEqual(self._post(fake_async_view).status_code, 200)
+        self.assertEqual(self._post(fake_async_view).status_code, 429)
+
+    def test_sync_backends_run_in_a_thread(self):
+        self._post(fake_async_view)
+        self.assertEqual(
+            self.counting_cache.calls, ['get_many', 'set_many', 'set_many'])
+
+    def test_increment(self):
+        self._post(fake_async_increment)
+        self.assertEqual(
+            self.counting_cache.calls, ['get_many', 'get_many', 'set_many'])
+
+    def test_native_async_backend(self):
+        path = 'brake.backends.asyncbe.AsyncCacheBackend'
+        with override_settings(RATELIMIT_CACHE_BACKEND=path):
+            self.assertEqual(self._post(fake_async_view).status_code, 200)
+            self.assertEqual(self._post(fake_async_view).status_code, 429)
+        self.assertEqual(self.counting_cache.calls[:3],
+            ['aget_many', 'aset_many', 'aset_many'])
+
+    def test_native_async_atomic_backend(self):
+        path = 'brake.backends.asyncbe.AsyncAtomicCacheBackend'
+        with override_settings(
+                RATELIMIT_CACHE_BACKEND=path,
+                RATELIMIT_ALGORITHM='sliding-window'):
+            self.assertEqual(self._post(fake_async_view).status_code, 200)
+            self.assertEqual(self._post(fake_async_view).status_code, 429)
+            self.assertEqual(self._post(fake_async_increment).status_code,
+                200)
+        self.assertEqual(
+            set(self.counting_cache.calls), set(['aget_many', 'aincr', 'aadd']))
+
+    def test_sliding_window_reads_both_windows_at_once(self):
+        with override_settings(RATELIMIT_ALGORITHM='sliding-window'):
+            backend = AsyncAtomicCacheBackend()
+            backend.setup()
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        asyncio.run(backend.alimit_many(
+            'fake_login', request, rates=[(5, 60), (10, 3600)]))
+        self.assertEqual(self.counting_cache.calls, ['aget_many'])
+
+    def test_metrics(self):
+        with override_settings(
+                RATELIMIT_METRICS='brake.metrics.InMemoryMetrics'):
+            self._post(fake_async_increment)
+            collected = metrics._metrics._wrapped
+        self.assertEqual(collected.count(
+            metrics.CHECKS, func_name='fake_async_increment'), 1)
+        self.assertEqual(collected.count(
+            metrics.INCREMENTS, func_name='fake_async_increment'), 1)
+        self.assertEqual(len(collected.observed(
+            metrics.BACKEND_SECONDS, method='count_many')), 1)
+
+    def test_shadow(self):
+        for _ in range(3):
+            self.assertEqual(self._post(fake_async_shadowed).status_code, 200)
+        shadow._shadow.wait()
+        self.assertEqual(self.stored_count(
+            'rl:func:shadow:fake_async_shadowed:period:60:ip:10.0.0.1'), 4)
+
+    def test_blocked_by_ip_never_parses_the_body(self):
+        for i in range(3):
+            request = RequestFactory().post(
+                '/login/', {'username': 'user%d' % i}, REMOTE_ADDR='10.0.0.1')
+            response = asyncio.run(fake_async_staged(request))
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(hasattr(request, '_post'))
+
+    def test_max_concurrent(self):
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        request.during = FakeRequest()
+        request.during.META = request.META
+        self.assertEqual(
+            asyncio.run(fake_async_export(request)).status_code, 200)
+        self.assertEqual(request.inner.status_code, 429)
+        request.during = None
+        self.assertEqual(
+            asyncio.run(fake_async_export(request)).status_code, 200)
@@ -1,10 +1,59 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
 import time
 
 import unittest
-from django.core.cache import cache
+from functools import wraps
+import django
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 
+from brake.backends import IPPrefixes, _networks, cachebe
+from brake.backends.cachebe import (
+    AtomicCacheBackend, CacheBackend, SLIDING_WINDOW, VERSION_SHIFT)
+from brake.backends import gcrabe
+from brake.backends.gcrabe import GCRABackend
+from brake.backends import breakerbe
+from brake.backends.breakerbe import CircuitBreakerBackend
+from brake.backends.dummybe import DummyBackend
+from brake.backends import localbe
+from brake.backends.localbe import LocalCache, TieredBackend
+from brake.backends.redisbe import RedisBackend
+from brake.backends.sharding import HashRing, ShardedCache
+from brake.backends.sketchbe import SketchBackend
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+from brake import inspection, metrics, shadow, simulate
+from brake.middleware import RateLimitMiddleware, RuleTable
+from brake.signals import (
+    circuit_closed, circuit_opened, ratelimit_exceeded)
+from brake import decorators
 from brake.decorators import ratelimit
+from brake.management.commands import ratelimit as ratelimit_command
+from brake.management.commands import ratelimit_simulate
+from brake.tests.custom_backend import MyBrake
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 
 class MockRLKeys(object):
@@ -15,6 +64,70 @@ class RateLimitError(Exception):
     pass
 
 
+class FakeClock(object):
+    """Stands in for the time module so tests control what now is."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class CountingCache(object):
+    """Wraps a cache and records the name of every method called on it."""
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if not callable(attr):
+            return attr
+
+        def _counted(*args, **kwargs):
+            self.calls.append(name)
+            return attr(*args, **kwargs)
+
+        return _counted
+
+
+class CountingCacheMixin(object):
+    """Wraps the backends' cache in a CountingCache for each test."""
+
+    def setUp(self):
+        super(CountingCacheMixin, self).setUp()
+        self.counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = self.counting_cache
+
+    def tearDown(self):
+        cachebe.cache = self.counting_cache._cache
+        super(CountingCacheMixin, self).tearDown()
+
+
+class SlowCache(object):
+    """Wraps a cache, making every call slow or fail on demand."""
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.delay = 0
+        self.broken = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if not callable(attr):
+            return attr
+
+        def _slow(*args, **kwargs):
+            time.sleep(self.delay)
+            if self.broken:
+                raise IOError('cache is down')
+            return attr(*args, **kwargs)
+
+        return _slow
+
+
 class FakeRequest(object):
     """A simple request stub."""
     method = 'POST'
@@ -110,6 +223,10 @@ class RateLimitTestCase(unittest.TestCase):
                 count
             )
 
+    def stored_count(self, key):
+        """Returns the count CacheBackend has stored under key."""
+        return CacheBackend()._decode(cache.get(key), 60, time.time())[0]
+
     def setUp(self):
         super(RateLimitTestCase, self).setUp()
         self.client = FakeClient()
@@ -177,7 +294,7 @@ class TestRateLimiting(RateLimitTestCase):
         self.client.post(fake_login, self.good_payload)
 
         for test_key in self.FAKE_LOGIN_CACHE_KEYS:
-            self.assertEqual(cache.get(test_key)[0], 5)
+            self.assertEqual(self.stored_count(test_key), 5)
 
     def test_expiration_ttl_set_correctly(self):
         """Ensure our cache TTLs are set correctly."""
@@ -306,5 +423,2090 @@ class TestRateLimiting(RateLimitTestCase):
         # These are the cache keys that are specified by the decorator
         # for this view.
         for key in self.FAKE_LOGIN_CACHE_KEYS:
-            self.assertTrue(cache.get(key)[0] > 1)
+            self.assertTrue(self.stored_count(key) > 1)
+
+
+
+class TestAtomicCacheBackend(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestAtomicCacheBackend, self).setUp()
+        self.backend = AtomicCacheBackend()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.request.POST = {'username': 'user'}
+
+    def _counts(self, period=60):
+        keys = self.backend._window_keys(
+            'fake_login', self.request, field='username', period=period)
+        return [cache.get(key) for key in keys]
+
+    def test_counters_are_plain_integers(self):
+        self.backend.count('fake_login', self.request, field='username')
+        self.backend.count('fake_login', self.request, field='username')
+        self.assertEqual(self._counts(), [2, 2])
+
+    def test_window_is_part_of_the_key(self):
+        keys = self.backend._window_keys(
+            'fake_login', self.request, period=60, now=125)
+        self.assertEqual(
+            keys, ['rl:func:fake_login:period:60:ip:10.0.0.1:window:120'])
+
+    def test_limit(self):
+        for _ in range(5):
+            self.assertEqual(self.backend.limit(
+                'fake_login', self.request, field='username', count=5,
+                period=60), [])
+            self.backend.count('fake_login', self.request, field='username')
+
+        limits = self.backend.limit(
+            'fake_login', self.request, field='username', count=5, period=60)
+        self.assertEqual(
+            sorted(l['ratelimited_by'] for l in limits), ['field', 'ip'])
+        self.assertEqual([l['count'] for l in limits], [6, 6])
+
+    def test_lets_in_as_many_as_cache_backend(self):
+        for backend in (CacheBackend(), self.backend):
+            cache.clear()
+            self.assertEqual([
+                bool(backend.hit('fake_login', self.request, count=2,
+                    period=60))
+                for _ in range(3)
+            ], [False, False, True])
+
+    def test_concurrent_increments_are_not_lost(self):
+        """Many writers hitting the same counters must not drop updates."""
+        workers, hits = 8, 50
+
+        def hammer():
+            for _ in range(hits):
+                self.backend.count(
+                    'fake_login', self.request, field='username')
+
+        threads = [threading.Thread(target=hammer) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self._counts(), [workers * hits] * 2)
+
+
+class TestHit(CountingCacheMixin, RateLimitTestCase):
+
+    def setUp(self):
+        super(TestHit, self).setUp()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.request.POST = {'username': 'user'}
+
+    def test_hit_counts_and_limits(self):
+        backend = CacheBackend()
+        for _ in range(5):
+            self.assertEqual(backend.hit(
+                'fake_login', self.request, field='username', count=5,
+                period=60), [])
+
+        limits = backend.hit(
+            'fake_login', self.request, field='username', count=5, period=60)
+        self.assertEqual(len(limits), 2)
+        self.assertEqual([l['count'] for l in limits], [6, 6])
+
+    def test_hit_round_trips(self):
+        """One read and one write no matter how many keys are involved."""
+        CacheBackend().hit(
+            'fake_login', self.request, field='username', count=5, period=60)
+        self.assertEqual(self.counting_cache.calls, ['get_many', 'set_many'])
+
+    def test_atomic_hit(self):
+        backend = AtomicCacheBackend()
+        for _ in range(5):
+            self.assertEqual(backend.hit(
+                'fake_login', self.request, count=5, period=60), [])
+        self.assertEqual(
+            len(backend.hit('fake_login', self.request, count=5, period=60)),
+            1
+        )
+        self.assertNotIn('get_many', self.counting_cache.calls)
+
+    def test_decorator_uses_hit_without_increment(self):
+        rl = ratelimit(method='POST', rate='5/m')
+        self.client.post(rl(fake_login_use_request_path), {})
+        self.assertEqual(self.counting_cache.calls, ['get_many', 'set_many'])
+
+    def test_blocked_requests_are_counted_without_increment(self):
+        key = 'rl:func:fake_login_use_request_path:period:60:ip:10.0.0.1'
+        for increment, requests in [
+                (None, 3), (lambda request, response: True, 1)]:
+            cache.clear()
+            view = ratelimit(rate='1/m', block=True, increment=increment)(
+                fake_login_use_request_path)
+            self.assertEqual(
+                [view(self.request).status_code for _ in range(3)],
+                [200, 429, 429])
+            self.assertEqual(self.stored_count(key), requests + 1)
+
+
+class TestBackendResolution(RateLimitTestCase):
+
+    def test_backend_is_shared(self):
+        self.client.post(fake_login_no_exception, {'username': 'user'})
+        first = decorators._backend._wrapped
+        self.assertIsInstance(first, MyBrake)
+        self.client.post(fake_login_no_exception, {'username': 'user'})
+        self.assertIs(decorators._backend._wrapped, first)
+
+    def test_backend_is_rebuilt_when_setting_changes(self):
+        path = 'brake.backends.cachebe.AtomicCacheBackend'
+        with override_settings(RATELIMIT_CACHE_BACKEND=path):
+            self.client.post(fake_login_no_exception, {'username': 'user'})
+            self.assertIsInstance(
+                decorators._backend._wrapped, AtomicCacheBackend)
+        self.client.post(fake_login_no_exception, {'username': 'user'})
+        self.assertIsInstance(decorators._backend._wrapped, MyBrake)
+
+    def test_utils_share_the_backend(self):
+        from brake import utils
+        self.assertIs(utils._backend, decorators._backend)
+
+
+class TestMultipleRates(CountingCacheMixin, RateLimitTestCase):
+
+    def test_stacked_decorators_are_merged(self):
+        self.assertEqual(
+            fake_login._ratelimit['rates'], [(20, 86400), (10, 3600), (5, 60)])
+        self.assertIs(fake_login.__wrapped__, fake_login._ratelimit['fn'])
+
+    def test_different_options_are_not_merged(self):
+        view = ratelimit(block=True)(ratelimit(rate='10/h')(
+            fake_login_use_request_path))
+        self.assertEqual(view._ratelimit['rates'], [(5, 60)])
+
+    def test_decorators_in_between_are_kept(self):
+        def login_required(fn):
+            @wraps(fn)
+            def _wrapped(request):
+                if not getattr(request, 'user', None):
+                    return HttpResponse('login', status=302)
+                return fn(request)
+            return _wrapped
+
+        @ratelimit(rate='100/m')
+        @login_required
+        @ratelimit(rate='1000/h')
+        def view(request):
+            return HttpResponse('secret')
+
+        self.assertEqual(view._ratelimit['rates'], [(100, 60)])
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        request.POST = {}
+        response = view(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.content, b'login')
+
+    def test_rate_list(self):
+        view = ratelimit(
+            method='POST', rate=['1/m', '10/h', '100/d'], block=True
+        )(fake_login_use_request_path)
+        self.assertEqual(self.client.post(view, {}).status_code, 200)
+        # One read, and one write per TTL since Django's set_many can only
+        # apply a single timeout.
+        self.assertEqual(
+            self.counting_cache.calls, ['get_many'] + ['set_many'] * 3)
+        self.assertEqual(self.client.post(view, {}).status_code, 429)
+
+    def test_stacked_rates_share_one_round_trip(self):
+        self.client.post(fake_login, {'username': 'user'})
+        self.assertEqual(
+            self.counting_cache.calls, ['get_many'] + ['set_many'] * 3)
+        for key in self.FAKE_LOGIN_CACHE_KEYS[3:]:
+            self.assertEqual(self.stored_count(key), 2)
+
+    def test_utils_batch_periods(self):
+        from brake import utils
+        request = FakeRequest()
+        request.POST = {'username': 'user'}
+        utils.inc_counts(request, 'fake_login', 'username', self.PERIODS)
+        self.assertEqual(utils.get_limits(
+            request, 'fake_login', 'username', self.PERIODS), [])
+        self.assertEqual(
+            self.counting_cache.calls,
+            ['get_many'] + ['set_many'] * 3 + ['get_many'])
+
+
+class TestHeaders(CountingCacheMixin, RateLimitTestCase):
+
+    def _post(self, view):
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        request.POST = {}
+        return view(request)
+
+    def _view(self, **kwargs):
+        kwargs.setdefault('rate', '3/m')
+        return ratelimit(block=True, **kwargs)(fake_login_use_request_path)
+
+    def test_headers(self):
+        view = self._view()
+        response = self._post(view)
+        self.assertEqual(response['RateLimit-Limit'], '3')
+        self.assertEqual(response['RateLimit-Remaining'], '2')
+        self.assertEqual(response['RateLimit-Reset'], '60')
+        self.assertFalse(response.has_header('Retry-After'))
+        self.assertEqual(self.counting_cache.calls, ['get_many', 'set_many'])
+
+        response = self._post(view)
+        self.assertEqual(response['RateLimit-Remaining'], '1')
+        response = self._post(view)
+        self.assertEqual(response['RateLimit-Remaining'], '0')
+        response = self._post(view)
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response['Retry-After']) <= 60)
+
+    def test_tightest_rate_is_reported(self):
+        response = self._post(self._view(rate=['100/m', '2/h']))
+        self.assertEqual(response['RateLimit-Limit'], '2')
+        self.assertEqual(response['RateLimit-Reset'], '3600')
+
+    def test_counted_after_the_view(self):
+        response = self._post(self._view(increment=lambda req, resp: True))
+        self.assertEqual(response['RateLimit-Remaining'], '2')
+
+    def test_atomic_backend(self):
+        clock = FakeClock(6030)
+        cachebe.time = clock
+        try:
+            with override_settings(RATELIMIT_CACHE_BACKEND=(
+                    'brake.backends.cachebe.AtomicCacheBackend')):
+                response = self._post(self._view())
+        finally:
+            cachebe.time = time
+        self.assertEqual(response['RateLimit-Reset'], '30')
+
+    def test_gcra_backend(self):
+        with override_settings(
+                RATELIMIT_CACHE_BACKEND='brake.backends.gcrabe.GCRABackend'):
+            view = self._view(rate='6/m', burst=1)
+            response = self._post(view)
+            self.assertEqual(response['RateLimit-Remaining'], '0')
+            self.assertEqual(response['RateLimit-Reset'], '10')
+            response = self._post(view)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '10')
+
+    def test_disabled(self):
+        with override_settings(RATELIMIT_HEADERS=False):
+            response = self._post(self._view())
+        self.assertFalse(response.has_header('RateLimit-Limit'))
+
+
+class TestKeys(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestKeys, self).setUp()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.request.POST = {'username': 'alice'}
+
+    def _keys(self, backend, rates=((5, 60), (10, 3600))):
+        return backend._rate_keys(
+            'fake_login', self.request, True, 'username', list(rates))
+
+    def test_key_prefixes_are_formatted_once(self):
+        backend = CacheBackend()
+        rates = ((5, 60), (10, 3600))
+        self.assertTrue(backend._prefixes_for('fake_login', rates) is
+            backend._prefixes_for('fake_login', rates))
+        keys = self._keys(backend)
+        self.assertEqual([key for key, _, _ in keys], [
+            'rl:func:fake_login:period:60:ip:10.0.0.1',
+            'rl:func:fake_login:period:60:field:username:%s' %
+                hashlib.sha1(b'alice').hexdigest(),
+            'rl:func:fake_login:period:3600:ip:10.0.0.1',
+            'rl:func:fake_login:period:3600:field:username:%s' %
+                hashlib.sha1(b'alice').hexdigest(),
+        ])
+
+    def test_keys_follow_the_request(self):
+        backend = CacheBackend()
+        keys = self._keys(backend)
+        self.request.POST = {'username': 'bob'}
+        self.assertNotEqual(self._keys(backend), keys)
+        self.request.META = {'REMOTE_ADDR': '10.0.0.2'}
+        self.assertEqual(
+            self._keys(backend, [(5, 60)])[0][0],
+            'rl:func:fake_login:period:60:ip:10.0.0.2')
+
+    def test_field_hash(self):
+        with override_settings(RATELIMIT_FIELD_HASH='blake2b'):
+            backend = CacheBackend()
+            backend.setup()
+        self.assertEqual(
+            self._keys(backend, [(5, 60)])[1][0],
+            'rl:func:fake_login:period:60:field:username:%s' %
+                hashlib.blake2b(b'alice', digest_size=16).hexdigest())
+
+    def test_previous_field_hash_is_kept_up(self):
+        with override_settings(
+                RATELIMIT_FIELD_HASH='blake2b',
+                RATELIMIT_PREVIOUS_FIELD_HASH='sha1'):
+            backend = CacheBackend()
+            backend.setup()
+        keys = [key for key, _, _ in self._keys(backend, [(5, 60)])]
+        self.assertEqual(len(keys), 3)
+        self.assertTrue(keys[2].endswith(
+            hashlib.sha1(b'alice').hexdigest()))
+
+        # Counters under the old digest still limit during the migration.
+        cache.set(keys[2], (10, time.time() + 60))
+        self.assertTrue(backend.limit_many(
+            'fake_login', self.request, True, 'username', [(5, 60)]))
+
+    def test_unknown_field_hash(self):
+        from django.core.exceptions import ImproperlyConfigured
+        with override_settings(RATELIMIT_FIELD_HASH='md4'):
+            self.assertRaises(ImproperlyConfigured, CacheBackend().setup)
+
+
+class TestCounterEncoding(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestCounterEncoding, self).setUp()
+        self.backend = CacheBackend()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.key = self.backend._keys(
+            'fake_login', self.request, period=60)[0]
+
+    def _count(self):
+        self.backend.count('fake_login', self.request, period=60)
+
+    def test_counters_are_packed_integers(self):
+        now = time.time()
+        self._count()
+        value = cache.get(self.key)
+        self.assertTrue(isinstance(value, int))
+        count, expiration = self.backend._decode(value, 60, now)
+        self.assertEqual(count, 2)
+        self.assertTrue(now + 59 <= expiration <= now + 60)
+
+    def test_packed_counters_can_be_incremented(self):
+        self._count()
+        _, expiration = self.backend._decode(cache.get(self.key), 60, 0)
+        cache.incr(self.key, 3)
+        self.assertEqual(
+            self.backend._decode(cache.get(self.key), 60, 0),
+            (5, expiration))
+
+    def test_old_values_are_read_and_rewritten(self):
+        expiration = int(time.time()) + 30
+        for old in [4, (4, expiration)]:
+            cache.set(self.key, old)
+            self.assertTrue(self.backend.limit(
+                'fake_login', self.request, count=3, period=60))
+            self._count()
+            self.assertEqual(self.stored_count(self.key), 5)
+            self.assertTrue(isinstance(cache.get(self.key), int))
+        self.assertEqual(
+            self.backend._decode(cache.get(self.key), 60, 0)[1], expiration)
+
+    def test_values_that_are_not_counters_are_ignored(self):
+        for value in [1012.5, 'x', (1, 2, 3), 2 << VERSION_SHIFT]:
+            self.assertEqual(
+                self.backend._decode(value, 60, 1000), (None, 1060))
+
+    def test_legacy_encoding(self):
+        with override_settings(RATELIMIT_COUNTER_ENCODING='legacy'):
+            self.backend.setup()
+        self._count()
+        self.assertEqual(cache.get(self.key)[0], 2)
+
+    def test_unknown_encoding(self):
+        from django.core.exceptions import ImproperlyConfigured
+        with override_settings(RATELIMIT_COUNTER_ENCODING='json'):
+            self.assertRaises(ImproperlyConfigured, self.backend.setup)
+
+
+class PrometheusTestMetrics(metrics.PrometheusMetrics):
+    if prometheus_client is not None:
+        registry = prometheus_client.CollectorRegistry()
+
+
+class TestMetrics(RateLimitTestCase):
+
+    def _post(self, times):
+        for _ in range(times):
+            self.client.post(
+                fake_login_no_exception, {'username': 'metrics'},
+                {'REMOTE_ADDR': '10.0.0.3'})
+
+    def test_disabled_by_default(self):
+        self.assertFalse(metrics._metrics.enabled)
+        self.assertEqual(metrics.start(), None)
+
+    def test_in_memory(self):
+        with override_settings(
+                RATELIMIT_METRICS='brake.metrics.InMemoryMetrics'):
+            self._post(12)
+            collected = metrics._metrics._wrapped
+
+        labels = {'func_name': 'fake_login_no_exception', 'period': 60}
+        self.assertEqual(collected.count(metrics.CHECKS, **labels), 12)
+        self.assertEqual(collected.count(metrics.INCREMENTS, **labels), 12)
+        self.assertEqual(collected.count(
+            metrics.LIMITED, ratelimited_by='field', **labels), 2)
+        self.assertEqual(collected.count(
+            metrics.LIMITED, ratelimited_by='ip', **labels), 2)
+        self.assertEqual(len(collected.observed(
+            metrics.BACKEND_SECONDS, backend='MyBrake', method='hit_many')),
+            12)
+
+    def test_request_paths_are_not_labels(self):
+        view = ratelimit(use_request_path=True, rate='5/m')(
+            fake_login_use_request_path)
+        with override_settings(
+                RATELIMIT_METRICS='brake.metrics.InMemoryMetrics'):
+            for path in ('/items/1', '/items/2'):
+                request = FakeRequest()
+                request.path = path
+                request.POST = {}
+                view(request)
+            collected = metrics._metrics._wrapped
+
+        self.assertEqual(set(labels for _, labels in collected.counters), set([
+            (('func_name', 'fake_login_use_request_path'), ('period', 60)),
+        ]))
+        self.assertEqual(collected.count(
+            metrics.CHECKS, func_name='fake_login_use_request_path'), 2)
+
+    def test_signal(self):
+        received = []
+
+        def receiver(sender, request, func_name, limits, **kwargs):
+            received.append((sender, func_name, len(limits)))
+
+        ratelimit_exceeded.connect(receiver)
+        try:
+            self._post(10)
+            self.assertEqual(received, [])
+            self._post(1)
+        finally:
+            ratelimit_exceeded.disconnect(receiver)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0][1:], ('fake_login_no_exception', 2))
+
+    @unittest.skipIf(prometheus_client is None, 'prometheus_client missing')
+    def test_prometheus(self):
+        with override_settings(
+                RATELIMIT_METRICS='brake.tests.tests.PrometheusTestMetrics'):
+            self._post(12)
+        registry = PrometheusTestMetrics.registry
+        labels = {'func_name': 'fake_login_no_exception', 'period': '60'}
+        self.assertEqual(
+            registry.get_sample_value('brake_checks_total', labels), 12)
+        labels['ratelimited_by'] = 'ip'
+        self.assertEqual(
+            registry.get_sample_value('brake_limited_total', labels), 2)
+        self.assertEqual(registry.get_sample_value(
+            'brake_backend_seconds_count',
+            {'backend': 'MyBrake', 'method': 'hit_many'}), 12)
+
+
+class TestSampledCounting(CountingCacheMixin, RateLimitTestCase):
+
+    def setUp(self):
+        super(TestSampledCounting, self).setUp()
+        self.backend = self._backend()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        random.seed(7)
+
+    def _backend(self, **kwargs):
+        kwargs.setdefault('RATELIMIT_SAMPLE_ABOVE', 1000)
+        kwargs.setdefault('RATELIMIT_SAMPLE_RATE', 0.1)
+        kwargs.setdefault('RATELIMIT_SAMPLE_EXACT_FRACTION', 0.5)
+        with override_settings(**kwargs):
+            backend = CacheBackend()
+            backend.setup()
+        return backend
+
+    def _hit(self, rate, times):
+        for _ in range(times):
+            self.backend.hit_many(
+                'fake_login', self.request, rates=[rate])
+        key, = self.backend._keys('fake_login', self.request, period=60)
+        return self.stored_count(key)
+
+    def test_writes_are_sampled(self):
+        count = self._hit((10000, 60), 2000)
+        writes = self.counting_cache.calls.count('set_many')
+        self.assertTrue(100 < writes < 300, writes)
+        # The standard error is sqrt(2000 * 0.9 / 0.1), about 134.
+        self.assertTrue(1500 < count < 2500, count)
+
+    def test_exact_near_the_limit(self):
+        key, = self.backend._keys('fake_login', self.request, period=60)
+        cache.set(key, self.backend._encode(5000, time.time() + 60))
+        self.assertEqual(self._hit((10000, 60), 10), 5010)
+        self.assertEqual(self.counting_cache.calls.count('set_many'), 10)
+
+    def test_low_rates_are_exact(self):
+        self.assertEqual(self._hit((999, 60), 10), 11)
+        self.assertEqual(self.counting_cache.calls.count('set_many'), 10)
+
+    def test_off_by_default(self):
+        self.backend = CacheBackend()
+        self.backend.setup()
+        self.assertEqual(self._hit((10000, 60), 10), 11)
+
+    def test_settings_are_checked(self):
+        self.assertRaises(
+            ImproperlyConfigured, self._backend, RATELIMIT_SAMPLE_RATE=0)
+        self.assertRaises(ImproperlyConfigured, self._backend,
+            RATELIMIT_SAMPLE_EXACT_FRACTION=1.5)
+
+
+class TestSlidingWindow(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestSlidingWindow, self).setUp()
+        self.clock = FakeClock(6000)
+        cachebe.time = self.clock
+        self.backend = AtomicCacheBackend()
+        self.backend.algorithm = SLIDING_WINDOW
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+
+    def tearDown(self):
+        cachebe.time = time
+        super(TestSlidingWindow, self).tearDown()
+
+    def _hit(self):
+        return self.backend.hit_many(
+            'fake_login', self.request, rates=[(5, 60)])
+
+    def test_previous_window_is_weighted(self):
+        for _ in range(6):
+            self._hit()
+        # Half of the previous window overlaps the last minute, so three of
+        # its six hits still count.
+        self.clock.now = 6090
+        self.assertEqual(self._hit(), [])
+        self.assertEqual(self._hit(), [])
+        limits = self._hit()
+        self.assertEqual(len(limits), 1)
+        self.assertEqual(limits[0]['count'], 6)
+
+    def test_boundary_burst_is_limited(self):
+        """The fixed window would let a second burst through right away."""
+        self.clock.now = 6059
+        for _ in range(6):
+            self._hit()
+        self.clock.now = 6061
+        self.assertTrue(self._hit())
+
+    def test_previous_window_outlives_its_period(self):
+        self._hit()
+        key = self.backend._window_keys(
+            'fake_login', self.request, period=60, now=6000)[0]
+        self.assertEqual(
+            int(cache._expire_info[':1:' + key]), int(time.time()) + 121)
+
+    def test_limit_many(self):
+        for _ in range(6):
+            self._hit()
+        self.clock.now = 6090
+        self.assertEqual(self.backend.limit_many(
+            'fake_login', self.request, rates=[(4, 60)]), [])
+        self.assertTrue(self.backend.limit_many(
+            'fake_login', self.request, rates=[(3, 60)]))
+
+    def test_limit_many_reads_both_windows_at_once(self):
+        counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = counting_cache
+        try:
+            self.backend.limit_many(
+                'fake_login', self.request, rates=[(5, 60), (10, 3600)])
+        finally:
+            cachebe.cache = counting_cache._cache
+        self.assertEqual(counting_cache.calls, ['get_many'])
+
+    def test_unknown_algorithm(self):
+        from django.core.exceptions import ImproperlyConfigured
+        with override_settings(RATELIMIT_ALGORITHM='leaky'):
+            self.assertRaises(ImproperlyConfigured, self.backend.setup)
+
+    def test_only_atomic_backends_slide(self):
+        with override_settings(RATELIMIT_ALGORITHM=SLIDING_WINDOW):
+            for backend_class in (CacheBackend, GCRABackend, SketchBackend):
+                self.assertRaises(
+                    ImproperlyConfigured, backend_class().setup)
+            self.backend.setup()
+
+
+class TestGCRABackend(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestGCRABackend, self).setUp()
+        self.clock = FakeClock(1000.0)
+        gcrabe.time = self.clock
+        self.backend = GCRABackend()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+
+    def tearDown(self):
+        gcrabe.time = time
+        super(TestGCRABackend, self).tearDown()
+
+    def _hit(self, burst=None):
+        return self.backend.hit_many(
+            'fake_login', self.request, rates=[(10, 60)], burst=burst)
+
+    def test_whole_rate_may_burst_by_default(self):
+        for _ in range(10):
+            self.assertEqual(self._hit(), [])
+        limits = self._hit()
+        self.assertEqual(len(limits), 1)
+        self.assertAlmostEqual(limits[0]['retry_after'], 6)
+        self.assertEqual(limits[0]['count'], 10)
+
+    def test_burst(self):
+        self.assertEqual(self._hit(burst=2), [])
+        self.assertEqual(self._hit(burst=2), [])
+        self.assertAlmostEqual(self._hit(burst=2)[0]['retry_after'], 6)
+        self.clock.now += 5
+        self.assertTrue(self._hit(burst=2))
+        self.clock.now += 1
+        self.assertEqual(self._hit(burst=2), [])
+
+    def test_single_value_per_key(self):
+        self._hit()
+        self._hit()
+        key = self.backend._keys('fake_login', self.request, period=60)[0]
+        self.assertEqual(cache.get(key), 1012.0)
+
+    def test_limited_requests_are_not_charged(self):
+        for _ in range(15):
+            self._hit(burst=1)
+        key = self.backend._keys('fake_login', self.request, period=60)[0]
+        self.assertEqual(cache.get(key), 1006.0)
+
+    def test_keys_are_apart_from_counters(self):
+        self._hit()
+        key = self.backend._keys('fake_login', self.request, period=60)[0]
+        self.assertTrue(key.startswith('rl:gcra:func:'))
+        counters = CacheBackend()
+        counters.count('fake_login', self.request, period=60)
+        self.assertEqual(cache.get(key), 1006.0)
+        self.assertFalse(counters.limit(
+            'fake_login', self.request, count=3, period=60))
+
+    def test_limit_and_count(self):
+        rates = [(1, 60)]
+        self.assertEqual(self.backend.limit_many(
+            'fake_login', self.request, rates=rates), [])
+        self.backend.count_many('fake_login', self.request, rates=rates)
+        self.assertTrue(self.backend.limit_many(
+            'fake_login', self.request, rates=rates))
+
+    def test_decorator_burst(self):
+        with override_settings(
+                RATELIMIT_CACHE_BACKEND='brake.backends.gcrabe.GCRABackend'):
+            view = ratelimit(rate='10/m', burst=1, block=True)(
+                fake_login_use_request_path)
+            self.assertEqual(self.client.post(view, {}).status_code, 200)
+            self.assertEqual(self.client.post(view, {}).status_code, 429)
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def test_entries_expire(self):
+        local = LocalCache(10)
+        local.set('a', 1, expires=100)
+        self.assertEqual(local.get('a', 99), 1)
+        self.assertEqual(local.get('a', 100), None)
+
+    def test_least_recently_used_are_evicted(self):
+        local = LocalCache(2)
+        local.set('a', 1)
+        local.set('b', 2)
+        local.get('a', 0)
+        self.assertEqual(local.set('c', 3), [('b', 2)])
+        self.assertEqual(local.get('a', 0), 1)
+
+
+class TestTieredBackend(CountingCacheMixin, RateLimitTestCase):
+
+    def setUp(self):
+        super(TestTieredBackend, self).setUp()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+
+    def _backend(self, **kwargs):
+        with override_settings(**kwargs):
+            backend = TieredBackend()
+            backend.setup()
+        return backend
+
+    def _hit(self, backend):
+        return backend.hit_many(
+            'fake_login', self.request, rates=[(5, 60)])
+
+    def test_limited_keys_are_rejected_locally(self):
+        backend = self._backend()
+        for _ in range(5):
+            self.assertEqual(self._hit(backend), [])
+        self.assertTrue(self._hit(backend))
+        calls = len(self.counting_cache.calls)
+        for _ in range(100):
+            self.assertTrue(self._hit(backend))
+        self.assertEqual(len(self.counting_cache.calls), calls)
+
+    def test_max_ttl(self):
+        backend = self._backend(RATELIMIT_LOCAL_MAX_TTL=0)
+        for _ in range(7):
+            self._hit(backend)
+        calls = len(self.counting_cache.calls)
+        self.assertTrue(self._hit(backend))
+        self.assertEqual(len(self.counting_cache.calls), calls + 2)
+
+    def test_windowed_keys_are_remembered(self):
+        backend = self._backend(
+            RATELIMIT_TIERED_BACKEND='brake.backends.cachebe.'
+            'AtomicCacheBackend')
+        for _ in range(7):
+            self._hit(backend)
+        calls = len(self.counting_cache.calls)
+        self.assertTrue(self._hit(backend))
+        self.assertEqual(len(self.counting_cache.calls), calls)
+
+    def test_batching(self):
+        backend = self._backend(
+            RATELIMIT_LOCAL_FLUSH_INTERVAL=60, RATELIMIT_LOCAL_FLUSH_SIZE=4)
+        for _ in range(3):
+            self.assertEqual(self._hit(backend), [])
+        self.assertEqual(self.counting_cache.calls, [])
+        # The fourth request flushes all four upstream in one write.
+        self.assertEqual(self._hit(backend), [])
+        key = backend.backend._keys('fake_login', self.request, period=60)[0]
+        self.assertEqual(self.stored_count(key), 5)
+        for _ in range(4):
+            self._hit(backend)
+        self.assertTrue(self._hit(backend))
+
+    def test_flush_checks_the_request_that_sends_it(self):
+        for count, limited in [(3, True), (4, False)]:
+            cache.clear()
+            backend = self._backend(
+                RATELIMIT_LOCAL_FLUSH_INTERVAL=60,
+                RATELIMIT_LOCAL_FLUSH_SIZE=4)
+            self.assertEqual([
+                bool(backend.hit_many(
+                    'fake_login', self.request, rates=[(count, 60)]))
+                for _ in range(4)
+            ], [False, False, False, limited])
+
+    def test_denied_limits_count_down(self):
+        clock = FakeClock(1000)
+        localbe.time = clock
+        try:
+            backend = self._backend()
+            for _ in range(6):
+                limits = self._hit(backend)
+            reset = limits[0]['reset']
+            clock.now += 20
+            limits = self._hit(backend)
+            self.assertAlmostEqual(limits[0]['reset'], reset - 20, places=3)
+        finally:
+            localbe.time = time
+
+    def test_batches_keep_only_keys(self):
+        backend = self._backend(RATELIMIT_LOCAL_FLUSH_INTERVAL=60)
+        self._hit(backend)
+        batch, = backend.batches.values()
+        self.assertEqual(batch.rate_keys, backend.backend._rate_keys(
+            'fake_login', self.request, rates=[(5, 60)]))
+        self.assertFalse(hasattr(batch, 'args'))
+
+    def test_idle_batches_are_flushed(self):
+        clock = FakeClock(1000)
+        localbe.time = clock
+        try:
+            backend = self._backend(RATELIMIT_LOCAL_FLUSH_INTERVAL=10)
+            self._hit(backend)
+            self._hit(backend)
+            key = backend.backend._keys(
+                'fake_login', self.request, period=60)[0]
+            self.assertEqual(cache.get(key), None)
+
+            # Another client's request sends the idle batch upstream.
+            clock.now += 10
+            other = FakeRequest()
+            other.META = {'REMOTE_ADDR': '10.0.0.2'}
+            backend.limit_many('fake_login', other, rates=[(5, 60)])
+            self.assertEqual(self.stored_count(key), 3)
+        finally:
+            localbe.time = time
+
+    def test_flush(self):
+        backend = self._backend(RATELIMIT_LOCAL_FLUSH_INTERVAL=60)
+        self._hit(backend)
+        self._hit(backend)
+        backend.flush()
+        key = backend.backend._keys('fake_login', self.request, period=60)[0]
+        self.assertEqual(self.stored_count(key), 3)
+
+
+class TestCircuitBreakerBackend(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestCircuitBreakerBackend, self).setUp()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.slow_cache = SlowCache(cachebe.cache)
+        cachebe.cache = self.slow_cache
+        self.clock = FakeClock(1000)
+        breakerbe.time = self.clock
+        self.events = []
+        circuit_opened.connect(self._opened)
+        circuit_closed.connect(self._closed)
+
+    def tearDown(self):
+        circuit_opened.disconnect(self._opened)
+        circuit_closed.disconnect(self._closed)
+        breakerbe.time = time
+        cachebe.cache = self.slow_cache._cache
+        super(TestCircuitBreakerBackend, self).tearDown()
+
+    def _opened(self, sender, **kwargs):
+        self.events.append(('opened', sender))
+
+    def _closed(self, sender, **kwargs):
+        self.events.append(('closed', sender))
+
+    def _backend(self, **kwargs):
+        kwargs.setdefault('RATELIMIT_BREAKER_FAILURES', 2)
+        kwargs.setdefault('RATELIMIT_BREAKER_COOLDOWN', 30)
+        with override_settings(**kwargs):
+            backend = CircuitBreakerBackend()
+            backend.setup()
+        return backend
+
+    def _hit(self, backend):
+        return backend.hit_many('fake_login', self.request, rates=[(2, 60)])
+
+    def test_passes_through(self):
+        backend = self._backend()
+        for _ in range(2):
+            self.assertEqual(self._hit(backend), [])
+        self.assertTrue(self._hit(backend))
+        self.assertFalse(backend.is_open)
+
+    def test_failures_open_the_circuit(self):
+        backend = self._backend()
+        self.slow_cache.broken = True
+        self.assertEqual(self._hit(backend), [])
+        self.assertFalse(backend.is_open)
+        self.assertEqual(self._hit(backend), [])
+        self.assertTrue(backend.is_open)
+        self.assertEqual(self.events, [('opened', CacheBackend)])
+
+        # The backend isn't called again until the cooldown is over.
+        self.slow_cache.broken = False
+        self.slow_cache.delay = 10
+        self.clock.now += 29
+        self.assertEqual(self._hit(backend), [])
+
+    def test_recovery(self):
+        backend = self._backend()
+        self.slow_cache.broken = True
+        self._hit(backend)
+        self._hit(backend)
+
+        # Still broken after the cooldown: stays open, no new signal.
+        self.clock.now += 30
+        self._hit(backend)
+        self.assertTrue(backend.is_open)
+        self.assertEqual(len(self.events), 1)
+
+        self.slow_cache.broken = False
+        self.clock.now += 30
+        self.assertEqual(self._hit(backend), [])
+        self.assertFalse(backend.is_open)
+        self.assertEqual(
+            self.events, [('opened', CacheBackend), ('closed', CacheBackend)])
+
+    def test_timeout(self):
+        backend = self._backend(RATELIMIT_BREAKER_TIMEOUT=0.05)
+        self.slow_cache.delay = 0.2
+        started = time.time()
+        self._hit(backend)
+        self._hit(backend)
+        self.assertTrue(time.time() - started < 0.3)
+        self.assertTrue(backend.is_open)
+        # Let the abandoned calls finish before the cache is cleared, or
+        # they write their counters into later tests.
+        backend.executor.shutdown(wait=True)
+
+    def test_local_fallback(self):
+        backend = self._backend(RATELIMIT_BREAKER_FALLBACK='local')
+        self.slow_cache.broken = True
+        for _ in range(2):
+            self.assertEqual(self._hit(backend), [])
+        limits = self._hit(backend)
+        self.assertEqual(len(limits), 1)
+        self.assertEqual(limits[0]['ratelimited_by'], 'ip')
+        self.assertEqual(limits[0]['count'], 3)
+        self.assertEqual(backend.limit_many(
+            'fake_login', self.request, rates=[(10, 60)]), [])
+
+    def test_metrics(self):
+        with override_settings(
+                RATELIMIT_METRICS='brake.metrics.InMemoryMetrics'):
+            backend = self._backend()
+            self.slow_cache.broken = True
+            self._hit(backend)
+            self._hit(backend)
+            self.slow_cache.broken = False
+            self.clock.now += 30
+            self._hit(backend)
+            collected = metrics._metrics._wrapped
+        self.assertEqual(collected.count(
+            metrics.BREAKER_TRIPS, backend='CacheBackend'), 1)
+        self.assertEqual(collected.count(
+            metrics.BREAKER_RECOVERIES, backend='CacheBackend'), 1)
+
+
+    def test_acquire(self):
+        backend = self._backend()
+        leases, limits = backend.acquire('fake_export', self.request)
+        self.assertEqual(len(leases), 1)
+        self.assertEqual(limits, [])
+        backend.release(leases)
+
+        # With the cache down, requests run without a slot.
+        self.slow_cache.broken = True
+        self.assertEqual(backend.acquire('fake_export', self.request), ([], []))
+        self.assertEqual(backend.acquire('fake_export', self.request), ([], []))
+        self.assertTrue(backend.is_open)
+
+class TestHitBuckets(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestHitBuckets, self).setUp()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.request.POST = {'username': 'alice'}
+        self.buckets = [
+            ('wide', True, None, [(10, 60)], None),
+            ('narrow', True, 'username', [(2, 60), (5, 3600)], None),
+        ]
+
+    def _limited(self, backend, hits):
+        """Return the number of limits per bucket on the last of hits."""
+        for _ in range(hits):
+            results = backend.hit_buckets(self.request, self.buckets)
+        return [len(limits) for limits in results]
+
+    def test_backends(self):
+        for backend_class in (
+                CacheBackend, AtomicCacheBackend, GCRABackend, TieredBackend,
+                CircuitBreakerBackend):
+            cache.clear()
+            backend = backend_class()
+            backend.setup()
+            self.assertEqual(self._limited(backend, 2), [0, 0])
+            limited = self._limited(backend, 2)
+            self.assertEqual(limited[0], 0, backend_class)
+            self.assertEqual(limited[1], 2, backend_class)
+
+    def test_dummy_backend_never_limits(self):
+        self.assertEqual(self._limited(DummyBackend(), 5), [0, 0])
+
+    def test_one_round_trip(self):
+        counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = counting_cache
+        try:
+            CacheBackend().hit_buckets(self.request, self.buckets)
+        finally:
+            cachebe.cache = counting_cache._cache
+        self.assertEqual(
+            counting_cache.calls, ['get_many', 'set_many', 'set_many'])
+
+
+class TestRateLimitMiddleware(CountingCacheMixin, RateLimitTestCase):
+
+    RULES = [
+        {'prefix': '/', 'rate': '100/m', 'block': False},
+        {'prefix': '/api/', 'rate': '3/m'},
+        {'prefix': '/api/v2/', 'rate': '10/m', 'method': ['POST']},
+        {'pattern': r'/users/\d+/$', 'rate': '5/m', 'name': 'users'},
+    ]
+
+    def setUp(self):
+        super(TestRateLimitMiddleware, self).setUp()
+        with override_settings(RATELIMIT_RULES=self.RULES):
+            self.middleware = RateLimitMiddleware(lambda request: 'view')
+
+    def _request(self, path, method='GET'):
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        request.path = path
+        request.method = method
+        setattr(request, method, {})
+        return request
+
+    def _names(self, path, method='GET'):
+        return [rule.name for rule in
+            self.middleware.table.match(path, method)]
+
+    def test_match(self):
+        self.assertEqual(self._names('/api/v2/items', 'POST'),
+            ['/', '/api/', '/api/v2/'])
+        self.assertEqual(self._names('/api/v2/items'), ['/', '/api/'])
+        self.assertEqual(self._names('/api'), ['/'])
+        self.assertEqual(self._names('/users/12/'), ['/', 'users'])
+        self.assertEqual(self._names('/users/ab/'), ['/'])
+        self.assertEqual(self._names('users/12/'), [])
+
+    def test_patterns_that_cant_be_combined(self):
+        table = RuleTable([
+            {'pattern': r'/a/(?P<id>\d+)/', 'rate': '5/m'},
+            {'pattern': r'/b/(?P<id>\d+)/', 'rate': '5/m'},
+        ])
+        self.assertEqual(table.prefilter, None)
+        self.assertEqual(len(table.match('/b/1/', 'GET')), 1)
+
+    def test_patterns_with_backreferences(self):
+        table = RuleTable([
+            {'pattern': r'/a/', 'rate': '5/m', 'name': 'a'},
+            {'pattern': r'/(\w+)/\1/', 'rate': '5/m', 'name': 'twice'},
+        ])
+        self.assertEqual(table.prefilter, None)
+        names = lambda path: [
+            rule.name for rule in table.match(path, 'GET')]
+        self.assertEqual(names('/a/a/'), ['a', 'twice'])
+        self.assertEqual(names('/b/b/'), ['twice'])
+        self.assertEqual(names('/b/c/'), [])
+
+    def test_prefilter_names_the_first_pattern(self):
+        table = RuleTable([
+            {'pattern': r'/x/', 'rate': '5/m', 'name': 'x'},
+            {'pattern': r'/(a)/(\d+)/', 'rate': '5/m', 'name': 'a'},
+            {'pattern': r'/(?P<first>a)/', 'rate': '5/m', 'name': 'b'},
+            {'pattern': r'/a/1', 'rate': '5/m', 'name': 'c'},
+        ])
+        self.assertNotEqual(table.prefilter, None)
+        run = []
+
+        class Recording(object):
+            def __init__(self, name, regex):
+                self.name, self.regex = name, regex
+
+            def match(self, path):
+                run.append(self.name)
+                return self.regex.match(path)
+
+        for rule in table.patterns:
+            rule.regex = Recording(rule.name, rule.regex)
+        names = [rule.name for rule in table.match('/a/1/', 'GET')]
+        self.assertEqual(names, ['a', 'b', 'c'])
+        # The first match and the patterns before it aren't run again.
+        self.assertEqual(run, ['b', 'c'])
+
+    def test_rule_needs_a_path(self):
+        from django.core.exceptions import ImproperlyConfigured
+        self.assertRaises(
+            ImproperlyConfigured, RuleTable, [{'rate': '5/m'}])
+
+    def test_blocks(self):
+        for _ in range(3):
+            request = self._request('/api/items')
+            self.assertEqual(self.middleware(request), 'view')
+        request = self._request('/api/items')
+        response = self.middleware(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['RateLimit-Limit'], '3')
+        self.assertTrue(response.has_header('Retry-After'))
+        self.assertTrue(request.limited)
+
+    def test_one_backend_call_for_all_rules(self):
+        self.middleware(self._request('/api/v2/items', 'POST'))
+        self.assertEqual(self.counting_cache.calls, ['get_many', 'set_many'])
+
+    def test_unmatched_paths_are_free(self):
+        self.middleware(self._request('static.css'))
+        self.assertEqual(self.counting_cache.calls, [])
+
+    def test_non_blocking_rule(self):
+        with override_settings(RATELIMIT_RULES=self.RULES[:1]):
+            middleware = RateLimitMiddleware(lambda request: 'view')
+        for _ in range(101):
+            request = self._request('/page')
+            self.assertEqual(middleware(request), 'view')
+        self.assertTrue(request.limited)
+
+
+class TestSketchBackend(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestSketchBackend, self).setUp()
+        self.backend = SketchBackend()
+        self.backend.setup()
+        self.rates = [(5, 60), (10, 3600)]
+
+    def _request(self, username, ip='10.0.0.1'):
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': ip}
+        request.POST = {'username': username}
+        return request
+
+    def _limited(self, backend, request, hits):
+        """Return the number of limits on each of hits."""
+        return [
+            len(backend.hit_many(
+                'fake_login', request, field='username', rates=self.rates))
+            for _ in range(hits)
+        ]
+
+    def test_limits_like_cache_backend(self):
+        exact = CacheBackend()
+        exact.setup()
+        expected = self._limited(exact, self._request('alice'), 12)
+        cache.clear()
+        self.assertEqual(
+            self._limited(self.backend, self._request('alice'), 12), expected)
+
+    def test_light_identities_stay_in_the_sketch(self):
+        requests = [
+            self._request('user%d' % i, '10.0.0.%d' % i) for i in range(200)]
+        for request in requests:
+            self.assertEqual(self._limited(self.backend, request, 1), [0])
+        keys = [
+            key for request in requests
+            for key, _, _ in self.backend._rate_keys(
+                'fake_login', request, True, 'username', self.rates)
+        ]
+        self.assertEqual(cache.get_many(keys), {})
+        sketch_key = self.backend._sketch_key(keys[0], 60, time.time())
+        self.assertEqual(
+            len(cache.get(sketch_key)),
+            self.backend.width * self.backend.depth)
+
+    def test_heavy_identities_are_promoted(self):
+        request = self._request('alice')
+        key = self.backend._keys(
+            'fake_login', request, field='username', period=60)[0]
+        self._limited(self.backend, request, 1)
+        self.assertEqual(cache.get(key), None)
+        # Past half of the rate.
+        self._limited(self.backend, request, 1)
+        self.assertEqual(self.stored_count(key), 3)
+
+    def test_one_read_and_write(self):
+        self.rates = [(5, 60)]
+        counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = counting_cache
+        try:
+            self._limited(self.backend, self._request('alice'), 1)
+        finally:
+            cachebe.cache = counting_cache._cache
+        self.assertEqual(counting_cache.calls, ['get_many', 'set_many'])
+
+    def test_reset(self):
+        request = self._request('alice')
+        self.assertEqual(self._limited(self.backend, request, 7)[-1], 2)
+        self.backend.reset_counts(
+            'fake_login', [60, 3600], ips=['10.0.0.1'],
+            fields=[('username', 'alice')])
+        self.assertEqual(self._limited(self.backend, request, 1), [0])
+        self.assertEqual(self.backend.get_counts(
+            'fake_login', [60], ips=['10.0.0.1']),
+            {(('ip', '10.0.0.1'), 60): 1})
+
+
+@ratelimit(rate='1/m', block=True, shadow=True)
+def fake_shadowed(request):
+    return HttpResponse()
+
+
+class ThreadRecordingCache(CountingCache):
+    """Records the thread every cache method is called from."""
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if not callable(attr):
+            return attr
+
+        def _recorded(*args, **kwargs):
+            self.calls.append(threading.current_thread())
+            return attr(*args, **kwargs)
+
+        return _recorded
+
+
+class BlockingBackend(CacheBackend):
+    """Blocks every check until ``release`` is set."""
+
+    def __init__(self):
+        super(BlockingBackend, self).__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def hit_many(self, *args, **kwargs):
+        self.started.set()
+        self.release.wait(5)
+        return []
+
+
+class TestShadow(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestShadow, self).setUp()
+        self.recording_cache = ThreadRecordingCache(cachebe.cache)
+        cachebe.cache = self.recording_cache
+        self.metrics_settings = override_settings(
+            RATELIMIT_METRICS='brake.metrics.InMemoryMetrics')
+        self.metrics_settings.enable()
+
+    def tearDown(self):
+        self.metrics_settings.disable()
+        cachebe.cache = self.recording_cache._cache
+        super(TestShadow, self).tearDown()
+
+    def _post(self, view):
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        request.POST = {}
+        return request, view(request)
+
+    def test_shadowed_view_is_never_limited(self):
+        with self.assertLogs('brake.shadow', 'INFO') as logs:
+            for _ in range(4):
+                request, response = self._post(fake_shadowed)
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse(getattr(request, 'limited', False))
+                self.assertFalse(response.has_header('RateLimit-Limit'))
+            shadow._shadow.wait()
+
+        self.assertEqual(len(logs.records), 3)
+        self.assertTrue(self.recording_cache.calls)
+        self.assertFalse(
+            threading.current_thread() in self.recording_cache.calls)
+        self.assertEqual(metrics._metrics.count(
+            metrics.SHADOW_LIMITED, func_name='fake_shadowed', period=60), 3)
+        key = 'rl:func:shadow:fake_shadowed:period:60:ip:10.0.0.1'
+        self.assertEqual(self.stored_count(key), 5)
+        self.assertEqual(
+            cache.get('rl:func:fake_shadowed:period:60:ip:10.0.0.1'), None)
+
+    def test_everything(self):
+        with override_settings(RATELIMIT_SHADOW=True):
+            for _ in range(4):
+                self.assertEqual(
+                    self._post(fake_login_no_exception)[1].status_code, 200)
+            shadow._shadow.wait()
+        self.assertEqual(metrics._metrics.count(
+            metrics.SHADOW_LIMITED, func_name='fake_login_no_exception'), 0)
+        self.assertEqual(self.stored_count(
+            'rl:func:shadow:fake_login_no_exception:period:60:ip:10.0.0.1'),
+            5)
+
+    def test_full_queue_drops_requests(self):
+        backend = BlockingBackend()
+        evaluator = shadow.ShadowEvaluator(queue_size=1)
+        decorators._backend._wrapped = backend
+        try:
+            request = FakeRequest()
+            self.assertTrue(evaluator.submit(
+                'view', request, True, None, [(1, 60)], None, True))
+            backend.started.wait(5)
+            self.assertTrue(evaluator.submit(
+                'view', request, True, None, [(1, 60)], None, True))
+            self.assertFalse(evaluator.submit(
+                'view', request, True, None, [(1, 60)], None, True))
+        finally:
+            backend.release.set()
+            evaluator.wait()
+            decorators._backend._wrapped = decorators.empty
+        self.assertEqual(metrics._metrics.count(
+            metrics.SHADOW_DROPPED, func_name='view'), 1)
+
+    def test_middleware(self):
+        rules = [
+            {'prefix': '/', 'rate': '1/m', 'shadow': True},
+            {'prefix': '/api/', 'rate': '100/m'},
+        ]
+        with override_settings(RATELIMIT_RULES=rules):
+            middleware = RateLimitMiddleware(lambda request: 'view')
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        request.path = '/api/'
+        request.method = 'GET'
+        for _ in range(3):
+            self.assertEqual(middleware.process_request(request), None)
+        shadow._shadow.wait()
+        self.assertEqual(metrics._metrics.count(
+            metrics.SHADOW_LIMITED, func_name='/'), 2)
+
+
+SHARDED_CACHES = dict(
+    (alias, {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': alias,
+    })
+    for alias in ('default', 'rl1', 'rl2', 'rl3')
+)
+
+
+class TestShardedCache(RateLimitTestCase):
+
+    ALIASES = ['rl1', 'rl2', 'rl3']
+
+    def setUp(self):
+        super(TestShardedCache, self).setUp()
+        self.sharded_settings = override_settings(
+            CACHES=SHARDED_CACHES, RATELIMIT_CACHE_ALIASES=self.ALIASES)
+        self.sharded_settings.enable()
+        for alias in self.ALIASES:
+            caches[alias].clear()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.request.POST = {'username': 'alice'}
+
+    def tearDown(self):
+        self.sharded_settings.disable()
+        super(TestShardedCache, self).tearDown()
+
+    def test_ring_is_consistent(self):
+        keys = ['rl:key:%d' % i for i in range(1000)]
+        ring = HashRing(self.ALIASES)
+        placed = dict((key, ring.get(key)) for key in keys)
+        self.assertEqual(set(placed.values()), set(self.ALIASES))
+        smaller = HashRing(['rl1', 'rl2'])
+        for key, alias in placed.items():
+            if alias != 'rl3':
+                self.assertEqual(smaller.get(key), alias)
+
+    def test_one_call_per_alias(self):
+        sharded = ShardedCache(self.ALIASES)
+        keys = ['rl:key:%d' % i for i in range(30)]
+        sharded.set_many(dict((key, i) for i, key in enumerate(keys)), 60)
+        counting = dict(
+            (alias, CountingCache(caches[alias])) for alias in self.ALIASES)
+        original = sharded._call
+        sharded._call = lambda alias, method, *args, **kwargs: getattr(
+            counting[alias], method)(*args, **kwargs)
+        try:
+            values = sharded.get_many(keys)
+        finally:
+            sharded._call = original
+        self.assertEqual(values, dict((key, i) for i, key in enumerate(keys)))
+        for alias in self.ALIASES:
+            self.assertEqual(counting[alias].calls, ['get_many'])
+            self.assertTrue(0 < len(
+                caches[alias].get_many(keys)) < len(keys))
+        sharded.delete_many(keys)
+        self.assertEqual(sharded.get_many(keys), {})
+
+    def test_backends(self):
+        rates = [(2, 60), (10, 3600)]
+        for backend_class in (CacheBackend, AtomicCacheBackend, GCRABackend):
+            backend = backend_class()
+            backend.setup()
+            for _ in range(4):
+                limits = backend.hit_many(
+                    'sharded', self.request, field='username', rates=rates)
+            self.assertEqual(len(limits), 2, backend_class)
+            self.assertEqual(cache.get_many(
+                [key for key, _, _ in backend._rate_keys(
+                    'sharded', self.request, True, 'username', rates)]), {})
+            for alias in self.ALIASES:
+                caches[alias].clear()
+
+    @override_settings(RATELIMIT_SUB_COUNTERS={'sharded': 4})
+    def test_sub_counters(self):
+        backend = AtomicCacheBackend()
+        backend.setup()
+        for _ in range(40):
+            limits = backend.hit_many(
+                'sharded', self.request, rates=[(30, 3600)])
+        self.assertEqual([l['count'] for l in limits], [40])
+        key = backend._window_keys('sharded', self.request, period=3600)[0]
+        subs = cachebe.cache.get_many(backend._sub_keys(key))
+        self.assertTrue(len(subs) > 1)
+        self.assertEqual(sum(subs.values()), 40)
+        self.assertEqual(cachebe.cache.get(key), None)
+        self.assertEqual(backend.get_counts(
+            'sharded', [3600], ips=['10.0.0.1']),
+            {(('ip', '10.0.0.1'), 3600): 40})
+        backend.reset_counts('sharded', [3600], ips=['10.0.0.1'])
+        self.assertEqual(cachebe.cache.get_many(backend._sub_keys(key)), {})
+
+
+@ratelimit(field='username', method='POST', rate='2/m', block=True)
+def fake_inspected(request):
+    return HttpResponse()
+
+
+class TestInspection(RateLimitTestCase):
+
+    def _post(self, ip, username, times=1):
+        for _ in range(times):
+            request = FakeRequest()
+            request.META = {'REMOTE_ADDR': ip}
+            request.POST = {'username': username}
+            response = fake_inspected(request)
+        return response
+
+    def test_get_counts(self):
+        self._post('10.0.0.1', 'alice', 3)
+        self._post('10.0.0.2', 'bob')
+        counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = counting_cache
+        try:
+            counts = inspection.get_counts(
+                'fake_inspected', [60, 3600],
+                ips=['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+                fields=[('username', 'alice')])
+        finally:
+            cachebe.cache = counting_cache._cache
+        self.assertEqual(counting_cache.calls, ['get_many'])
+        self.assertEqual(counts, {
+            (('ip', '10.0.0.1'), 60): 4,
+            (('ip', '10.0.0.2'), 60): 2,
+            (('username', 'alice'), 60): 4,
+        })
+
+    def test_reset(self):
+        self._post('10.0.0.1', 'alice', 3)
+        self.assertEqual(self._post('10.0.0.2', 'alice').status_code, 429)
+        counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = counting_cache
+        try:
+            keys = inspection.reset(
+                'fake_inspected', [60], ips=['10.0.0.1'],
+                fields=[('username', 'alice')])
+        finally:
+            cachebe.cache = counting_cache._cache
+        self.assertEqual(counting_cache.calls, ['delete_many'])
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(self._post('10.0.0.1', 'alice').status_code, 200)
+
+    def test_atomic_backend(self):
+        path = 'brake.backends.cachebe.AtomicCacheBackend'
+        with override_settings(
+                RATELIMIT_CACHE_BACKEND=path,
+                RATELIMIT_ALGORITHM=SLIDING_WINDOW):
+            self._post('10.0.0.1', 'alice', 3)
+            self.assertEqual(inspection.get_counts(
+                'fake_inspected', [60], ips=['10.0.0.1']),
+                {(('ip', '10.0.0.1'), 60): 3})
+            inspection.reset('fake_inspected', [60], ips=['10.0.0.1'])
+            self.assertEqual(inspection.get_counts(
+                'fake_inspected', [60], ips=['10.0.0.1']), {})
+
+    def test_top_offenders(self):
+        with override_settings(
+                RATELIMIT_INDEX_SIZE=2, RATELIMIT_INDEX_FLUSH_INTERVAL=0):
+            self._post('10.0.0.1', 'alice', 5)
+            self._post('10.0.0.2', 'bob', 4)
+            self._post('10.0.0.3', 'carol')
+            top = inspection.top_offenders()
+            self.assertEqual(
+                [(entry['ip'], entry['count']) for entry in top],
+                [('10.0.0.1', 5), ('10.0.0.1', 5)])
+            self.assertEqual(
+                inspection.top_offenders('fake_inspected', 60, limit=1),
+                top[:1])
+            self.assertEqual(inspection.top_offenders('other'), [])
+
+            inspection.reset_keys([entry['cache_key'] for entry in top])
+            self.assertEqual(inspection.top_offenders(), [])
+            self.assertEqual(self._post('10.0.0.1', 'alice').status_code, 200)
+
+    def test_top_offenders_needs_the_index(self):
+        self.assertRaises(ImproperlyConfigured, inspection.top_offenders)
+
+    def test_index_is_bounded_and_flushed_periodically(self):
+        index = inspection.ActiveKeyIndex(2, flush_interval=10)
+        index.flushed = 1000
+        for i in range(5):
+            index.record('view', [{
+                'cache_key': 'key%d' % i, 'count': i, 'period': 60,
+                'ratelimited_by': 'ip', 'ip': '10.0.0.1', 'reset': 30,
+            }], now=1001)
+        self.assertEqual(sorted(index.pending), ['key3', 'key4'])
+        self.assertEqual(cache.get(inspection.INDEX_KEY), None)
+        self.assertEqual(
+            [entry['cache_key'] for entry in index.entries(now=1002)],
+            ['key4', 'key3'])
+        self.assertEqual(index.entries(now=1032), [])
+
+    @unittest.skipIf(django.VERSION < (1, 8), 'Needs Django 1.8')
+    def test_command(self):
+        self._post('10.0.0.1', 'alice', 3)
+        out = StringIO()
+        call_command(
+            ratelimit_command.Command(), 'show', '--func', 'fake_inspected', '--period', 'm',
+            '--ip', '10.0.0.1', '--field', 'username=bob', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'ip=10.0.0.1\t60\t4', 'username=bob\t60\t0'])
+
+        out = StringIO()
+        call_command(
+            ratelimit_command.Command(), 'reset', '--func', 'fake_inspected',
+            '--period', '60', '--ip', '10.0.0.1',
+            '--field', 'username=alice', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Reset 2 counters.')
+        self.assertEqual(self._post('10.0.0.1', 'alice').status_code, 200)
+
+        with override_settings(
+                RATELIMIT_INDEX_SIZE=10, RATELIMIT_INDEX_FLUSH_INTERVAL=0):
+            self._post('10.0.0.2', 'bob', 4)
+            out = StringIO()
+            call_command(ratelimit_command.Command(), 'top', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+        self.assertTrue(out.getvalue().startswith(
+            '4\tfake_inspected\t60\t'))
+
+    @unittest.skipIf(django.VERSION < (1, 8), 'Needs Django 1.8')
+    def test_command_without_counts(self):
+        with override_settings(
+                RATELIMIT_CACHE_BACKEND='brake.backends.gcrabe.GCRABackend'):
+            self.assertRaises(CommandError, call_command,
+                ratelimit_command.Command(), 'show', '--func', 'fake_inspected',
+                '--period', 'm', '--ip', '10.0.0.1')
+
+
+@ratelimit(field='username', method='POST', rate='2/m', block=True)
+def fake_staged(request):
+    return HttpResponse()
+
+
+@ratelimit(field='X-Api-Key', field_source='header', rate='2/m', block=True)
+def fake_api_key(request):
+    return HttpResponse()
+
+
+class TestStagedCheck(RateLimitTestCase):
+
+    def _post(self, view, ip, username, **extra):
+        request = RequestFactory().post(
+            '/login/', {'username': username}, REMOTE_ADDR=ip, **extra)
+        return request, view(request)
+
+    def test_blocked_by_ip_never_parses_the_body(self):
+        for i in range(2):
+            request, response = self._post(
+                fake_staged, '10.0.0.1', 'user%d' % i)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(hasattr(request, '_post'))
+
+        request, response = self._post(fake_staged, '10.0.0.1', 'alice')
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(hasattr(request, '_post'))
+        self.assertEqual(
+            [l['ratelimited_by'] for l in request.limits], ['ip'])
+        # Blocked on its IP, the request wasn't counted against alice.
+        self.assertEqual(inspection.get_counts(
+            'fake_staged', [60], fields=[('username', 'alice')]), {})
+
+    def test_fields_are_checked_next(self):
+        for i in range(2):
+            self._post(fake_staged, '10.0.0.%d' % i, 'alice')
+        request, response = self._post(fake_staged, '10.0.0.9', 'alice')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(
+            [l['ratelimited_by'] for l in request.limits], ['field'])
+
+    def test_parsed_bodies_are_checked_at_once(self):
+        request = RequestFactory().post(
+            '/login/', {'username': 'alice'}, REMOTE_ADDR='10.0.0.1')
+        request.POST
+        counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = counting_cache
+        try:
+            fake_staged(request)
+        finally:
+            cachebe.cache = counting_cache._cache
+        self.assertEqual(counting_cache.calls, ['get_many', 'set_many'])
+
+    def test_header_field(self):
+        for i in range(2):
+            request, response = self._post(
+                fake_api_key, '10.0.0.%d' % i, 'alice',
+                HTTP_X_API_KEY='secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(hasattr(request, '_post'))
+        request, response = self._post(
+            fake_api_key, '10.0.0.9', 'alice', HTTP_X_API_KEY='secret')
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(hasattr(request, '_post'))
+        self.assertIn(':field:header:X-Api-Key:', request.limits[0]['cache_key'])
+
+    def test_query_field(self):
+        @ratelimit(field='page', field_source='query', rate='2/m', block=True)
+        def view(request):
+            return HttpResponse()
+
+        factory = RequestFactory()
+        for i in range(3):
+            request = factory.post(
+                '/items/?page=3', {'page': str(i)}, REMOTE_ADDR='10.0.0.%d' % i)
+            response = view(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(hasattr(request, '_post'))
+
+    def test_unknown_field_source(self):
+        self.assertRaises(
+            ImproperlyConfigured, ratelimit, field='page', field_source='body')
+
+    def test_middleware(self):
+        with override_settings(RATELIMIT_RULES=[
+                {'prefix': '/login/', 'rate': '2/m', 'field': 'username'}]):
+            middleware = RateLimitMiddleware(lambda request: 'view')
+        for i in range(2):
+            request, _ = self._post(
+                middleware.process_request, '10.0.0.1', 'user%d' % i)
+        request, response = self._post(
+            middleware.process_request, '10.0.0.1', 'alice')
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(hasattr(request, '_post'))
+
+        for i in range(2):
+            self._post(middleware.process_request, '10.0.1.%d' % i, 'bob')
+        request, response = self._post(
+            middleware.process_request, '10.0.1.9', 'bob')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(
+            [l['ratelimited_by'] for l in request.limits], ['field'])
+
+
+@ratelimit(rate=None, max_concurrent=1, block=True)
+def fake_export(request):
+    during = getattr(request, 'during', None)
+    if during is not None:
+        during()
+    return HttpResponse()
+
+
+class TestConcurrencyLimit(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestConcurrencyLimit, self).setUp()
+        self.backend = CacheBackend()
+        self.backend.setup()
+
+    def _request(self, ip='10.0.0.1', username='alice'):
+        request = FakeRequest()
+        request.META = {'REMOTE_ADDR': ip}
+        request.POST = {'username': username}
+        return request
+
+    def test_slot_is_held_while_the_view_runs(self):
+        inner = []
+        request = self._request()
+        request.during = lambda: inner.append(fake_export(self._request()))
+        self.assertEqual(fake_export(request).status_code, 200)
+        self.assertEqual(inner[0].status_code, 429)
+        self.assertEqual(inner[0]['Retry-After'], '1')
+
+        # Released once the view returned.
+        self.assertEqual(fake_export(self._request()).status_code, 200)
+        self.assertEqual(fake_export(self._request('10.0.0.2')).status_code,
+            200)
+
+    def test_dummy_backend_never_holds_a_slot(self):
+        inner = []
+        request = self._request()
+        request.during = lambda: inner.append(fake_export(self._request()))
+        with override_settings(
+                RATELIMIT_CACHE_BACKEND='brake.backends.dummybe.DummyBackend'):
+            self.assertEqual(fake_export(request).status_code, 200)
+        self.assertEqual(inner[0].status_code, 200)
+
+    def test_slot_is_released_when_the_view_raises(self):
+        request = self._request()
+
+        def fail():
+            raise RateLimitError()
+
+        request.during = fail
+        self.assertRaises(RateLimitError, fake_export, request)
+        self.assertEqual(fake_export(self._request()).status_code, 200)
+
+    def test_slots_per_field(self):
+        leases = []
+        for _ in range(2):
+            leased, limits = self.backend.acquire(
+                'fake_export', self._request(), False, 'username', 2)
+            self.assertEqual(limits, [])
+            leases.extend(leased)
+        _, limits = self.backend.acquire(
+            'fake_export', self._request('10.0.0.2'), False, 'username', 2)
+        self.assertEqual(
+            [(l['ratelimited_by'], l['max_concurrent']) for l in limits],
+            [('field', 2)])
+        self.assertEqual(self.backend.acquire(
+            'fake_export', self._request(username='bob'), False,
+            'username', 2)[1], [])
+
+        self.backend.release(leases[:1])
+        self.assertEqual(self.backend.acquire(
+            'fake_export', self._request(), False, 'username', 2)[1], [])
+
+    def test_global_slots(self):
+        self.backend.acquire('fake_export', self._request(), False, None, 1)
+        leases, limits = self.backend.acquire(
+            'fake_export', self._request('10.0.0.2'), False, None, 1)
+        self.assertEqual(leases, [])
+        self.assertEqual(limits[0]['ratelimited_by'], 'all')
+        self.assertEqual(
+            limits[0]['cache_key'], 'rl:func:fake_export:concurrent:1:all')
+
+    def test_no_slot_is_held_when_any_identity_is_full(self):
+        self.backend.acquire(
+            'fake_export', self._request('10.0.0.9'), False, 'username')
+        self.assertEqual(self.backend.acquire(
+            'fake_export', self._request(), True, 'username')[0], [])
+        # The IP's slot taken along the way was given back.
+        self.assertEqual(
+            self.backend.acquire('fake_export', self._request())[1], [])
+
+    def test_expired_lease_isnt_released_twice(self):
+        stale, _ = self.backend.acquire('fake_export', self._request())
+        # As if the lease had timed out and the slot been taken again.
+        cache.clear()
+        self.backend.acquire('fake_export', self._request())
+        self.backend.release(stale)
+        self.assertEqual(
+            self.backend.acquire('fake_export', self._request())[0], [])
+
+    def test_lease_timeout(self):
+        added = []
+        backend = CacheBackend()
+        with override_settings(RATELIMIT_LEASE_TIMEOUT=30):
+            backend.setup()
+        backend._add_slot = lambda key, token, timeout: added.append(timeout)
+        backend.acquire('fake_export', self._request())
+        self.assertEqual(added, [30])
+
+
+@ratelimit(ip_prefix_v4=24, ip_prefix_v6=64, rate='2/m', block=True)
+@ratelimit(ip_prefix_v4=24, ip_prefix_v6=64, rate='10/h', block=True)
+def fake_prefixed(request):
+    return HttpResponse()
+
+
+class TestIPPrefixes(RateLimitTestCase):
+
+    def _get(self, view, ip):
+        request = FakeRequest()
+        request.method = 'GET'
+        request.META = {'REMOTE_ADDR': ip}
+        request.GET = {}
+        return view(request)
+
+    def test_addresses(self):
+        prefixes = IPPrefixes(24, 64)
+        self.assertEqual(prefixes.addresses('10.0.0.7'), ('10.0.0.0/24',))
+        self.assertEqual(prefixes.addresses('2001:db8:0:1:2:3:4:5'),
+            ('2001:db8:0:1::/64',))
+        self.assertEqual(
+            prefixes.addresses('::ffff:10.0.0.7'), ('10.0.0.0/24',))
+        self.assertEqual(prefixes.addresses('unknown'), ('unknown',))
+        self.assertEqual(IPPrefixes(32, 48).addresses('10.0.0.7'),
+            ('10.0.0.7',))
+        self.assertEqual(
+            IPPrefixes(v6=64, exact=True).addresses('2001:db8::1'),
+            ('2001:db8::1', '2001:db8::/64'))
+        self.assertRaises(ImproperlyConfigured, IPPrefixes, 33)
+
+    def test_ipaddress_is_only_needed_for_prefixes(self):
+        from brake import backends
+        ipaddress = backends.ipaddress
+        backends.ipaddress = None
+        try:
+            self.assertEqual(backends.with_prefixes(True), True)
+            self.assertRaises(
+                ImproperlyConfigured, backends.with_prefixes, True, 24)
+        finally:
+            backends.ipaddress = ipaddress
+
+    def test_parsed_addresses_are_remembered(self):
+        prefixes = IPPrefixes(16)
+        prefixes.addresses('192.168.3.4')
+        hits = _networks.cache_info().hits
+        IPPrefixes(16).addresses('192.168.3.4')
+        self.assertEqual(_networks.cache_info().hits, hits + 1)
+
+    def test_network_is_limited(self):
+        self.assertEqual(fake_prefixed._ratelimit['rates'],
+            [(10, 3600), (2, 60)])
+        for i in range(2):
+            self.assertEqual(
+                self._get(fake_prefixed, '2001:db8::%d' % i).status_code, 200)
+        self.assertEqual(
+            self._get(fake_prefixed, '2001:db8::ffff').status_code, 429)
+        self.assertEqual(
+            self._get(fake_prefixed, '2001:db8:0:1::1').status_code, 200)
+        self.assertEqual(self.stored_count(
+            'rl:func:fake_prefixed:period:60:ip:2001:db8::/64'), 4)
+
+    def test_exact_and_network_in_one_call(self):
+        @ratelimit(ip_prefix_v4=24, ip_exact=True, rate='5/m')
+        def view(request):
+            return HttpResponse()
+
+        counting_cache = CountingCache(cachebe.cache)
+        cachebe.cache = counting_cache
+        try:
+            self._get(view, '10.0.0.7')
+        finally:
+            cachebe.cache = counting_cache._cache
+        self.assertEqual(counting_cache.calls, ['get_many', 'set_many'])
+        self.assertEqual(self.stored_count(
+            'rl:func:view:period:60:ip:10.0.0.7'), 2)
+        self.assertEqual(self.stored_count(
+            'rl:func:view:period:60:ip:10.0.0.0/24'), 2)
+
+
+class TestSimulate(unittest.TestCase):
+
+    RULES = [
+        {'prefix': '/login/', 'rate': '2/m', 'field': 'username',
+         'name': 'login'},
+        {'prefix': '/api/', 'rate': '3/m', 'ip': False,
+         'field': 'X-Api-Key', 'field_source': 'header'},
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def _csv(self):
+        return self._write('access.csv', '\n'.join([
+            'timestamp,ip,path,method,username',
+            '1000,10.0.0.1,/login/,POST,alice',
+            '1001,10.0.0.1,/login/,POST,bob',
+            '1002,10.0.0.1,/login/,POST,carol',
+            '1003,10.0.0.2,/login/,POST,alice',
+            '1004,10.0.0.3,/login/,POST,alice',
+            '1005,10.0.0.4,/other/,GET,',
+            # The next minute: every counter has expired.
+            '1070,10.0.0.1,/login/,POST,alice',
+        ]) + '\n')
+
+    def test_parse_timestamp(self):
+        self.assertEqual(simulate.parse_timestamp('1000.5'), 1000.5)
+        self.assertEqual(
+            simulate.parse_timestamp('1970-01-01T00:16:40.5Z'), 1000.5)
+        self.assertEqual(
+            simulate.parse_timestamp('1970-01-01 01:16:40+01:00'), 1000)
+        self.assertRaises(ValueError, simulate.parse_timestamp, 'yesterday')
+
+    def test_csv(self):
+        results = simulate.simulate([self._csv()], {'current': self.RULES})
+        self.assertEqual(results, {'current': {
+            'requests': 6, 'limited': 2,
+            'rules': {'login': {
+                'requests': 6, 'limited': 2, 'ips': 1, 'fields': 1}},
+        }})
+
+    def test_candidates_and_jsonl(self):
+        path = self._write('access.jsonl', '\n'.join(json.dumps({
+            'timestamp': '1970-01-01T00:16:%02dZ' % i, 'ip': '10.0.0.%d' % i,
+            'path': '/api/items', 'method': 'GET', 'X-Api-Key': 'secret',
+        }) for i in range(6)))
+        results = simulate.simulate([path], {
+            'current': self.RULES,
+            'stricter': [dict(self.RULES[1], rate='1/m')],
+        })
+        self.assertEqual(results['current']['rules']['/api/'], {
+            'requests': 6, 'limited': 3, 'ips': 0, 'fields': 1})
+        self.assertEqual(results['stricter']['limited'], 5)
+
+    def test_processes(self):
+        path = self._csv()
+        by_ip = [dict(self.RULES[0], field=None)]
+        self.assertEqual(
+            simulate.simulate([path], {'current': by_ip}, processes=2),
+            simulate.simulate([path], {'current': by_ip}))
+        by_user = [dict(self.RULES[0], ip=False)]
+        self.assertEqual(
+            simulate.simulate([path], {'current': by_user}, processes=3,
+                shard_by='username'),
+            simulate.simulate([path], {'current': by_user}))
+
+    def test_lines_are_split_unparsed(self):
+        class Batches(list):
+            put = list.append
+
+        queues = [Batches(), Batches()]
+        simulate._split([self._csv()], None, 'ip', queues)
+        sent = []
+        for index, queue in enumerate(queues):
+            self.assertEqual(queue[-1], None)
+            for format, header, lines in queue[:-1]:
+                self.assertEqual(format, simulate.CSV)
+                self.assertEqual(header, 'timestamp,ip,path,method,username\n')
+                for number, line in lines:
+                    sent.append(number)
+                    self.assertEqual(
+                        simulate._shard(line.split(',')[1], 2), index)
+        self.assertEqual(sorted(sent), list(range(7)))
+
+    def test_column_of_a_raw_line(self):
+        value = simulate._column(simulate.JSONL, None, 'ip')
+        self.assertEqual(value('{"ip": "10.0.0.1", "path": "/"}'), '10.0.0.1')
+        self.assertEqual(value('{"path": "/"}'), '')
+        value = simulate._column(simulate.CSV, 'ip,"path"\n', 'path')
+        self.assertEqual(value('10.0.0.1,"/login/"\n'), '/login/')
+        self.assertRaises(
+            ValueError, simulate._column, simulate.CSV, 'ip\n', 'username')
+
+    def test_errors_in_processes_are_raised(self):
+        path = self._write('broken.csv', 'ip,path\n10.0.0.1,/login/\n')
+        self.assertRaises(KeyError, simulate.simulate,
+            [path], {'current': self.RULES}, processes=2)
+
+    @unittest.skipIf(django.VERSION < (1, 8), 'Needs Django 1.8')
+    def test_command(self):
+        config = self._write('rules.json', json.dumps({'new': self.RULES}))
+        out = StringIO()
+        call_command(ratelimit_simulate.Command(), self._csv(),
+            '--config', config, stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'candidate\trule\trequests\tlimited\tips\tfields',
+            'new\tlogin\t6\t2\t1\t1',
+            'new\t*\t6\t2\t\t',
+        ])
+
+        with override_settings(RATELIMIT_RULES=[]):
+            self.assertRaises(CommandError, call_command,
+                ratelimit_simulate.Command(), self._csv())
+
+
+class FakeRedisBackend(RedisBackend):
+
+    def get_client(self):
+        return fakeredis.FakeRedis()
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisBackend(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestRedisBackend, self).setUp()
+        self.backend = FakeRedisBackend()
+        self.backend.setup()
+        self.backend.client.flushall()
+        self.request = FakeRequest()
+        self.request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.request.POST = {'username': 'user'}
+        self.rates = [(5, 60), (10, 3600)]
+
+    def _hit(self):
+        return self.backend.hit_many(
+            'fake_login', self.request, field='username', rates=self.rates)
+
+    def test_hit(self):
+        for _ in range(5):
+            self.assertEqual(self._hit(), [])
+        limits = self._hit()
+        self.assertEqual(
+            sorted((l['ratelimited_by'], l['period']) for l in limits),
+            [('field', 60), ('ip', 60)])
+        limits = self.backend.limit_many(
+            'fake_login', self.request, field='username', rates=self.rates)
+        self.assertEqual([l['count'] for l in limits], [7, 7])
+
+    def test_lets_in_as_many_as_cache_backend(self):
+        rates = [(2, 60)]
+        self.assertEqual([
+            bool(self.backend.hit_many('fake_login', self.request, rates=rates))
+            for _ in range(3)
+        ], [False, False, True])
+        self.assertEqual([l['count'] for l in self.backend.hit_buckets(
+            self.request, [('fake_login', True, None, rates, None)])[0]], [4])
+
+    def test_increment_checks_as_many_as_cache_backend(self):
+        rates = [(2, 60)]
+        for _ in range(2):
+            self.assertEqual(self.backend.limit_many(
+                'fake_login', self.request, rates=rates), [])
+            self.backend.count_many('fake_login', self.request, rates=rates)
+        self.assertTrue(self.backend.limit_many(
+            'fake_login', self.request, rates=rates))
+
+    def test_quota(self):
+        self._hit()
+        self.assertEqual(self.request.ratelimit_quota['remaining'], 4)
+        self.assertTrue(59 <= self.request.ratelimit_quota['reset'] <= 60)
+        for _ in range(6):
+            self._hit()
+        limits = self.backend.limit_many(
+            'fake_login', self.request, field='username', rates=self.rates)
+        self.assertTrue(all(0 < l['reset'] <= 60 for l in limits))
+
+    def test_ttls(self):
+        self._hit()
+        for key in self.backend._keys(
+                'fake_login', self.request, field='username', period=3600):
+            self.assertEqual(self.backend.client.ttl(key), 3600)
+            self.assertEqual(int(self.backend.client.get(key)), 1)
+
+    def test_count_many(self):
+        self.backend.count_many(
+            'fake_login', self.request, rates=[(None, 60)], amount=3)
+        key = self.backend._keys('fake_login', self.request, period=60)[0]
+        self.assertEqual(int(self.backend.client.get(key)), 3)
+
+    def test_concurrent_increments_are_not_lost(self):
+        workers, hits = 8, 25
+
+        def hammer():
+            for _ in range(hits):
+                self._hit()
+
+        threads = [threading.Thread(target=hammer) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        key = self.backend._keys('fake_login', self.request, period=60)[0]
+        self.assertEqual(int(self.backend.client.get(key)), workers * hits)
+
+    def test_acquire(self):
+        leases, _ = self.backend.acquire(
+            'fake_export', self.request, max_concurrent=1)
+        (slot, _), = leases
+        self.assertTrue(0 < self.backend.client.ttl(slot) <= 300)
+        self.assertEqual(self.backend.acquire(
+            'fake_export', self.request, max_concurrent=1)[0], [])
+        self.backend.release(leases)
+        self.assertEqual(self.backend.client.exists(slot), 0)
 
+    def test_inspection(self):
+        self._hit()
+        self._hit()
+        counts = self.backend.get_counts(
+            'fake_login', [60], ips=['10.0.0.1', '10.0.0.2'],
+            fields=[('username', 'user')])
+        self.assertEqual(counts, {
+            (('ip', '10.0.0.1'), 60): 2, (('username', 'user'), 60): 2})
+        self.assertEqual(len(self.backend.reset_counts(
+            'fake_login', [60, 3600], ips=['10.0.0.1'])), 2)
+        self.assertEqual(self.backend.get_counts(
+            'fake_login', [60, 3600], ips=['10.0.0.1']), {})
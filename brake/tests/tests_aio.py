@@ -0,0 +1,9 @@
+"""Tests for async views, which only parse on Python 3.7 and later.
+
+They live in ``aio.py``, a name nose doesn't collect by itself, so that
+running the tests on Python 2 doesn't stop at a SyntaxError.
+"""
+import sys
+
+if sys.version_info >= (3, 7):
+    from brake.tests.aio import TestAsyncViews  # noqa
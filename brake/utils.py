@@ -3,20 +3,14 @@ from brake.decorators import _backend
 """Access limits and increment counts without using a decorator."""
 
 def get_limits(request, label, field, periods, increment=1):
-    limits = []
+    rates = []
     count = 10
     for period in periods:
-        limits.extend(_backend.limit(
-            label,
-            request,
-            field=field,
-            count=count,
-            period=period
-        ))
+        rates.append((count, period))
         count += increment
 
-    return limits
+    return _backend.limit_many(label, request, field=field, rates=rates)
 
 def inc_counts(request, label, field, periods):
-    for period in periods:
-        _backend.count(label, request, field=field, period=period)
+    _backend.count_many(
+        label, request, field=field, rates=[(None, p) for p in periods])
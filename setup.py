@@ -11,13 +11,18 @@ setup(
     author_email='james@mozilla.com, gavin@urbanairship.com',
     url='http://github.com/gmcquillan/django-brake',
     license='BSD',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
     package_data = { '': ['README.rst'] },
     install_requires=[
         'django',
         'nose',
     ],
+    extras_require={
+        'redis': ['redis'],
+        'prometheus': ['prometheus_client'],
+        'ipaddress': ['ipaddress; python_version < "3"'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',